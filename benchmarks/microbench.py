@@ -0,0 +1,435 @@
+""" Microbenchmarks of the pubsub components
+
+Runs on a plain machine over inproc://, ipc:// and loopback TCP, without
+Mininet, and times each component on its own:
+- Publisher.publish for every message type
+- Subscriber.wait_for_msg, decoding plus the callback
+- RoutingBroker.process forwarding
+- registration round trips with the routing and the direct broker
+- adding topics to and matching prefixes in the direct broker's topic trie
+- matching topics against wildcard patterns, as the routing broker does
+- compressing and decompressing small JSON payloads with a trained dictionary
+
+Results are written as JSON. When a baseline file from an earlier run is
+given, every benchmark is compared with it and the script exits with status 1
+if any of them got slower by more than the threshold.
+
+Usage, from the repository root:
+python -m benchmarks.microbench --output bench.json [--baseline baseline.json]
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import zmq
+
+from pubsub.broker import AbstractBroker, DirectBroker, RoutingBroker
+from pubsub.compression import Compression, TopicCompression
+from pubsub.patterns import PatternIndex
+from pubsub.publisher import Publisher
+from pubsub.subscriber import Subscriber
+from pubsub.trie import TopicTrie
+from pubsub.util import MessageType, WireFormat, codecs, get_codec, pack_envelope
+
+TRANSPORTS = ["inproc", "ipc", "tcp"]
+TOPIC = "bench"
+
+context = zmq.Context.instance()
+
+endpoint_ids = itertools.count()
+
+# The directory of ipc:// endpoints, created and removed by run
+ipc_dir = None
+
+
+def endpoint(transport):
+    """
+    Returns a new address for a transport. TCP addresses use a wildcard port,
+    use `bound_address` to find the port that was picked.
+    :param transport: inproc, ipc or tcp
+    :return: A string address
+    """
+    index = next(endpoint_ids)
+    if transport == "inproc":
+        return f"inproc://bench-{index}"
+    if transport == "ipc":
+        return f"ipc://{ipc_dir}/{index}"
+    return "tcp://127.0.0.1:*"
+
+
+def bound_address(socket):
+    """
+    :param socket: a bound socket
+    :return: the address the socket was last bound to
+    """
+    return socket.getsockopt_string(zmq.LAST_ENDPOINT)
+
+
+def sample_messages():
+    """
+    :return: dict of message type to a sample message of that type
+    """
+    messages = {
+        MessageType.STRING: "lorem ipsum dolor sit amet " * 4,
+        MessageType.PYOBJ: {"id": 1, "values": list(range(16)), "name": "lorem"},
+        MessageType.JSON: {"id": 1, "values": list(range(16)), "name": "lorem"},
+    }
+    if MessageType.NDARRAY in codecs:
+        import numpy as np
+        messages[MessageType.NDARRAY] = np.arange(1 << 16, dtype=np.float64)
+    return messages
+
+
+def drain(socket, stop):
+    """
+    Receives and discards messages until stop is set.
+    :param socket: the socket to drain
+    :param stop: threading.Event
+    """
+    while not stop.is_set():
+        if socket.poll(10):
+            while True:
+                try:
+                    socket.recv_multipart(zmq.NOBLOCK, copy=False)
+                except zmq.Again:
+                    break
+
+
+def timed(count, operation):
+    """
+    Calls operation count times.
+    :return: the number of seconds it took
+    """
+    start = time.perf_counter()
+    for _ in range(count):
+        operation()
+    return time.perf_counter() - start
+
+
+def bench_publish(transport, message_type, message, count):
+    publisher = Publisher(endpoint(transport), "inproc://bench-no-broker")
+    publisher.topics.append(TOPIC)
+    publisher.wire_format = WireFormat.COMPACT
+
+    # A subscriber keeps the messages flowing over the transport
+    sink = context.socket(zmq.SUB)
+    sink.setsockopt(zmq.SUBSCRIBE, b"")
+    sink.connect(bound_address(publisher.message_pub))
+    stop = threading.Event()
+    thread = threading.Thread(target=drain, args=[sink, stop])
+    thread.start()
+    time.sleep(.1)
+
+    elapsed = timed(count, lambda: publisher.publish(TOPIC, message, message_type))
+
+    stop.set()
+    thread.join()
+    for socket in [sink, publisher.message_pub, publisher.registration]:
+        socket.close(linger=0)
+    return elapsed
+
+
+def bench_wait_for_msg(transport, message_type, message, count):
+    source = context.socket(zmq.PUB)
+    source.setsockopt(zmq.SNDHWM, 0)
+    source.bind(endpoint(transport))
+
+    subscriber = Subscriber(endpoint(transport), "inproc://bench-no-broker")
+    subscriber.register_callback(lambda topic, received: None)
+    subscriber.message_sub.setsockopt(zmq.RCVHWM, 0)
+    subscriber.message_sub.setsockopt_string(zmq.SUBSCRIBE, TOPIC)
+    subscriber.message_sub.connect(bound_address(source))
+    time.sleep(.1)
+
+    frames = pack_envelope(TOPIC, message_type, time.time(), get_codec(message_type).encode_frames(message),
+                           WireFormat.COMPACT)
+    for _ in range(count):
+        source.send_multipart(frames, copy=False)
+
+    elapsed = timed(count, subscriber.wait_for_msg)
+
+    for socket in [source, subscriber.message_sub, subscriber.publisher_sub, subscriber.registration]:
+        socket.close(linger=0)
+    return elapsed
+
+
+def bench_routing_process(transport, count):
+    broker = RoutingBroker(endpoint(transport))
+    source = context.socket(zmq.PUB)
+    source.setsockopt(zmq.SNDHWM, 0)
+    source.bind(endpoint(transport))
+    sink = context.socket(zmq.SUB)
+    sink.setsockopt(zmq.SUBSCRIBE, b"")
+    sink.bind(endpoint(transport))
+
+    broker.message_in.setsockopt(zmq.RCVHWM, 0)
+    broker.message_in.setsockopt(zmq.SUBSCRIBE, TOPIC.encode('utf-8'))
+    broker.message_in.connect(bound_address(source))
+    broker.message_out.connect(bound_address(sink))
+    stop = threading.Event()
+    thread = threading.Thread(target=drain, args=[sink, stop])
+    thread.start()
+    time.sleep(.1)
+
+    frames = pack_envelope(TOPIC, MessageType.STRING, time.time(), [b"lorem ipsum dolor sit amet" * 4],
+                           WireFormat.COMPACT)
+    for _ in range(count):
+        source.send_multipart(frames)
+
+    elapsed = timed(count, broker.process)
+
+    stop.set()
+    thread.join()
+    for socket in [source, sink, broker.message_in, broker.message_out, broker.registration]:
+        socket.close(linger=0)
+    return elapsed
+
+
+def bench_registration(broker_class, transport, count):
+    broker = broker_class(endpoint(transport))
+    registration_address = bound_address(broker.registration)
+    thread = threading.Thread(target=broker.serve, args=[.01])
+    thread.start()
+
+    # Register the same publisher address every time, so the routing broker
+    # only ever connects to one endpoint
+    publisher = context.socket(zmq.PUB)
+    publisher.bind(endpoint(transport))
+    request = context.socket(zmq.REQ)
+    request.connect(registration_address)
+    frames = [b"REGISTER_PUBLISHER", TOPIC.encode('utf-8'), bound_address(publisher).encode('utf-8'),
+              json.dumps({"wire_formats": [WireFormat.LEGACY, WireFormat.COMPACT]}).encode('utf-8')]
+
+    def round_trip():
+        request.send_multipart(frames)
+        request.recv_multipart()
+
+    round_trip()
+    elapsed = timed(count, round_trip)
+
+    broker.shutdown()
+    thread.join()
+    for socket in [request, publisher, broker.registration, broker.message_out]:
+        socket.close(linger=0)
+    if broker_class is RoutingBroker:
+        broker.message_in.close(linger=0)
+    return elapsed
+
+
+def bench_trie(count):
+    """
+    Adds count topics, in a hierarchy of sites and sensors, to a trie and
+    matches the prefix of every site.
+    :return: the number of seconds it took
+    """
+    topics = [f"site{index % 100}/sensor{index}" for index in range(count)]
+    sites = [f"site{index}/" for index in range(100)]
+    trie = TopicTrie()
+
+    start = time.perf_counter()
+    for index, topic in enumerate(topics):
+        trie.add(topic, b"tcp://127.0.0.1:%d" % (5000 + index % 100))
+    for site in sites:
+        trie.match(site)
+    return time.perf_counter() - start
+
+
+def bench_patterns(count):
+    """
+    Matches count messages on a thousand topics against ten thousand
+    wildcard patterns, memoized per topic as the routing broker does.
+    :return: the number of seconds it took
+    """
+    patterns = PatternIndex()
+    for site in range(100):
+        for sensor in range(100):
+            patterns.add(f"site{site}/*/sensor{sensor}" if sensor % 2 else f"site{site}/building{sensor}/#")
+    topics = [f"site{index % 100}/building{index % 10}/sensor{index % 100}" for index in range(1000)]
+
+    start = time.perf_counter()
+    for index in range(count):
+        patterns.match(topics[index % len(topics)])
+    return time.perf_counter() - start
+
+
+def bench_compression(count, decompress=False):
+    """
+    Compresses, or decompresses, count small JSON payloads with a dictionary
+    trained from a thousand others.
+    :return: the number of seconds it took
+    """
+    payloads = [json.dumps({"sensor": f"sensor{index % 100}", "state": "running", "temperature": 70 + index % 7,
+                            "pressure": round(1 + index % 13 / 10, 1)}).encode('utf-8') for index in range(1000)]
+    compression = Compression(TopicCompression(threshold=0), samples=len(payloads))
+    for payload in payloads:
+        compression.compress(TOPIC, payload)
+    compression.configure(TOPIC, compression.train(TOPIC))
+    compressed = [compression.compress(TOPIC, payload) for payload in payloads]
+
+    start = time.perf_counter()
+    for index in range(count):
+        if decompress:
+            compression.decompress(TOPIC, *compressed[index % len(compressed)])
+        else:
+            compression.compress(TOPIC, payloads[index % len(payloads)])
+    return time.perf_counter() - start
+
+
+def run(transports, count, repeat):
+    """
+    Runs every benchmark and keeps the fastest of `repeat` runs. The directory
+    of ipc endpoints only exists while they run.
+    :param transports: list of transports to run on
+    :param count: number of operations timed per run
+    :param repeat: number of runs
+    :return: dict of benchmark name to its result
+    """
+    # inproc only connects sockets of the same context, so every component shares one
+    contexts = Publisher.ctx, Subscriber.ctx, AbstractBroker.context
+    Publisher.ctx = context
+    Subscriber.ctx = context
+    AbstractBroker.context = context
+
+    global ipc_dir
+    if "ipc" in transports:
+        ipc_dir = tempfile.mkdtemp(prefix="pubsub-bench-")
+    try:
+        return run_benchmarks(transports, count, repeat)
+    finally:
+        Publisher.ctx, Subscriber.ctx, AbstractBroker.context = contexts
+        if ipc_dir is not None:
+            shutil.rmtree(ipc_dir, ignore_errors=True)
+            ipc_dir = None
+
+
+def run_benchmarks(transports, count, repeat):
+    """
+    Runs every benchmark, see `run`.
+    :param transports: list of transports to run on
+    :param count: number of operations timed per run
+    :param repeat: number of runs
+    :return: dict of benchmark name to its result
+    """
+    benchmarks = {}
+    for transport in transports:
+        for message_type, message in sample_messages().items():
+            benchmarks[f"publish/{transport}/{message_type}"] = \
+                (lambda t=transport, m=message_type, v=message: bench_publish(t, m, v, count), count)
+            benchmarks[f"wait_for_msg/{transport}/{message_type}"] = \
+                (lambda t=transport, m=message_type, v=message: bench_wait_for_msg(t, m, v, count), count)
+        benchmarks[f"routing_process/{transport}"] = (lambda t=transport: bench_routing_process(t, count), count)
+        registrations = max(1, count // 20)
+        for name, broker_class in [("routing", RoutingBroker), ("direct", DirectBroker)]:
+            benchmarks[f"registration/{name}/{transport}"] = \
+                (lambda t=transport, b=broker_class: bench_registration(b, t, registrations), registrations)
+
+    benchmarks["trie"] = (lambda: bench_trie(count), count)
+    benchmarks["patterns"] = (lambda: bench_patterns(count), count)
+    benchmarks["compress"] = (lambda: bench_compression(count), count)
+    benchmarks["decompress"] = (lambda: bench_compression(count, decompress=True), count)
+
+    results = {}
+    for name, (benchmark, operations) in benchmarks.items():
+        elapsed = min(benchmark() for _ in range(repeat))
+        results[name] = {
+            "operations": operations,
+            "seconds": elapsed,
+            "ops_per_sec": operations / elapsed,
+            "us_per_op": elapsed / operations * 1000000,
+        }
+        print(f"{name:<40} {results[name]['ops_per_sec']:>12.0f} ops/s {results[name]['us_per_op']:>10.2f} us/op")
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Compares results with a baseline.
+    :param results: dict of benchmark name to result, from `run`
+    :param baseline: dict of benchmark name to result, from an earlier run
+    :param threshold: the fraction by which ops_per_sec may drop before it is a regression
+    :return: dict of benchmark name to the change in ops_per_sec, as a fraction,
+        and the list of names that regressed
+    """
+    changes = {}
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        change = result["ops_per_sec"] / baseline[name]["ops_per_sec"] - 1
+        changes[name] = change
+        if change < -threshold:
+            regressions.append(name)
+    return changes, regressions
+
+
+def config_parser() -> argparse.ArgumentParser:
+    """
+    Configures the arguments accepted by the argparse module.
+    :return: A (argparse.ArgumentParser)
+    """
+    parser = argparse.ArgumentParser(prog='Microbenchmarks', usage='%(prog)s [options]',
+                                     description='Time the pubsub components over local transports.')
+    parser.add_argument('--output', '-o', metavar='Output', type=str, default='bench.json',
+                        help='file to write the results to')
+    parser.add_argument('--baseline', '-b', metavar='Baseline', type=str,
+                        help='results of an earlier run to compare with')
+    parser.add_argument('--threshold', metavar='Threshold', type=float, default=.1,
+                        help='slowdown compared with the baseline that counts as a regression, default .1 (10%%)')
+    parser.add_argument('--transports', metavar='Transports', nargs='+', choices=TRANSPORTS, default=TRANSPORTS,
+                        help='transports to run on')
+    parser.add_argument('--count', '-n', metavar='Count', type=int, default=10000,
+                        help='operations per run, registrations use a twentieth of this')
+    parser.add_argument('--repeat', '-r', metavar='Repeat', type=int, default=3,
+                        help='runs per benchmark, the fastest is kept')
+    return parser
+
+
+def main():
+    args = config_parser().parse_args()
+    results = run(args.transports, args.count, args.repeat)
+
+    report = {
+        "meta": {
+            "time": time.time(),
+            "python": platform.python_version(),
+            "pyzmq": zmq.__version__,
+            "libzmq": zmq.zmq_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "count": args.count,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)["results"]
+        changes, regressions = compare(results, baseline, args.threshold)
+        report["baseline"] = {"file": args.baseline, "threshold": args.threshold, "changes": changes,
+                              "regressions": regressions}
+        print()
+        for name, change in changes.items():
+            flag = "  REGRESSION" if name in regressions else ""
+            print(f"{name:<40} {change:>+8.1%}{flag}")
+
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results: {args.output}")
+
+    context.destroy(linger=0)
+    if regressions:
+        print(f"{len(regressions)} benchmarks regressed by more than {args.threshold:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import argparse
 import os
 import pathlib
 import re
@@ -5,10 +6,21 @@ import re
 import pandas as pd
 from matplotlib import pyplot as plt
 
+from pubsub.analysis import BINARY_EXTENSION, summarize_files
+from pubsub.metrics import PERCENTILES, read_exports
+
 source = "latency"
-filename_pattern = re.compile(".*(sub-(\\d+)_broker-([rd])).*")
+# sub-<N>_broker-<r|d>, with the other parameters tested by local_scaling.py if any
+filename_pattern = re.compile(".*(sub-(\\d+)_broker-([rd]))([^.]*).*")
 output_plot = "boxplot.png"
 output_stat = "boxplot.txt"
+metrics_plot = "percentiles.png"
+metrics_stat = "percentiles.txt"
+stream_cdf_plot = "cdf.png"
+stream_throughput_plot = "throughput.png"
+stream_stat = "stream.txt"
+# Percentiles reported by the streaming analysis
+stream_percentiles = [("p50", 50), ("p90", 90), ("p99", 99), ("p999", 99.9), ("p9999", 99.99)]
 
 
 def import_data():
@@ -16,11 +28,11 @@ def import_data():
     names = []
     for file in os.listdir(source):
         match = filename_pattern.match(file)
-        if not match:
+        if not match or not file.endswith(".log"):
             continue
         num_subs = int(match.group(2))
         rows = num_subs * 1000
-        name = "{0:03}_{1}".format(num_subs, match.group(3))
+        name = "{0:03}_{1}{2}".format(num_subs, match.group(3), match.group(4))
         df_curr = pd.read_csv(os.path.join(source, file), header=None, usecols=[0], names=[name], nrows=rows)
         df[name] = df_curr[name]
         names.append(name)
@@ -29,7 +41,144 @@ def import_data():
     return df, names
 
 
+def import_metrics():
+    """
+    Reads the metrics exports of every test run and merges the latency histograms
+    of every topic and interval in a run.
+    :return: dict of run name to the merged latency Histogram, in microseconds
+    """
+    runs = {}
+    for file in os.listdir(source):
+        match = filename_pattern.match(file)
+        if not match or not file.endswith(".metrics"):
+            continue
+        name = "{0:03}_{1}{2}".format(int(match.group(2)), match.group(3), match.group(4))
+        latency, _ = read_exports(os.path.join(source, file))
+        for histogram in latency.values():
+            if name in runs:
+                runs[name].merge(histogram)
+            else:
+                runs[name] = histogram
+
+    return dict(sorted(runs.items()))
+
+
+def analyze_metrics():
+    print("Analyzing metrics...")
+    runs = import_metrics()
+
+    names = [name for name, _ in PERCENTILES] + ["max"]
+    df = pd.DataFrame({run: [histogram.percentile(percentile) / 1000000 for _, percentile in PERCENTILES] +
+                       [histogram.max / 1000000] for run, histogram in runs.items()}, index=names)
+
+    plt.figure()
+    plt.title("PubSub Latency Percentiles")
+    axes = df.drop(index="max").T.plot(marker="o", logy=True, ax=plt.gca())
+    axes.set_xlabel("Test Run (<number subscribers>_<routing|direct>)")
+    axes.set_ylabel("Time (seconds)")
+    plt.savefig(metrics_plot, format="png")
+    print(f"Generated plot: {metrics_plot}")
+
+    counts = pd.DataFrame({run: [histogram.count] for run, histogram in runs.items()}, index=["count"])
+    print(f"Statistics:  {metrics_stat}")
+    with open(metrics_stat, "w") as f:
+        f.write("Statistics:\n\n")
+        f.write(pd.concat([counts, df]).to_string())
+        f.write("\n")
+
+
+def find_logs():
+    """
+    Finds the text and binary performance logs of every test run.
+    :return: dict of run name to the list of its log files
+    """
+    runs = {}
+    for file in sorted(os.listdir(source)):
+        match = filename_pattern.match(file)
+        if not match or not (file.endswith(".log") or file.endswith(BINARY_EXTENSION)):
+            continue
+        name = "{0:03}_{1}{2}".format(int(match.group(2)), match.group(3), match.group(4))
+        runs.setdefault(name, []).append(os.path.join(source, file))
+
+    return dict(sorted(runs.items()))
+
+
+def analyze_stream(window, workers):
+    print("Analyzing in chunks...")
+    summaries = summarize_files(find_logs(), window, workers)
+
+    plt.figure()
+    plt.title("PubSub Tail Latency")
+    for run, summary in summaries.items():
+        points = summary.cdf()
+        # plotting 1 - CDF on a log scale spreads out the tail
+        plt.step([latency for latency, _ in points], [1 - fraction for _, fraction in points],
+                 where="post", label=run)
+    plt.xscale("log")
+    plt.yscale("log")
+    plt.xlabel("Time (seconds)")
+    plt.ylabel("Fraction of messages slower")
+    plt.legend(fontsize="small")
+    plt.savefig(stream_cdf_plot, format="png")
+    print(f"Generated plot: {stream_cdf_plot}")
+
+    plt.figure()
+    plt.title("PubSub Throughput")
+    for run, summary in summaries.items():
+        windows = summary.throughput()
+        plt.plot([start for start, _, _ in windows], [messages for _, messages, _ in windows], label=run)
+    plt.xlabel(f"Time since first message (seconds, {window}s windows)")
+    plt.ylabel("Messages per second")
+    plt.legend(fontsize="small")
+    plt.savefig(stream_throughput_plot, format="png")
+    print(f"Generated plot: {stream_throughput_plot}")
+
+    print(f"Statistics:  {stream_stat}")
+    with open(stream_stat, "w") as f:
+        f.write("Latency (seconds):\n\n")
+        f.write(f"{'run':<24} {'count':>10} {'mean':>10} " +
+                " ".join(f"{name:>10}" for name, _ in stream_percentiles) + f" {'max':>10}\n")
+        for run, summary in summaries.items():
+            latency = summary.latency
+            f.write(f"{run:<24} {latency.count:>10} {latency.mean() / 1000000:>10.6f} " +
+                    " ".join(f"{latency.percentile(percentile) / 1000000:>10.6f}"
+                             for _, percentile in stream_percentiles) +
+                    f" {latency.max / 1000000:>10.6f}\n")
+
+        f.write(f"\nThroughput (messages per second, {window}s windows):\n\n")
+        f.write(f"{'run':<24} {'mean':>10} {'min':>10} {'max':>10}\n")
+        for run, summary in summaries.items():
+            rates = [messages for _, messages, _ in summary.throughput()] or [0]
+            f.write(f"{run:<24} {sum(rates) / len(rates):>10.1f} {min(rates):>10.1f} {max(rates):>10.1f}\n")
+
+        f.write("\nThroughput by window:\n")
+        for run, summary in summaries.items():
+            f.write(f"\n{run}\n")
+            for start, messages, size in summary.throughput():
+                f.write(f"{start:>10.1f}s {messages:>10.1f} msg/s {size / 1000:>10.1f} kB/s\n")
+
+
 def main():
+    parser = argparse.ArgumentParser(prog='Latency Analysis', usage='%(prog)s [options]',
+                                     description='Summarize the latency of test runs.')
+    parser.add_argument('--metrics', action='store_true',
+                        help='read the latency histograms exported by subscribers (*.metrics) '
+                             'instead of the per message performance logs')
+    parser.add_argument('--stream', action='store_true',
+                        help='summarize text and binary (*.bin) performance logs of any size in chunks on '
+                             'a pool of processes, and report latency CDFs and throughput over time')
+    parser.add_argument('--window', metavar='Window', type=float, default=1.0,
+                        help='seconds per throughput window with --stream')
+    parser.add_argument('--workers', metavar='Workers', type=int,
+                        help='number of processes with --stream, default is the number of CPUs')
+    args = parser.parse_args()
+    if args.metrics:
+        analyze_metrics()
+        return
+    if args.stream:
+        analyze_stream(args.window, args.workers)
+        return
+
     print("Analyzing...")
     df, cols = import_data()
 
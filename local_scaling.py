@@ -0,0 +1,391 @@
+#!/usr/bin/python
+""" Scaling tests on a single machine
+
+Runs the same kind of test as single_switch.py without Mininet: the broker,
+the publishers and the subscribers are started as local processes talking
+over loopback TCP. Every combination of subscriber count, publisher count,
+message size, topic count and broker type is run once.
+
+The per message performance logs and metrics exports of the subscribers are
+written to latency/sub-<N>_broker-<r|d>.log and .metrics, as with
+single_switch.py, so latency_analysis.py reads them the same way. When more
+than one publisher count, message size or topic count is tested, those are
+added to the file names, e.g. sub-4_broker-r_pub-2_size-1024.log. With
+--binary the performance logs are written as .bin files instead, read by
+latency_analysis.py --stream.
+
+Throughput, latency percentiles and the CPU time and peak RSS of every
+process are printed and written to latency/scaling.json.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import string
+import tempfile
+import time
+from queue import Empty
+
+import pubsub.broker as br
+from psserver import serve
+from pubsub.logs import PerfMode, configure_logging, stop_logging
+from pubsub.metrics import PERCENTILES, Histogram, TopicMetrics, read_exports
+from pubsub.publisher import Publisher
+from pubsub.subscriber import Subscriber
+
+address_format = "tcp://{0}:{1}"
+output_dir = "latency"
+output_results = "scaling.json"
+EXIT_TOPIC = "EXIT_MESSAGE"
+EXIT_MESSAGE = "Exiting..."
+banner = "\n" \
+         "+-------------------------------------------------\n" \
+         "| Running test with {0} subscribers, {1} publishers, {2} byte messages,\n" \
+         "| {3} topics and {4} broker\n" \
+         "+-------------------------------------------------\n"
+
+# Spawn rather than fork so children do not inherit this process's ZMQ contexts
+mp_context = multiprocessing.get_context("spawn")
+
+
+def config_parser() -> argparse.ArgumentParser:
+    """
+    Configures the arguments accepted by the argparse module.
+    :return: A (argparse.ArgumentParser)
+    """
+    parser = argparse.ArgumentParser(prog='Local Scaling Tests', usage='%(prog)s [options]',
+                                     description='Run scaling tests with local processes, without Mininet.')
+    parser.add_argument('--subscribers', '-s', metavar='Subscribers', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help='numbers of subscribers to test')
+    parser.add_argument('--publishers', '-p', metavar='Publishers', type=int, nargs='+', default=[1],
+                        help='numbers of publishers to test')
+    parser.add_argument('--sizes', metavar='Sizes', type=int, nargs='+', default=[64],
+                        help='message sizes to test, in characters')
+    parser.add_argument('--topics', '-t', metavar='Topics', type=int, nargs='+', default=[1],
+                        help='numbers of topics to test, every publisher sends on and every subscriber '
+                             'subscribes to all of them')
+    parser.add_argument('--brokers', '-b', metavar='Brokers', choices=['r', 'd'], nargs='+', default=['r', 'd'],
+                        help="broker types to test: 'r' routing, 'd' direct")
+    parser.add_argument('--messages', '-n', metavar='Messages', type=int, default=1000,
+                        help='number of messages sent by each publisher')
+    parser.add_argument('--rate', metavar='Rate', type=float, default=0,
+                        help='messages per second sent by each publisher, default sends as fast as possible')
+    parser.add_argument('--address', metavar='Address', type=str, default='127.0.0.1',
+                        help='IP address to bind to')
+    parser.add_argument('--port', metavar='Port', type=int, default=5555,
+                        help='port of the broker, publishers and subscribers use the ports after it')
+    parser.add_argument('--delay', metavar='Delay', type=float, default=0,
+                        help='extra seconds publishers wait before sending, after their connections are confirmed')
+    parser.add_argument('--timeout', metavar='Timeout', type=float, default=10.0,
+                        help='seconds a subscriber waits for a message before giving up')
+    parser.add_argument('--binary', action='store_true',
+                        help='write binary performance logs (.bin) instead of text, read by '
+                             'latency_analysis.py --stream')
+    parser.add_argument('--keep', action='store_true',
+                        help='add to the results of the previous run instead of replacing them')
+    return parser
+
+
+def usage():
+    """
+    :return: dict with the CPU seconds and peak RSS in kB of the calling process
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {"cpu_seconds": usage.ru_utime + usage.ru_stime, "max_rss_kb": usage.ru_maxrss}
+
+
+def topic_names(num_topics):
+    """
+    Returns topic names that are not prefixes of each other.
+    :param num_topics: the number of topics
+    :return: A list of strings
+    """
+    if num_topics == 1:
+        return ["lorem"]
+    return [f"lorem-{index:04}" for index in range(num_topics)]
+
+
+def run_broker(broker_type, address, ready, results):
+    broker = br.RoutingBroker(address) if broker_type == 'r' else br.DirectBroker(address)
+    ready.put("broker")
+    # returns when the harness terminates the process
+    serve(broker)
+    report = {"name": "broker", "role": "broker"}
+    report.update(usage())
+    results.put(report)
+
+
+def run_subscriber(name, address, broker_address, topics, num_publishers, run_dir, timeout, binary, ready,
+                   results):
+    if binary:
+        configure_logging(log_file=None, perf_log_file=os.path.join(run_dir, f"{name}.bin"),
+                          perf_mode=PerfMode.BINARY)
+    else:
+        configure_logging(log_file=None, perf_log_file=os.path.join(run_dir, f"{name}.log"))
+    metrics = TopicMetrics(export_file=os.path.join(run_dir, f"{name}.metrics"))
+    subscriber = Subscriber(address, broker_address, metrics=metrics)
+
+    counts = {"received": 0, "exits": 0, "first": None, "last": None}
+
+    def counting_callback(topic, message):
+        if topic == EXIT_TOPIC:
+            counts["exits"] += 1
+            return
+        now = time.time()
+        if counts["first"] is None:
+            counts["first"] = now
+        counts["last"] = now
+        counts["received"] += 1
+
+    subscriber.register_callback(counting_callback)
+    subscriber.register_many(topics + [EXIT_TOPIC])
+    ready.put(name)
+
+    last_message = time.time()
+    while counts["exits"] < num_publishers and time.time() - last_message < timeout:
+        if subscriber.run_once(timeout=.1):
+            last_message = time.time()
+
+    metrics.close()
+    stop_logging()
+    report = {"name": name, "role": "subscriber", "received": counts["received"], "first": counts["first"],
+              "last": counts["last"], "timed_out": counts["exits"] < num_publishers}
+    report.update(usage())
+    results.put(report)
+
+
+def run_publisher(name, address, broker_address, topics, num_messages, size, rate, delay, num_subscribers, timeout,
+                  results):
+    publisher = Publisher(address, broker_address)
+    publisher.register_many(topics + [EXIT_TOPIC])
+
+    # a routing broker subscribes once a subscriber is interested, direct
+    # subscribers connect after hearing about this publisher from the broker
+    count = num_subscribers if publisher.broker_type == br.BrokerType.DIRECT else min(num_subscribers, 1)
+    if not publisher.wait_for_subscribers(count, timeout):
+        print(f"{name} timed out waiting for {count} subscribers")
+
+    message = "".join(random.choices(string.ascii_letters, k=size))
+    interval = 1 / rate if rate else 0
+    time.sleep(delay)
+
+    start = time.time()
+    for index in range(num_messages):
+        publisher.publish(topics[index % len(topics)], message)
+        if interval:
+            pause = start + (index + 1) * interval - time.time()
+            if pause > 0:
+                time.sleep(pause)
+    seconds = time.time() - start
+    publisher.publish(EXIT_TOPIC, EXIT_MESSAGE)
+
+    # give the last messages time to leave before the sockets are closed
+    time.sleep(.5)
+    report = {"name": name, "role": "publisher", "sent": num_messages, "seconds": seconds}
+    report.update(usage())
+    results.put(report)
+
+
+def wait_ready(ready, count, timeout):
+    for _ in range(count):
+        try:
+            ready.get(timeout=timeout)
+        except Empty:
+            raise RuntimeError("Timed out waiting for processes to start")
+
+
+def collect(results, processes, timeout):
+    reports = []
+    deadline = time.time() + timeout
+    for process in processes:
+        try:
+            reports.append(results.get(timeout=max(.1, deadline - time.time())))
+        except Empty:
+            print(f"No report from {process.name}")
+    for process in processes:
+        process.join(1)
+        if process.is_alive():
+            process.kill()
+    return reports
+
+
+def run_iteration(config, run_dir):
+    """
+    Runs one test with local processes.
+    :param config: dict with subscribers, publishers, size, topics, broker, messages, rate,
+        address, port, delay, timeout and binary
+    :param run_dir: directory the subscribers write their logs and metrics to
+    :return: list of the reports of every process
+    """
+    ready = mp_context.Queue()
+    results = mp_context.Queue()
+    topics = topic_names(config["topics"])
+    broker_address = address_format.format(config["address"], config["port"])
+    ports = iter(range(config["port"] + 1, config["port"] + 1 + config["publishers"] + config["subscribers"]))
+
+    broker = mp_context.Process(target=run_broker, name="broker",
+                                args=[config["broker"], broker_address, ready, results])
+    broker.start()
+    wait_ready(ready, 1, config["timeout"])
+
+    subscribers = []
+    for index in range(config["subscribers"]):
+        name = f"sub-{index}"
+        subscribers.append(mp_context.Process(
+            target=run_subscriber, name=name,
+            args=[name, address_format.format(config["address"], next(ports)), broker_address, topics,
+                  config["publishers"], run_dir, config["timeout"], config["binary"], ready, results]))
+        subscribers[-1].start()
+    wait_ready(ready, config["subscribers"], config["timeout"])
+
+    publishers = []
+    for index in range(config["publishers"]):
+        name = f"pub-{index}"
+        publishers.append(mp_context.Process(
+            target=run_publisher, name=name,
+            args=[name, address_format.format(config["address"], next(ports)), broker_address, topics,
+                  config["messages"], config["size"], config["rate"], config["delay"], config["subscribers"],
+                  config["timeout"], results]))
+        publishers[-1].start()
+
+    reports = collect(results, publishers + subscribers, config["timeout"] * 2 + config["delay"] +
+                      (config["messages"] / config["rate"] if config["rate"] else 0))
+
+    broker.terminate()
+    reports.extend(collect(results, [broker], config["timeout"]))
+    return reports
+
+
+def run_name(config, swept):
+    """
+    Returns the file name of a test, without extension.
+    :param config: the test configuration
+    :param swept: the parameters that take more than one value, besides subscribers and broker
+    :return: A string in the format sub-<N>_broker-<r|d>[_pub-<N>][_size-<N>][_topics-<N>]
+    """
+    name = f"sub-{config['subscribers']}_broker-{config['broker']}"
+    for parameter, label in [("publishers", "pub"), ("size", "size"), ("topics", "topics")]:
+        if parameter in swept:
+            name += f"_{label}-{config[parameter]}"
+    return name
+
+
+def concatenate(run_dir, extension, path):
+    with open(path, 'wb') as output:
+        for file in sorted(os.listdir(run_dir)):
+            if file.endswith(extension):
+                with open(os.path.join(run_dir, file), 'rb') as part:
+                    shutil.copyfileobj(part, output)
+
+
+def remove_results(results_path):
+    """
+    Removes the results of the previous run, the logs and metrics exports it wrote and the results file.
+    Other files in the directory, such as the logs of Mininet runs, are left alone.
+    :param results_path: the results file of the previous run
+    """
+    if not os.path.exists(results_path):
+        return
+    with open(results_path) as file:
+        summaries = json.load(file)
+    directory = os.path.dirname(results_path)
+    for summary in summaries:
+        for extension in (".log", ".bin", ".metrics"):
+            path = os.path.join(directory, summary["name"] + extension)
+            if os.path.exists(path):
+                os.remove(path)
+    os.remove(results_path)
+
+
+def summarize(config, reports, latency):
+    """
+    Combines the reports of the processes of one test.
+    :param config: the test configuration
+    :param reports: the reports of every process
+    :param latency: the Histogram of every message received, in microseconds
+    :return: dict with the configuration, throughput, latency percentiles in seconds and processes
+    """
+    subscribers = [report for report in reports if report["role"] == "subscriber"]
+    received = sum(report["received"] for report in subscribers)
+    expected = config["messages"] * config["publishers"] * config["subscribers"]
+    firsts = [report["first"] for report in subscribers if report["first"] is not None]
+    lasts = [report["last"] for report in subscribers if report["last"] is not None]
+    elapsed = max(lasts) - min(firsts) if firsts else 0
+
+    summary = dict(config)
+    summary.update({
+        "sent": sum(report["sent"] for report in reports if report["role"] == "publisher"),
+        "received": received,
+        "lost": expected - received,
+        "throughput": received / elapsed if elapsed > 0 else 0.0,
+        "latency": {name: latency.percentile(percentile) / 1000000 for name, percentile in PERCENTILES},
+        "processes": sorted(reports, key=lambda report: report["name"]),
+    })
+    summary["latency"]["max"] = latency.max / 1000000
+    return summary
+
+
+def print_summary(summary):
+    print(f"Received {summary['received']} of {summary['received'] + summary['lost']} messages, "
+          f"{summary['throughput']:.0f} msg/s")
+    print("Latency " + ", ".join(f"{name} {value * 1000:.3f} ms" for name, value in summary["latency"].items()))
+    for report in summary["processes"]:
+        print(f"  {report['name']:<8} cpu {report['cpu_seconds']:>7.2f} s  rss {report['max_rss_kb'] / 1024:>7.1f} MB")
+
+
+def main():
+    arg_parser = config_parser()
+    args = arg_parser.parse_args()
+
+    swept = {parameter for parameter, values in [("publishers", args.publishers), ("size", args.sizes),
+                                                 ("topics", args.topics)] if len(values) > 1}
+    results_path = os.path.join(output_dir, output_results)
+    summaries = []
+    if not args.keep:
+        remove_results(results_path)
+    elif os.path.exists(results_path):
+        with open(results_path) as file:
+            summaries = json.load(file)
+    os.makedirs(output_dir, exist_ok=True)
+
+    for num_subs in args.subscribers:
+        for broker_type in args.brokers:
+            for num_pubs in args.publishers:
+                for size in args.sizes:
+                    for num_topics in args.topics:
+                        config = {"subscribers": num_subs, "publishers": num_pubs, "size": size,
+                                  "topics": num_topics, "broker": broker_type, "messages": args.messages,
+                                  "rate": args.rate, "address": args.address, "port": args.port,
+                                  "delay": args.delay, "timeout": args.timeout, "binary": args.binary}
+                        print(banner.format(num_subs, num_pubs, size, num_topics, broker_type))
+
+                        run_dir = tempfile.mkdtemp(prefix="pubsub-scaling-")
+                        reports = run_iteration(config, run_dir)
+
+                        name = run_name(config, swept)
+                        log_extension = ".bin" if args.binary else ".log"
+                        concatenate(run_dir, log_extension, os.path.join(output_dir, name + log_extension))
+                        concatenate(run_dir, ".metrics", os.path.join(output_dir, f"{name}.metrics"))
+                        shutil.rmtree(run_dir, ignore_errors=True)
+
+                        latency = Histogram()
+                        for topic, histogram in read_exports(os.path.join(output_dir, f"{name}.metrics"))[0].items():
+                            if topic != EXIT_TOPIC:
+                                latency.merge(histogram)
+
+                        summary = summarize(config, reports, latency)
+                        summary["name"] = name
+                        print_summary(summary)
+                        summaries.append(summary)
+
+                        with open(results_path, "w") as file:
+                            json.dump(summaries, file, indent=2)
+
+    print(f"\nResults: {results_path}")
+
+
+if __name__ == '__main__':
+    main()
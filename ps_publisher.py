@@ -3,6 +3,10 @@ import sys
 from time import sleep
 
 from faker import Faker
+from pubsub.broker import BrokerType
+from pubsub.compression import Compression, TopicCompression
+from pubsub.flow import BLOCK, DROP, FlowControl
+from pubsub.logs import configure_logging
 from pubsub.publisher import Publisher
 
 
@@ -28,24 +32,45 @@ def config_parser() -> argparse.ArgumentParser:
                         help='topics to publish')
     parser.add_argument('--random', '-r', metavar='<number of messages>', type=int,
                         help='send random messages')
-    parser.add_argument('--delay', metavar='Delay', type=float, default=.5,
-                        help='amount of time to wait for connections before sending messages')
+    parser.add_argument('--delay', metavar='Delay', type=float,
+                        help='time to wait before sending messages, default .5 seconds, or 0 with --subscribers '
+                             'since connections are confirmed')
+    parser.add_argument('--subscribers', '-s', metavar='Subscribers', type=int, default=0,
+                        help='number of subscribers to wait for before sending messages, with a routing broker '
+                             'waits for the broker to subscribe')
+    parser.add_argument('--timeout', metavar='Timeout', type=float, default=10.0,
+                        help='most seconds to wait for subscribers')
+    parser.add_argument('--compress', metavar='Codec', type=str, choices=['zlib', 'lzma'],
+                        help='compress random messages with zlib or lzma')
+    parser.add_argument('--threshold', metavar='Threshold', type=int, default=64,
+                        help='size in bytes below which messages are not compressed')
+    parser.add_argument('--train', metavar='Samples', type=int, default=0,
+                        help='train a zlib dictionary from the first <samples> random messages')
+    parser.add_argument('--hwm', metavar='HWM', type=int,
+                        help='most messages queued per subscriber, more are dropped and counted')
+    parser.add_argument('--rate', metavar='Rate', type=float,
+                        help='most messages sent per second')
+    parser.add_argument('--burst', metavar='Burst', type=float,
+                        help='most messages sent at once over --rate, default one second of messages')
+    parser.add_argument('--block', action='store_true',
+                        help='wait for room and for the rate instead of dropping messages')
     return parser
 
 
-def register(address, broker_address, topics) -> Publisher:
+def register(address, broker_address, topics, compression=None, flow=None) -> Publisher:
     """
     Register a publisher based upon user arguments.
     :param address: Address to bind this publisher to
     :param broker_address: Address of broker to connect to
     :param topics: A list of topics to subscribe to
+    :param compression: Compression settings of the publisher, or None
+    :param flow: FlowControl settings of the publisher, or None
     :return: A Publisher object
     """
-    publisher = Publisher(address, broker_address)
+    publisher = Publisher(address, broker_address, compression=compression, flow=flow)
 
     if topics is not None:
-        for topic in topics:
-            publisher.register(topic)
+        publisher.register_many(topics)
 
     return publisher
 
@@ -67,16 +92,26 @@ def handle_cli(publisher):
             print("Please enter valid option")
 
 
-def handle_random(publisher, topics, num_messages):
+def handle_random(publisher, topics, num_messages, train=0):
     num_sent = 0
     topic = topics[0]
     while num_sent < num_messages:
         publisher.publish(topic, get_message())
         num_sent += 1
+        if num_sent == train:
+            publisher.train_dictionary(topic)
         if num_sent % 100 == 0:
             print(f"Sent {num_sent} messages")
 
     publisher.publish(EXIT_TOPIC, EXIT_MESSAGE)
+    if publisher.compression is not None:
+        for topic, counters in publisher.compression.statistics().items():
+            print(f"{topic}: compression ratio {counters['ratio']:.2f}, "
+                  f"{counters['seconds'] * 1e6 / max(counters['messages'], 1):.1f} us per message")
+    if publisher.flow is not None:
+        for topic, counters in publisher.flow.statistics().items():
+            print(f"{topic}: {counters['dropped']} dropped, {counters['throttled']} over the rate, "
+                  f"{counters['blocked']} waited")
 
 
 def get_message():
@@ -86,19 +121,41 @@ def get_message():
 def main():
     arg_parser = config_parser()
     args = arg_parser.parse_args()
+    configure_logging()
     address = args.address
     broker_address = args.broker_address
     topics = args.topics
+    # Without --subscribers nothing confirms that anybody is listening, so
+    # give subscribers the time to connect they always had
     delay = args.delay
+    if delay is None:
+        delay = 0 if args.subscribers else .5
 
     if args.random:
         topics.append(EXIT_TOPIC)
 
-    publisher = register(address, broker_address, topics)
+    compression = None
+    if args.compress or args.train:
+        compression = Compression(samples=args.train)
+        compression.configure(topics[0], TopicCompression(args.compress or 'zlib', args.threshold))
+
+    flow = None
+    if args.hwm is not None or args.rate or args.block:
+        flow = FlowControl(sndhwm=args.hwm, policy=BLOCK if args.block else DROP, rate=args.rate, burst=args.burst)
+
+    publisher = register(address, broker_address, topics, compression, flow)
+
+    # A routing broker is the only subscriber, and it subscribes once a
+    # subscriber is interested. Direct subscribers connect on their own, so
+    # wait until they have subscribed
+    if args.subscribers:
+        count = args.subscribers if publisher.broker_type == BrokerType.DIRECT else 1
+        if not publisher.wait_for_subscribers(count, args.timeout):
+            print(f"Timed out waiting for {count} subscribers")
 
     sleep(delay)
     if args.random:
-        handle_random(publisher, topics, args.random)
+        handle_random(publisher, topics, args.random, args.train)
     else:
         handle_cli(publisher)
 
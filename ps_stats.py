@@ -0,0 +1,97 @@
+import argparse
+import json
+import time
+
+import zmq
+
+from pubsub.stats import rates
+
+
+def config_parser() -> argparse.ArgumentParser:
+    """
+    Configures the arguments accepted by the argparse module.
+    :return: A (argparse.ArgumentParser)
+    """
+    parser = argparse.ArgumentParser(prog='Stats', usage='%(prog)s [options]',
+                                     description='Show live message rates of a broker started with --stats.')
+    parser.add_argument('stats_address', metavar='Stats Address', type=str,
+                        help='<transport>://<ip_address>:<port>')
+    parser.add_argument('--interval', '-i', metavar='Interval', type=float, default=1.0,
+                        help='seconds between updates')
+    parser.add_argument('--count', '-c', metavar='Count', type=int,
+                        help='number of updates to show, default runs until interrupted')
+    parser.add_argument('--timeout', metavar='Timeout', type=float, default=5.0,
+                        help='seconds to wait for the broker to answer')
+    return parser
+
+
+def request_snapshot(socket, timeout):
+    """
+    Requests the broker's counters.
+    :param socket: REQ socket connected to the broker's stats address
+    :param timeout: seconds to wait for a reply
+    :return: the snapshot dict, or None if the broker did not answer
+    """
+    socket.send(b"")
+    if not socket.poll(timeout * 1000):
+        return None
+    return json.loads(socket.recv().decode('utf-8'))
+
+
+def format_rates(previous, current):
+    """
+    Formats a table of per topic rates between two snapshots.
+    :param previous: the older snapshot
+    :param current: the newer snapshot
+    :return: A string
+    """
+    lines = [f"{current['broker']} up {current['uptime']:.0f}s, "
+             f"{current['registrations']['publishers']} publisher and "
+             f"{current['registrations']['subscribers']} subscriber registrations",
+             f"{'topic':<30} {'msg/s in':>10} {'msg/s out':>10} {'kB/s in':>10} {'drops/s':>10} "
+             f"{'hwm drops/s':>12} {'pubs':>5} {'subs':>5}"]
+
+    topic_rates = rates(previous, current)
+    for topic, counters in sorted(current["topics"].items()):
+        rate = topic_rates[topic]
+        lines.append(f"{topic[:30]:<30} {rate.get('messages_in', 0):>10.1f} {rate.get('messages_out', 0):>10.1f} "
+                     f"{rate.get('bytes_in', 0) / 1000:>10.1f} {rate.get('drops', 0):>10.1f} "
+                     f"{rate.get('hwm_drops', 0):>12.1f} {len(counters.get('publishers', [])):>5} "
+                     f"{len(counters.get('subscribers', [])):>5}")
+
+    if "proxy" in current:
+        elapsed = current["time"] - previous["time"]
+        forwarded = current["proxy"]["frontend_messages_in"] - previous["proxy"]["frontend_messages_in"]
+        lines.append(f"proxy forwarding {forwarded / elapsed:.1f} msg/s")
+
+    return "\n".join(lines)
+
+
+def main():
+    arg_parser = config_parser()
+    args = arg_parser.parse_args()
+
+    context = zmq.Context()
+    socket = context.socket(zmq.REQ)
+    socket.connect(args.stats_address)
+
+    previous = request_snapshot(socket, args.timeout)
+    shown = 0
+    while previous is not None and (args.count is None or shown < args.count):
+        time.sleep(args.interval)
+        current = request_snapshot(socket, args.timeout)
+        if current is None:
+            break
+        print(format_rates(previous, current))
+        print()
+        previous = current
+        shown += 1
+
+    if previous is None or (args.count is not None and shown < args.count):
+        print(f"No answer from {args.stats_address}")
+
+    context.destroy(linger=0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,10 @@
 import argparse
 import sys
-import threading
 
+from pubsub.dispatch import Dispatcher
+from pubsub.flow import FlowControl
+from pubsub.logs import PerfMode, configure_logging
+from pubsub.metrics import TopicMetrics
 from pubsub.subscriber import Subscriber
 this = sys.modules[__name__]
 this.subscriber = None
@@ -35,39 +38,59 @@ def config_parser() -> argparse.ArgumentParser:
     parser.add_argument('--topics', metavar='Topics', type=str, nargs='+', required=True,
                         help='topics to subscribe to')
     parser.add_argument('--start_listener', action='store_true',
-                        help='flag to start thread to listen for publisher registration')
+                        help='no longer needed, publisher registrations are handled by the receive loop. '
+                             'Kept so that existing scripts still run')
     parser.add_argument('--receive_exit', '-e', action='store_true',
                         help='flag indicating that this program will exit when publisher'
                              'indicates it has sent its final message')
+    parser.add_argument('--workers', metavar='Workers', type=int, default=0,
+                        help='number of threads running the callback, topics keep their order. '
+                             'Default runs the callback in the receiving thread')
+    parser.add_argument('--perf_ring', action='store_true',
+                        help='keep per message performance records in memory and write them to '
+                             'pubsub_perf.bin on exit instead of writing text to pubsub_perf.log')
+    parser.add_argument('--perf_binary', action='store_true',
+                        help='write every per message performance record to pubsub_perf.bin in binary '
+                             'instead of writing text to pubsub_perf.log, read by latency_analysis.py --stream')
+    parser.add_argument('--metrics', metavar='Metrics', type=str,
+                        help='file to append latency and size histograms to every 10 seconds and on exit, '
+                             'read by latency_analysis.py --metrics')
+    parser.add_argument('--hwm', metavar='HWM', type=int,
+                        help='most messages queued per publisher before they stop being read')
+    parser.add_argument('--buffer', metavar='Buffer', type=int,
+                        help='kernel receive buffer size in bytes')
     return parser
 
 
-def register(address, broker_address, topics) -> Subscriber:
+def register(address, broker_address, topics, dispatcher=None, metrics=None, flow=None) -> Subscriber:
     """
     Register a subscriber based upon user arguments.
     :param address: Address to bind this publisher to
     :param broker_address: Address of the broker to connect to
     :param topics: A list of topics to subscribe to
+    :param dispatcher: Dispatcher to run the callback on, or None
+    :param metrics: TopicMetrics to record received messages in, or None
+    :param flow: FlowControl settings of the subscriber, or None
     :return: A Subscriber object
     """
-    subscriber = Subscriber(address, broker_address)
+    subscriber = Subscriber(address, broker_address, dispatcher=dispatcher, metrics=metrics, flow=flow)
 
     if topics is not None:
-        for topic in topics:
-            subscriber.register(topic)
+        subscriber.register_many(topics)
 
     return subscriber
 
 
-def listen_for_registration(subscriber):
-    while True:
-        subscriber.wait_for_registration()
-
-
 def main():
     print("Intializing...")
     arg_parser = config_parser()
     args = arg_parser.parse_args()
+    if args.perf_ring:
+        configure_logging(perf_log_file='pubsub_perf.bin', perf_mode=PerfMode.RING)
+    elif args.perf_binary:
+        configure_logging(perf_log_file='pubsub_perf.bin', perf_mode=PerfMode.BINARY)
+    else:
+        configure_logging()
     address = args.address
     broker_address = args.broker_address
     topics = args.topics
@@ -75,15 +98,23 @@ def main():
     if args.receive_exit:
         topics.append(EXIT_TOPIC)
 
-    subscriber = register(address, broker_address, topics)
+    dispatcher = Dispatcher(args.workers) if args.workers else None
+    metrics = TopicMetrics(export_file=args.metrics) if args.metrics else None
+    flow = FlowControl(rcvhwm=args.hwm, rcvbuf=args.buffer)
+    subscriber = register(address, broker_address, topics, dispatcher, metrics, flow)
     subscriber.register_callback(exiting_callback)
 
-    if args.start_listener:
-        threading.Thread(target=listen_for_registration, args=[subscriber], daemon=True).start()
-
     print("Waiting for messages...")
+    # use a timeout so that the exit flag is seen even when it is set by a
+    # dispatcher worker after the last message has been received
     while not exit_received:
-        subscriber.wait_for_msg()
+        subscriber.run_once(timeout=.1)
+
+    if dispatcher is not None:
+        dispatcher.shutdown()
+        print(f"Dispatch statistics: {dispatcher.statistics()}")
+
+    subscriber.metrics.close()
 
     print("Exiting...")
 
@@ -1,6 +1,10 @@
-import threading
+import signal
 import pubsub.broker as br
+from pubsub.cache import LastValueCache
+from pubsub.flow import BLOCK, FlowControl
+from pubsub.logs import configure_logging
 import argparse as ap
+from pubsub.util import WireFormat
 
 
 def config_parser() -> ap.ArgumentParser:
@@ -16,41 +20,116 @@ def config_parser() -> ap.ArgumentParser:
                         help='IP address EX: 127.0.0.1')
     parser.add_argument('--port', metavar='Port', type=int, nargs='?',
                         help='Port number EX: 5556')
+    parser.add_argument('--proxy', action='store_true',
+                        help="forward messages inside libzmq (routing broker only)")
+    parser.add_argument('--shards', metavar='Shards', type=int, nargs='?',
+                        help='number of forwarding processes (routing broker only) EX: 4')
+    parser.add_argument('--legacy', action='store_true',
+                        help='only let clients use the legacy wire format (for older subscribers that '
+                             'register after publishers)')
+    parser.add_argument('--capture', metavar='Capture', type=str, nargs='?',
+                        help='address to publish a copy of forwarded messages on (requires --proxy) '
+                             'EX: tcp://127.0.0.1:5557')
+    parser.add_argument('--stats', metavar='Stats', type=str, nargs='?',
+                        help='address to serve broker counters on, read them with ps_stats.py '
+                             'EX: tcp://127.0.0.1:5558')
+    parser.add_argument('--cache', metavar='Cache', type=int, nargs='?',
+                        help='number of topics to keep the latest message of and send to new subscribers '
+                             '(routing broker only) EX: 10000')
+    parser.add_argument('--cache-bytes', metavar='CacheBytes', type=int, nargs='?',
+                        help='most bytes of messages kept with --cache EX: 67108864')
+    parser.add_argument('--hwm', metavar='HWM', type=int, nargs='?',
+                        help='most messages queued per connection, sending and receiving (routing and direct '
+                             'broker only) EX: 10000')
+    parser.add_argument('--buffer', metavar='Buffer', type=int, nargs='?',
+                        help='kernel send and receive buffer size in bytes EX: 4194304')
+    parser.add_argument('--block', metavar='Block', type=str, nargs='+',
+                        help='topic prefixes whose messages wait for a full subscriber instead of being dropped '
+                             '(routing broker only) EX: orders/')
+    parser.add_argument('--send-timeout', metavar='SendTimeout', type=float, nargs='?',
+                        help='most seconds a message of a --block topic waits before it is dropped EX: 1.0')
     return parser
 
 
-def msg_proc_loop(broker):
-    while True:
-        broker.process()
+def check_flow_arguments(parser, args):
+    """
+    Rejects the flow control arguments brokers that do not take them are given.
+    :param parser: the argument parser, exits with its usage on an error
+    :param args: the parsed arguments
+    """
+    flow_given = args.hwm is not None or args.buffer is not None or args.block or args.send_timeout is not None
+    if flow_given and args.type == "r" and (args.proxy or args.shards):
+        parser.error("--hwm, --buffer, --block and --send-timeout are not supported with --proxy or --shards")
+    if (args.block or args.send_timeout is not None) and args.type == "d":
+        parser.error("--block and --send-timeout are only supported by the routing broker")
+
+
+def flow_control(args):
+    """
+    Builds the flow control settings from the arguments.
+    :param args: the parsed arguments
+    :return: A FlowControl, or None if no flow control argument was given
+    """
+    if args.hwm is None and args.buffer is None and not args.block and args.send_timeout is None:
+        return None
+    flow = FlowControl(args.hwm, args.hwm, args.buffer, args.buffer, send_timeout=args.send_timeout)
+    for prefix in args.block or []:
+        flow.set_policy(prefix, BLOCK)
+    return flow
+
+
+def serve(broker):
+    """
+    Runs the broker until interrupted with Ctrl-C or SIGTERM.
+    :param broker: the broker to run
+    """
+    signal.signal(signal.SIGTERM, lambda signum, frame: broker.shutdown())
+    try:
+        broker.serve()
+    except KeyboardInterrupt:
+        pass
+
+
+def routing_broker(address, wire_format, stats_address, cache, flow):
+    broker = br.RoutingBroker(address, wire_format, stats_address, cache, flow)
+    serve(broker)
 
 
-def routing_broker(address):
-    broker = br.RoutingBroker(address)
-    process_msg_thread = threading.Thread(target=msg_proc_loop,
-                                          args=[broker],
-                                          daemon=True)
-    process_msg_thread.start()
+def proxy_broker(address, capture_address, wire_format, stats_address):
+    broker = br.ProxyRoutingBroker(address, capture_address, wire_format, stats_address)
+    serve(broker)
+    broker.stop()
 
-    while True:
-        broker.process_registration()
 
+def sharded_broker(address, num_shards, wire_format, stats_address):
+    broker = br.ShardedRoutingBroker(address, num_shards, wire_format, stats_address)
+    serve(broker)
 
-def direct_broker(address):
-    broker = br.DirectBroker(address)
 
-    while True:
-        broker.process_registration()
+def direct_broker(address, wire_format, stats_address, flow):
+    broker = br.DirectBroker(address, wire_format, stats_address, flow)
+    serve(broker)
 
 
 def main():
     endpoint = "tcp://{address}:{port}"
     arg_parser = config_parser()
     ps_args = arg_parser.parse_args()
+    check_flow_arguments(arg_parser, ps_args)
+    configure_logging()
     address = endpoint.format(address=ps_args.address, port=ps_args.port)
-    if ps_args.type == "r":
-        routing_broker(address)
+    wire_format = WireFormat.LEGACY if ps_args.legacy else WireFormat.COMPACT
+    if ps_args.type == "r" and ps_args.proxy:
+        proxy_broker(address, ps_args.capture, wire_format, ps_args.stats)
+    elif ps_args.type == "r" and ps_args.shards:
+        sharded_broker(address, ps_args.shards, wire_format, ps_args.stats)
+    elif ps_args.type == "r":
+        cache = None
+        if ps_args.cache:
+            cache = LastValueCache(ps_args.cache, ps_args.cache_bytes or 64 << 20)
+        routing_broker(address, wire_format, ps_args.stats, cache, flow_control(ps_args))
     elif ps_args.type == "d":
-        direct_broker(address)
+        direct_broker(address, wire_format, ps_args.stats, flow_control(ps_args))
     else:
         print("Invalid option")
 
@@ -2,20 +2,30 @@ import logging
 default_formatter = logging.Formatter('%(asctime)s %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s')
 perf_formatter = logging.Formatter('%(message)s')
 
+# No handlers are set up on import, so nothing is written and disabled log calls
+# cost a level check. Call pubsub.logs.configure_logging to write the log files.
+LOGGER = logging.getLogger('app_logger')
+PERF_LOGGER = logging.getLogger('message_logger')
 
-def setup_logger(name, log_file, formatter, level=logging.INFO):
-    handler = logging.FileHandler(log_file)
-    handler.setFormatter(formatter)
+# Performance records are data rather than diagnostics, keep them out of the
+# application's own handlers
+PERF_LOGGER.propagate = False
 
-    logger = logging.getLogger(name)
-    logger.setLevel(level)
-    logger.addHandler(handler)
+REG_PUB = "REGISTER_PUBLISHER"
+REG_SUB = "REGISTER_SUBSCRIBER"
 
-    return logger
+# Register several topics in one request, the topic frame holds a JSON list
+REG_PUB_MANY = "REGISTER_PUBLISHER_MANY"
+REG_SUB_MANY = "REGISTER_SUBSCRIBER_MANY"
 
+# Subscribers ask for the preset dictionaries of a topic, without registering
+# it, when they receive a message compressed with one they do not have
+LOOKUP_DICTIONARIES = "LOOKUP_DICTIONARIES"
 
-LOGGER = setup_logger('app_logger', 'pubsub.log', default_formatter)
-PERF_LOGGER = setup_logger('message_logger', 'pubsub_perf.log', perf_formatter)
+# Sent by brokers instead of their type in the reply to a registration they
+# could not process, followed by a frame describing the problem
+REG_ERROR = "ERROR"
 
-REG_PUB = "REGISTER_PUBLISHER"
-REG_SUB = "REGISTER_SUBSCRIBER"
+# Subscribers that want their connection confirmed subscribe to this prefix
+# followed by a token of their own, see AbstractBroker.reply_when_ready
+READY_PREFIX = b"\x00READY "
@@ -0,0 +1,437 @@
+import asyncio
+import itertools
+import time
+from collections import defaultdict, deque
+import zmq
+import zmq.asyncio
+from zmq.utils.monitor import parse_monitor_message
+import pubsub
+from pubsub import LOGGER
+from pubsub.broker import BrokerType
+from pubsub.compression import Compression, PayloadTooLargeError, UnknownDictionaryError
+from pubsub.logs import log_perf, message_size, perf_enabled
+from pubsub.metrics import TopicMetrics
+from pubsub.patterns import is_pattern
+from pubsub.util import MessageType, TopicNotRegisteredError, WireFormat, decode_payload, get_codec, pack_batch, \
+    pack_envelope, pack_options, pack_topics, split_reply, unpack_envelope
+
+
+class AsyncPublisher:
+    """ asyncio publisher for publishing messages
+
+    Same registration protocol and wire formats as `pubsub.publisher.Publisher`,
+    but every method that talks to the broker or sends a message is a coroutine,
+    so many publishers can share one event loop.
+
+    Sample usage:
+    publisher = AsyncPublisher("tcp://127.0.0.1:5556", "tcp://127.0.0.1:5555")
+    await publisher.register("topic1")
+    await publisher.publish("topic1", "message goes here")
+    """
+    ctx = zmq.asyncio.Context()
+
+    def __init__(self, address, registration_address, wire_format=WireFormat.COMPACT, ready_timeout=5.0):
+        """ Creates an asyncio publisher instance
+
+        :param str address: the address of this publisher. String with format <scheme>://<ip_addr>:<port>
+        :param str registration_address: address of the broker with which this publisher
+            registers topics. String with format <scheme>://<ip_addr>:<port>
+        :param int wire_format: the newest wire format this publisher offers the broker at registration.
+            Optional. Default = WireFormat.COMPACT
+        :param float ready_timeout: the most seconds `register` waits for a routing broker to
+            subscribe to this publisher. Optional. Default = 5 seconds
+        """
+        self.address = address
+        self.topics = []
+        self.ready_timeout = ready_timeout
+        self.broker_type = None
+
+        # See Publisher for why this is a verbose XPUB
+        self.message_pub = self.ctx.socket(zmq.XPUB)
+        self.message_pub.setsockopt(zmq.XPUB_VERBOSE, 1)
+        self.message_pub.bind(address)
+        self.subscriptions = defaultdict(int)
+
+        self.registration = self.ctx.socket(zmq.REQ)
+        self.registration.connect(registration_address)
+
+        self.wire_formats = list(range(WireFormat.LEGACY, wire_format + 1))
+        self.wire_format = WireFormat.LEGACY
+
+        LOGGER.info("Bound to %s. Registering with broker at %s.", address, registration_address)
+
+    async def register(self, topic):
+        """ Register a topic and address with the broker
+
+        :param str topic: a string topic
+        """
+        LOGGER.info("Publisher registering for topic %s at address %s", topic, self.address)
+        await self.send_registration(pubsub.REG_PUB, topic.encode('utf-8'), [topic])
+
+    async def register_many(self, topics):
+        """ Registers several topics with the broker in one round trip
+
+        :param list topics: the string topics
+        """
+        if not topics:
+            return
+
+        LOGGER.info("Publisher registering for %s topics at address %s", len(topics), self.address)
+        await self.send_registration(pubsub.REG_PUB_MANY, pack_topics(topics), topics)
+
+    async def send_registration(self, reg_type, topic_frame, topics):
+        """ Sends a registration and handles the reply
+
+        :param str reg_type: REGISTER_PUBLISHER or REGISTER_PUBLISHER_MANY
+        :param bytes topic_frame: the topic frame of the request
+        :param list topics: the string topics being registered
+        """
+        self.topics.extend(topics)
+
+        await self.registration.send_multipart([reg_type.encode('utf-8'),
+                                                topic_frame,
+                                                self.address.encode('utf-8'),
+                                                pack_options({"wire_formats": self.wire_formats})])
+
+        broker_type, options, _ = split_reply(await self.registration.recv_multipart())
+        self.broker_type = broker_type
+        self.wire_format = options.get("wire_format", WireFormat.LEGACY)
+
+        subscribed = topics if options.get("subscribes") else options.get("subscribed", [])
+        if subscribed and not await self.wait_for_subscribers(1, self.ready_timeout, subscribed):
+            LOGGER.warning("Broker did not subscribe to topics %s within %s seconds", subscribed, self.ready_timeout)
+
+        LOGGER.info("Connected to %s broker using wire format %s", broker_type, self.wire_format)
+
+    def read_subscriptions(self):
+        """ Reads the subscription events that have arrived without blocking """
+        while True:
+            try:
+                event = self.message_pub.recv(zmq.NOBLOCK).result()
+            except zmq.Again:
+                return
+            if event[:1] == b'\x01':
+                self.subscriptions[event[1:]] += 1
+            else:
+                self.subscriptions.pop(event[1:], None)
+
+    def count_subscribers(self, topic):
+        """ Returns the number of subscriptions that match a topic
+
+        :param str topic: a string topic
+        :return: int count, from the events read so far
+        """
+        encoded = topic.encode('utf-8')
+        return sum(count for prefix, count in self.subscriptions.items() if encoded.startswith(prefix))
+
+    async def wait_for_subscribers(self, count=1, timeout=None, topics=None):
+        """ Waits until enough subscribers have subscribed to every topic
+
+        :param int count: the number of subscriptions to wait for. Optional. Default = 1
+        :param float timeout: the most seconds to wait. Optional. Default = None, no limit
+        :param list topics: the topics to wait for. Optional. Default = every registered topic
+        :return: True if every topic has enough subscriptions, False if the timeout passed first
+        """
+        topics = self.topics if topics is None else topics
+        deadline = None if timeout is None else time.time() + timeout
+        self.read_subscriptions()
+        while any(self.count_subscribers(topic) < count for topic in topics):
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                return False
+            if await self.message_pub.poll(None if remaining is None else remaining * 1000):
+                self.read_subscriptions()
+        return True
+
+    async def publish(self, topic, message, message_type=MessageType.STRING):
+        """ Publishes message with the given topic
+
+        :param str topic: the topic of the message to publish, should be a registered string
+        :param message: the message to publish
+        :param str message_type: the type of the message to send. Optional. Default = MessageType.STRING
+        """
+        if topic not in self.topics:
+            raise TopicNotRegisteredError(topic, self.address, "Topic has not been registered with publisher. Cannot "
+                                                               "be published")
+
+        payload = get_codec(message_type).encode_frames(message)
+        await self.message_pub.send_multipart(pack_envelope(topic, message_type, time.time(), payload,
+                                                            self.wire_format), copy=False)
+
+    async def publish_batch(self, topic, messages, message_type=MessageType.STRING):
+        """ Publishes several messages with the given topic as one batch
+
+        :param str topic: the topic of the messages to publish, should be a registered string
+        :param list messages: the messages to publish
+        :param str message_type: the type of every message in the batch. Optional.
+            Default = MessageType.STRING
+
+        An empty list of messages sends nothing.
+        """
+        if topic not in self.topics:
+            raise TopicNotRegisteredError(topic, self.address, "Topic has not been registered with publisher. Cannot "
+                                                               "be published")
+        if not messages:
+            return
+
+        time_sent = time.time()
+        payload = [pack_batch([(time_sent, message) for message in messages], message_type)]
+        await self.message_pub.send_multipart(pack_envelope(topic, message_type, time_sent, payload,
+                                                            self.wire_format, batch=True))
+
+    def close(self):
+        """ Closes the sockets """
+        self.message_pub.close(linger=0)
+        self.registration.close(linger=0)
+
+
+class AsyncSubscriber:
+    """ asyncio subscriber for subscribing to messages
+
+    Same registration protocol as `pubsub.subscriber.Subscriber`. Instead of
+    a callback, messages are consumed by iterating over the subscriber:
+
+    subscriber = AsyncSubscriber("tcp://127.0.0.1:5557", "tcp://127.0.0.1:5555")
+    await subscriber.register("topic1")
+    async for topic, message in subscriber:
+        ...
+
+    With a direct broker, new publishers are discovered by a background task
+    that is started on the first registration and stopped by `close`.
+    """
+    ctx = zmq.asyncio.Context()
+
+    def __init__(self, address, registration_address, conn_sec=.5, metrics=None, ready_timeout=5.0,
+                 compression=None):
+        """Creates an asyncio subscriber instance
+
+        :param str address: the address of this subscriber. String with
+            format <scheme>://<ip_addr>:<port>
+        :param str registration_address: address of the broker with which this publisher
+            registers topics. String with format <scheme>://<ip_addr>:<port>
+        :param float conn_sec: the number of seconds it takes this subscriber to
+            connect to a publisher when using a direct broker that cannot confirm
+            connections. Optional. Default is .5 seconds
+        :param TopicMetrics metrics: the latency and size histograms to record received
+            messages in. Optional. Default is histograms that are not exported
+        :param float ready_timeout: the most seconds `register` waits for connections
+            to publishers to be made. Optional. Default is 5 seconds
+        :param Compression compression: decompresses payloads and counts the savings.
+            Optional. Default is a Compression that only decompresses
+        """
+        self.conn_sec = conn_sec
+        self.ready_timeout = ready_timeout
+        self.address = address
+        self.topics = []
+        self.metrics = metrics if metrics is not None else TopicMetrics()
+
+        # Only the preset dictionaries sent with registration replies are
+        # known, messages compressed with others are dropped
+        self.compression = compression if compression is not None else Compression()
+
+        # See Subscriber for how these two sockets are used with each broker type
+        self.message_sub = self.ctx.socket(zmq.SUB)
+        self.publisher_sub = self.ctx.socket(zmq.SUB)
+        self.publisher_sub.bind(self.address)
+        self.message_sub_bound = False
+        self.publisher_sub_ready = False
+
+        self.ready_tokens = itertools.count()
+        self.monitor = None
+        self.publishers = set()
+
+        self.registration = self.ctx.socket(zmq.REQ)
+        self.registration.connect(registration_address)
+
+        self.wire_formats = [WireFormat.LEGACY, WireFormat.COMPACT]
+
+        # messages received in a batch that have not been consumed yet
+        self.pending = deque()
+        self.registration_task = None
+
+        LOGGER.info("Bound to %s. Registering with broker at %s.", address, registration_address)
+
+    async def register(self, topic):
+        """ Registers a topic and address with the broker
+
+        Unlike `Subscriber`, wildcard patterns are not supported.
+
+        :param str topic: A string topic
+        :raises ValueError: if the topic is a wildcard pattern
+        """
+        LOGGER.info("Subscriber registering to topic %s at address %s", topic, self.address)
+        await self.send_registration(pubsub.REG_SUB, topic.encode('utf-8'), [topic])
+
+    async def register_many(self, topics):
+        """ Registers several topics with the broker in one round trip
+
+        :param list topics: the string topics
+        :raises ValueError: if any topic is a wildcard pattern
+        """
+        if not topics:
+            return
+
+        LOGGER.info("Subscriber registering to %s topics at address %s", len(topics), self.address)
+        await self.send_registration(pubsub.REG_SUB_MANY, pack_topics(topics), topics)
+
+    async def send_registration(self, reg_type, topic_frame, topics):
+        """ Subscribes to topics, sends a registration and handles the reply
+
+        :param str reg_type: REGISTER_SUBSCRIBER or REGISTER_SUBSCRIBER_MANY
+        :param bytes topic_frame: the topic frame of the request
+        :param list topics: the string topics being registered
+        """
+        # Subscribed as is, a pattern would only match topics equal to it
+        patterns = [topic for topic in topics if is_pattern(topic)]
+        if patterns:
+            raise ValueError(f"AsyncSubscriber does not support wildcard patterns {patterns}")
+        self.topics.extend(topics)
+
+        for topic in topics:
+            self.message_sub.setsockopt_string(zmq.SUBSCRIBE, topic)
+            self.publisher_sub.setsockopt_string(zmq.SUBSCRIBE, topic)
+
+        # See Subscriber.register for the ready token
+        ready = f"{self.address} {next(self.ready_tokens)}"
+        token = pubsub.READY_PREFIX + ready.encode('utf-8')
+        bound_sub = self.message_sub if self.message_sub_bound else self.publisher_sub
+        bound_sub.setsockopt(zmq.SUBSCRIBE, token)
+
+        await self.registration.send_multipart([reg_type.encode('utf-8'),
+                                                topic_frame,
+                                                self.address.encode('utf-8'),
+                                                pack_options({"wire_formats": self.wire_formats, "ready": ready,
+                                                              "dictionaries": True})])
+
+        broker_type, options, frames = split_reply(await self.recv_reply(bound_sub))
+        bound_sub.setsockopt(zmq.UNSUBSCRIBE, token)
+        self.compression.add_dictionaries(options.get("dictionaries", {}))
+
+        if broker_type == BrokerType.ROUTE:
+            if not self.message_sub_bound:
+                self.message_sub, self.publisher_sub = self.publisher_sub, self.message_sub
+                self.message_sub_bound = True
+        elif broker_type == BrokerType.DIRECT:
+            if not self.publisher_sub_ready:
+                if not options.get("ready"):
+                    await asyncio.sleep(self.conn_sec)
+                self.publisher_sub_ready = True
+                self.registration_task = asyncio.ensure_future(self.watch_registrations())
+
+            if frames[0] == b'\x01':
+                await self.connect_and_wait([address.decode('utf-8') for address in frames[1:]])
+
+        LOGGER.info("Connected to %s broker", broker_type)
+
+    async def recv_reply(self, bound_sub):
+        """ Receives the reply to a registration
+
+        The bound socket's events are read every few milliseconds until the
+        reply arrives, so that the broker's connection to it is attached. A
+        bound socket only attaches incoming connections when it is used.
+
+        :param bound_sub: the socket bound to this subscriber's address
+        :return: the frames of the reply
+        """
+        reply = asyncio.ensure_future(self.registration.recv_multipart())
+        while not reply.done():
+            bound_sub.getsockopt(zmq.EVENTS)
+            await asyncio.wait([reply], timeout=.005)
+        return reply.result()
+
+    async def connect_and_wait(self, addresses):
+        """ Connects to publishers and waits until the connections are made
+
+        :param list addresses: the addresses of the publishers
+        :return: True if every connection was made, False if the timeout passed first
+        """
+        if self.monitor is None:
+            self.monitor = self.message_sub.get_monitor_socket(zmq.EVENT_HANDSHAKE_SUCCEEDED)
+
+        pending = set(addresses) - self.publishers
+        for address in pending:
+            self.message_sub.connect(address)
+            self.publishers.add(address)
+
+        deadline = time.time() + self.ready_timeout
+        while pending:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not await self.monitor.poll(remaining * 1000):
+                LOGGER.warning("Timed out connecting to publishers %s", sorted(pending))
+                return False
+            event = parse_monitor_message(await self.monitor.recv_multipart())
+            pending.discard(event["endpoint"].decode('utf-8'))
+
+        return True
+
+    def unregister(self, topic):
+        """ Unregisters a topic
+
+        :param str topic: a string topic that has been registered
+        """
+        if topic not in self.topics:
+            raise TopicNotRegisteredError(topic, self.address, "Topic has not been registered with subscriber. Cannot "
+                                                               "unregister.")
+
+        self.topics.remove(topic)
+        self.message_sub.setsockopt_string(zmq.UNSUBSCRIBE, topic)
+        self.publisher_sub.setsockopt_string(zmq.UNSUBSCRIBE, topic)
+
+    async def watch_registrations(self):
+        """ Connects to new publishers announced by a direct broker until cancelled """
+        while True:
+            message = await self.publisher_sub.recv_multipart()
+            address = message[1].decode('utf-8')
+            if address not in self.publishers:
+                self.message_sub.connect(address)
+                self.publishers.add(address)
+
+    async def recv(self):
+        """ Waits for the next message
+
+        Messages received in a batch are returned one at a time, in order.
+
+        :return: tuple of the topic and the message
+        """
+        while not self.pending:
+            frames = await self.message_sub.recv_multipart(copy=False)
+            try:
+                topic, time_sent, message_type, batch, payload = unpack_envelope(frames, self.compression.decompress)
+            except (UnknownDictionaryError, PayloadTooLargeError) as error:
+                LOGGER.warning("Dropping message: %s", error)
+                continue
+            time_recv = time.time()
+            messages = decode_payload(time_sent, message_type, batch, payload)
+            if not messages:
+                # an empty batch, which current publishers do not send
+                continue
+            size = sum(len(frame) for frame in frames[len(frames) - len(payload):]) // len(messages)
+            perf = perf_enabled()
+            for time_sent, message in messages:
+                if perf:
+                    log_perf(time_recv - time_sent, time_recv, len(topic), message_size(message))
+                self.metrics.record(topic, time_recv - time_sent, size, time_recv)
+                self.pending.append((topic, message))
+
+        return self.pending.popleft()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.recv()
+
+    def close(self):
+        """ Stops discovering publishers and closes the sockets """
+        if self.registration_task is not None:
+            self.registration_task.cancel()
+            self.registration_task = None
+
+        if self.monitor is not None:
+            self.message_sub.disable_monitor()
+            self.monitor.close(linger=0)
+            self.monitor = None
+
+        self.message_sub.close(linger=0)
+        self.publisher_sub.close(linger=0)
+        self.registration.close(linger=0)
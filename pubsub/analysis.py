@@ -0,0 +1,170 @@
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from pubsub.logs import PERF_RECORD, read_perf_records
+from pubsub.metrics import Histogram
+
+# Bytes of a performance log parsed by one task
+CHUNK_SIZE = 1 << 24
+
+# Extension of binary performance logs, written in PerfMode.RING or PerfMode.BINARY
+BINARY_EXTENSION = ".bin"
+
+
+class PerfSummary:
+    """ Latency histogram and per window message counts of a performance log
+
+    Built one record at a time, so memory does not grow with the number of
+    records: the histogram has a fixed size and two counters are kept per
+    window, so it grows with the duration of the log, by about 200 bytes per
+    window. Windows are numbered from the epoch, so summaries of
+    different chunks of a log, or of different logs, are merged by adding
+    their histograms and window counts.
+    """
+
+    def __init__(self, window=1.0, precision_bits=8):
+        """ Creates an empty summary
+
+        :param float window: seconds per throughput window. Optional. Default = 1
+        :param int precision_bits: number of significant bits kept per latency. Optional. Default = 8
+        """
+        self.window = window
+        self.latency = Histogram(precision_bits)
+        self.messages = defaultdict(int)
+        self.bytes = defaultdict(int)
+
+    def record(self, delta_time, time_recv, topic_size, message_size):
+        """ Records one line or record of a performance log
+
+        :param float delta_time: seconds between the message being sent and received
+        :param float time_recv: time the message was received
+        :param int topic_size: length of the topic
+        :param int message_size: length of the message
+        """
+        self.latency.record(int(delta_time * 1000000))
+        index = int(time_recv // self.window)
+        self.messages[index] += 1
+        self.bytes[index] += message_size
+
+    def merge(self, other):
+        """ Adds another summary to this one
+
+        :param PerfSummary other: a summary with the same window and precision
+        """
+        if other.window != self.window:
+            raise ValueError(f"Cannot merge summaries with windows of {other.window} and {self.window} seconds")
+        self.latency.merge(other.latency)
+        for index, count in other.messages.items():
+            self.messages[index] += count
+        for index, size in other.bytes.items():
+            self.bytes[index] += size
+
+    def throughput(self):
+        """ Returns the throughput of every window from the first to the last message
+
+        :return: list of (seconds since the first window, messages per second, bytes per second)
+            tuples, windows without messages included
+        """
+        if not self.messages:
+            return []
+        first = min(self.messages)
+        return [((index - first) * self.window, self.messages.get(index, 0) / self.window,
+                 self.bytes.get(index, 0) / self.window)
+                for index in range(first, max(self.messages) + 1)]
+
+    def cdf(self):
+        """ Returns the cumulative distribution of latency
+
+        :return: list of (latency in seconds, fraction of messages at or below it) tuples,
+            one per histogram bucket with messages
+        """
+        points = []
+        seen = 0
+        for index, count in enumerate(self.latency.counts):
+            if count:
+                seen += count
+                value = min(self.latency.highest_equivalent(index), self.latency.max)
+                points.append((value / 1000000, seen / self.latency.count))
+        return points
+
+
+def split(path, chunk_size=CHUNK_SIZE):
+    """ Splits a performance log into byte ranges to summarize separately
+
+    :param str path: a text or binary performance log
+    :param int chunk_size: the approximate number of bytes per range. Optional. Default = 16 MiB
+    :return: list of (path, start, end) tuples
+    """
+    size = os.path.getsize(path)
+    if path.endswith(BINARY_EXTENSION):
+        # binary ranges hold whole records
+        chunk_size = max(PERF_RECORD.size, chunk_size - chunk_size % PERF_RECORD.size)
+    return [(path, start, min(start + chunk_size, size)) for start in range(0, size, chunk_size)]
+
+
+def read_text_lines(path, start, end):
+    """ Reads the lines of a text log that start in a byte range
+
+    :param str path: the file to read
+    :param int start: the offset of the first byte of the range
+    :param int end: the offset after the last byte of the range
+    :return: list of bytes lines
+    """
+    with open(path, 'rb') as file:
+        if start > 0:
+            # the line running over start belongs to the previous range
+            file.seek(start - 1)
+            file.readline()
+        position = file.tell()
+        if position >= end:
+            return []
+        data = file.read(end - position)
+        if not data.endswith(b"\n"):
+            data += file.readline()
+    return data.splitlines()
+
+
+def summarize_chunk(path, start, end, window=1.0, precision_bits=8):
+    """ Summarizes a byte range of a performance log
+
+    :param str path: a text log, lines of "<delta>, <time received>, <topic size>, <message size>",
+        or a binary log if the name ends in .bin
+    :param int start: the offset of the first byte of the range
+    :param int end: the offset after the last byte of the range
+    :param float window: seconds per throughput window. Optional. Default = 1
+    :param int precision_bits: number of significant bits kept per latency. Optional. Default = 8
+    :return: PerfSummary
+    """
+    summary = PerfSummary(window, precision_bits)
+    if path.endswith(BINARY_EXTENSION):
+        for record in read_perf_records(path, start, end):
+            summary.record(*record)
+        return summary
+
+    for line in read_text_lines(path, start, end):
+        fields = line.split(b",")
+        if len(fields) != 4:
+            continue
+        summary.record(float(fields[0]), float(fields[1]), int(fields[2]), int(fields[3]))
+    return summary
+
+
+def summarize_files(groups, window=1.0, workers=None, chunk_size=CHUNK_SIZE, precision_bits=8):
+    """ Summarizes performance logs in chunks on a pool of processes
+
+    :param dict groups: dict of name to the list of log files to summarize together
+    :param float window: seconds per throughput window. Optional. Default = 1
+    :param int workers: the number of processes. Optional. Default = the number of CPUs
+    :param int chunk_size: the approximate number of bytes per task. Optional. Default = 16 MiB
+    :param int precision_bits: number of significant bits kept per latency. Optional. Default = 8
+    :return: dict of name to PerfSummary
+    """
+    summaries = {name: PerfSummary(window, precision_bits) for name in groups}
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [(name, pool.submit(summarize_chunk, path, start, end, window, precision_bits))
+                   for name, paths in groups.items()
+                   for file in paths
+                   for path, start, end in split(file, chunk_size)]
+        for name, future in futures:
+            summaries[name].merge(future.result())
+    return summaries
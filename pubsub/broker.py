@@ -1,8 +1,25 @@
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import struct
+import threading
+import time
 from abc import abstractmethod, ABC
-from collections import defaultdict
 import zmq
 import pubsub
 from pubsub import LOGGER
+from pubsub.patterns import TAG_START, PatternIndex, is_pattern, literal_prefix, matches, tag
+from pubsub.stats import BYTES_IN, BYTES_OUT, DROPS, HWM_DROPS, MESSAGES_IN, MESSAGES_OUT, BrokerStats, encode_snapshot
+from pubsub.trie import TopicTrie
+from pubsub.util import WireFormat, choose_wire_format, pack_options, shard_for_topic, unpack_topics
+
+
+# Seconds a routing broker waits to forward a message of a BLOCK topic when
+# its flow control sets no send timeout, so a stuck subscriber cannot stall it
+SEND_TIMEOUT = 1.0
 
 
 class BrokerType:
@@ -10,6 +27,37 @@ class BrokerType:
     ROUTE = "ROUTE"
 
 
+registration_types = (pubsub.REG_PUB, pubsub.REG_SUB, pubsub.REG_PUB_MANY, pubsub.REG_SUB_MANY,
+                      pubsub.LOOKUP_DICTIONARIES)
+
+
+def parse_registration(message):
+    """ Decodes the parts of a registration after its envelope
+
+    :param list message: the registration type, topic, address and optional options frames
+    :return: tuple of the registration type, the list of string topics, the address
+        and the options dict, None if the client sent none
+    :raises ValueError: if the message is malformed
+    """
+    if len(message) < 3:
+        raise ValueError(f"expected at least 3 frames, got {len(message)}")
+    reg_type = message[0].decode('utf-8')
+    if reg_type in (pubsub.REG_PUB_MANY, pubsub.REG_SUB_MANY):
+        topics = unpack_topics(message[1])
+        if not isinstance(topics, list) or not all(isinstance(topic, str) for topic in topics):
+            raise ValueError("the topic frame is not a list of topics")
+    else:
+        topics = [message[1].decode('utf-8')]
+    address = message[2].decode('utf-8')
+
+    options = None
+    if len(message) > 3:
+        options = json.loads(message[3].decode('utf-8'))
+        if not isinstance(options, dict):
+            raise ValueError("the options frame is not a JSON object")
+    return reg_type, topics, address, options
+
+
 class AbstractBroker(ABC):
     """ Broker for abstracting pub/sub address
 
@@ -19,13 +67,58 @@ class AbstractBroker(ABC):
     """
     context = zmq.Context()
 
-    def __init__(self, registration_address):
-        self.registration = self.context.socket(zmq.REP)
+    # Sent first in every registration reply
+    broker_type = None
+
+    def __init__(self, registration_address, wire_format=WireFormat.COMPACT, stats_address=None):
+        # A ROUTER rather than a REP so that a registration waiting for its
+        # subscriber to be ready does not hold up the ones behind it. Replies
+        # are routed back by the envelope of their request, see process_registration
+        self.registration = self.context.socket(zmq.ROUTER)
 
         self.connect_address = registration_address
         self.registration.bind(registration_address)
 
-    def process_registration(self):
+        # The newest wire format clients are allowed to use. The format is
+        # negotiated per client below it, see negotiate_wire_format; set it to
+        # WireFormat.LEGACY to keep every client on the legacy format.
+        self.wire_format = wire_format
+
+        # Topics registered by subscribers that sent no options, which predate
+        # the compact format and only decode the legacy one
+        self.legacy_topics = set()
+
+        # The envelope of the registration being processed, the frames up to and
+        # including the empty delimiter, and the options to include in its
+        # reply, None if the client did not send any, and the options it sent
+        self.envelope = []
+        self.reply_options = None
+        self.request_options = {}
+
+        # The preset dictionaries publishers registered, topic to base64
+        # encoded dictionary, passed on to subscribers to the topics
+        self.dictionaries = {}
+
+        # Set by serve and cleared by shutdown
+        self.serving = False
+
+        # The ready token of the subscriber registration being processed, if it
+        # asked for its connection to be confirmed, the tokens seen on the
+        # sending socket and the replies waiting for a token. See reply_when_ready
+        self.ready_token = None
+        self.ready_tokens = set()
+        self.ready_timeout = 2.0
+        self.pending_replies = {}
+
+        # Counters, served by serve on a REP socket bound to stats_address if
+        # one is given. Any request is answered with a JSON snapshot
+        self.stats = BrokerStats()
+        self.stats_socket = None
+        if stats_address is not None:
+            self.stats_socket = self.context.socket(zmq.REP)
+            self.stats_socket.bind(stats_address)
+
+    def process_registration(self, flags=0):
         """ Process registration messages
 
         Blocks until a registration message is received. Once received, performs
@@ -36,28 +129,328 @@ class AbstractBroker(ABC):
         - registration type: string with value REGISTER_PUB or REGISTER_SUB
         - a topic that it wants to send or receive
         - an address to receive publications from or send publications to
+
+        The parts are preceded by the envelope of the request: the identity
+        the ROUTER socket adds, any request ID a DEALER client adds, and an
+        empty delimiter, which REQ clients add on their own. The reply is sent
+        with the same envelope.
+
+        Newer clients add a fourth part holding JSON options, such as the wire
+        formats they support. When it is present, the reply carries a JSON
+        options frame after the broker type with the wire format to use, see
+        `negotiate_wire_format`. Clients without it use the legacy format.
+
+        With registration type REGISTER_PUBLISHER_MANY or REGISTER_SUBSCRIBER_MANY
+        the topic part is a JSON list of topics, which are all registered with
+        a single reply.
+
+        Publishers may send the preset dictionaries of their topics in the
+        "dictionaries" option, see pubsub.compression. Subscribers that set the
+        option get those of the topics they register in the reply, and with
+        type LOOKUP_DICTIONARIES get them without registering anything.
+
+        A registration that is malformed, of an unknown type or that the broker
+        fails to process is answered with REG_ERROR and a description instead of
+        the broker type, and the broker carries on.
+
+        :param int flags: flags passed to the socket, zmq.NOBLOCK to raise
+            zmq.Again instead of blocking. Optional. Default = 0
         """
-        message = self.registration.recv_multipart()
+        message = self.registration.recv_multipart(flags)
+        if b"" not in message:
+            LOGGER.warning("Dropping registration message without an envelope: %s", message)
+            return
+        delimiter = message.index(b"") + 1
+        self.envelope, message = message[:delimiter], message[delimiter:]
+
+        self.reply_options = None
+        self.request_options = {}
+        self.ready_token = None
+        try:
+            reg_type, topics, address, options = parse_registration(message)
+        except ValueError as error:
+            LOGGER.warning("Rejecting malformed registration %s: %s", message, error)
+            self.send_error(f"Malformed registration: {error}")
+            return
+        if reg_type not in registration_types:
+            LOGGER.warning("Received registration message with unknown type: %s", reg_type)
+            self.send_error(f"Unknown registration type {reg_type}")
+            return
+        if reg_type == pubsub.LOOKUP_DICTIONARIES and options is None:
+            LOGGER.warning("Received %s without options", reg_type)
+            self.send_error(f"{reg_type} needs an options frame")
+            return
+
+        LOGGER.info("Broker processing %s to topics %s at address %s", reg_type, topics, address)
+
+        # A registration the broker fails on, for example because of an address
+        # it cannot connect to or an option of the wrong type, is answered with
+        # an error rather than stopping serve
+        try:
+            self.handle_registration(reg_type, topics, address, options)
+        except Exception as error:
+            LOGGER.exception("Failed to process %s for address %s", reg_type, address)
+            self.send_error(f"Failed to process the registration: {error!r}")
 
-        reg_type = message[0].decode('utf-8')
-        topic = message[1].decode('utf-8')
-        address = message[2].decode('utf-8')
+    def handle_registration(self, reg_type, topics, address, options):
+        """ Processes a parsed registration by its type
 
-        LOGGER.info(f"Broker processing {reg_type} to topic \"{topic}\" at address {address}")
+        :param str reg_type: the registration type
+        :param list topics: the string topics
+        :param str address: the address of the client
+        :param dict options: the options the client sent, None if it sent none
+        """
+        if options is not None:
+            self.request_options = options
+            self.reply_options = {"wire_format": self.negotiate_wire_format(reg_type, topics, options)}
+            # Confirming a connection means polling the sending socket, which
+            # only the thread running serve may do
+            if "ready" in options and self.serving:
+                self.ready_token = pubsub.READY_PREFIX + options["ready"].encode('utf-8')
 
-        if reg_type == pubsub.REG_PUB:
-            self.process_pub_registration(topic, address)
-        elif reg_type == pubsub.REG_SUB:
-            self.process_sub_registration(topic, address)
+        if reg_type in (pubsub.REG_PUB, pubsub.REG_PUB_MANY):
+            self.dictionaries.update(self.request_options.get("dictionaries", {}))
+            for topic in topics:
+                self.stats.register(pubsub.REG_PUB, topic, address)
+            self.process_pub_registrations(topics, address)
+        elif reg_type in (pubsub.REG_SUB, pubsub.REG_SUB_MANY):
+            if self.reply_options is None:
+                self.legacy_topics.update(topics)
+            if self.request_options.get("dictionaries"):
+                self.reply_options["dictionaries"] = self.matching_dictionaries(topics)
+            for topic in topics:
+                self.stats.register(pubsub.REG_SUB, topic, address)
+            self.process_sub_registrations(topics, address)
         else:
-            LOGGER.warning(f"Received registration message with unknown type: {reg_type}")
+            self.reply_options["dictionaries"] = self.matching_dictionaries(topics)
+            self.send_reply(self.broker_type)
+
+    def negotiate_wire_format(self, reg_type, topics, options):
+        """ Chooses the wire format of a client that sent options
+
+        A client gets the newest format it offers, up to `wire_format`.
+        Publishers get the legacy format when their topics overlap the topics
+        of a subscriber that registered without options, so that it can decode
+        their messages. Subscribers registering such topics after the publisher
+        are not noticed, the publisher keeps its format.
+
+        :param str reg_type: the registration type
+        :param list topics: the string topics being registered
+        :param dict options: the options the client sent
+        :return: int wire format
+        """
+        supported = self.wire_format
+        if reg_type in (pubsub.REG_PUB, pubsub.REG_PUB_MANY) and any(
+                topic.startswith(legacy) or legacy.startswith(topic)
+                for topic in topics for legacy in self.legacy_topics):
+            supported = WireFormat.LEGACY
+        return choose_wire_format(options.get("wire_formats", []), supported)
+
+    def matching_dictionaries(self, topics):
+        """ Returns the preset dictionaries of the topics that subscriptions match
+
+        :param list topics: string topic prefixes and patterns
+        :return: dict of topic to base64 encoded dictionary
+        """
+        matching = {}
+        for topic in topics:
+            try:
+                pattern = is_pattern(topic)
+            except ValueError:
+                continue
+            for published, dictionary in self.dictionaries.items():
+                if matches(topic, published) if pattern else published.startswith(topic):
+                    matching[published] = dictionary
+        return matching
+
+    def send_reply(self, broker_type, frames=()):
+        """ Sends the reply to the registration being processed
+
+        :param str broker_type: the type of this broker
+        :param frames: additional frames specific to the broker type. Optional
+        """
+        reply = self.envelope + [broker_type.encode('utf-8')]
+        if self.reply_options is not None:
+            reply.append(pack_options(self.reply_options))
+        reply.extend(frames)
+        self.registration.send_multipart(reply)
+
+    def send_error(self, reason):
+        """ Answers the registration being processed with an error instead of the broker type
+
+        :param str reason: what was wrong with the registration
+        """
+        self.registration.send_multipart(self.envelope + [pubsub.REG_ERROR.encode('utf-8'),
+                                                          reason.encode('utf-8')])
+
+    def serve(self, timeout=.1, max_batch=100, max_registrations=10):
+        """ Serves registrations and forwards messages until `shutdown` is called
+
+        Waits on the registration socket and the sockets returned by
+        `poll_sockets` with one poller, so every socket is only used by the
+        thread running this method. Each wakeup handles at most
+        `max_registrations` registrations and then lets `process_ready` handle
+        at most `max_batch` messages per socket, so neither a burst of
+        registrations nor a busy publisher can starve the other.
+
+        :param float timeout: seconds to wait for a socket to be ready before checking
+            whether `shutdown` was called. Optional. Default = .1
+        :param int max_batch: the most messages handled per socket per wakeup.
+            Optional. Default = 100
+        :param int max_registrations: the most registrations handled per wakeup.
+            Optional. Default = 10
+        """
+        poller = zmq.Poller()
+        poller.register(self.registration, zmq.POLLIN)
+        if self.stats_socket is not None:
+            poller.register(self.stats_socket, zmq.POLLIN)
+        for socket in self.poll_sockets():
+            poller.register(socket, zmq.POLLIN)
+
+        LOGGER.info("Broker serving at %s", self.connect_address)
+        self.serving = True
+        while self.serving:
+            ready = dict(poller.poll(timeout * 1000))
+
+            if self.registration in ready:
+                for _ in range(max_registrations):
+                    try:
+                        self.process_registration(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+
+            self.process_ready(ready, max_batch)
+            self.expire_replies()
+
+            if self.stats_socket in ready:
+                self.process_stats_request()
+
+        LOGGER.info("Broker at %s stopped serving", self.connect_address)
+
+    def reply_when_ready(self, reply):
+        """ Sends the reply to the registration being processed once the
+        registering subscriber confirms that it is connected
+
+        A subscriber that asks for confirmation subscribes to its ready token
+        after its topics. Subscriptions travel in order on a connection, so once
+        the token reaches the sending socket the connection is up and the
+        subscriber's topics are known to the broker. Until then the reply is
+        held, at most `ready_timeout` seconds, while `serve` carries on with
+        other registrations and messages. The reply reports in its "ready"
+        option whether the token was seen.
+
+        :param reply: function that sends the reply, called once the envelope
+            and options of this registration are restored
+        """
+        if self.ready_token is None:
+            reply()
+        elif self.ready_token in self.ready_tokens:
+            self.ready_tokens.discard(self.ready_token)
+            self.reply_options["ready"] = True
+            reply()
+        else:
+            self.pending_replies[self.ready_token] = (time.time() + self.ready_timeout, self.envelope,
+                                                      self.reply_options, reply)
+
+    def complete_reply(self, token, ready):
+        """ Sends a reply held by `reply_when_ready`
+
+        :param bytes token: the ready token of the registration
+        :param bool ready: whether the token was seen
+        """
+        _, self.envelope, self.reply_options, reply = self.pending_replies.pop(token)
+        self.reply_options["ready"] = ready
+        reply()
+
+    def expire_replies(self):
+        """ Sends the held replies whose subscribers did not confirm in time """
+        if not self.pending_replies:
+            return
+
+        now = time.time()
+        for token, (deadline, *_) in list(self.pending_replies.items()):
+            if deadline <= now:
+                LOGGER.warning("Subscriber did not confirm its connection within %s seconds", self.ready_timeout)
+                self.complete_reply(token, False)
+
+    def process_ready_event(self, event):
+        """ Records a subscription event if it is for a ready token
+
+        :param bytes event: a subscription event read from an XPUB socket
+        :return: True if the event was for a ready token
+        """
+        token = event[1:]
+        if not token.startswith(pubsub.READY_PREFIX):
+            return False
+        if event[:1] != b'\x01':
+            self.ready_tokens.discard(token)
+        elif token in self.pending_replies:
+            self.complete_reply(token, True)
+        else:
+            # the subscriber was connected already, its registration is still to come
+            self.ready_tokens.add(token)
+        return True
+
+    def process_stats_request(self):
+        """ Answers a request on the stats socket with a snapshot of the counters """
+        self.stats_socket.recv_multipart()
+        self.stats_socket.send(encode_snapshot(self.stats_snapshot()))
+
+    def stats_snapshot(self):
+        """ Returns the broker's counters
+
+        :return: dict returned by `BrokerStats.snapshot` with the broker type added
+        """
+        snapshot = self.stats.snapshot()
+        snapshot["broker"] = type(self).__name__
+        return snapshot
+
+    def shutdown(self):
+        """ Makes `serve` return after its current iteration
+
+        Safe to call from another thread or a signal handler.
+        """
+        self.serving = False
+
+    def poll_sockets(self):
+        """ Returns the sockets, other than registration, that `serve` waits on
+
+        :return: list of sockets
+        """
+        return []
+
+    def process_ready(self, ready, max_batch):
+        """ Handles messages on the sockets returned by `poll_sockets`
+
+        :param dict ready: the sockets that are ready, as returned by `zmq.Poller.poll`
+        :param int max_batch: the most messages to handle per socket
+        """
+        pass
 
-    @abstractmethod
     def process_pub_registration(self, topic, address):
+        """ Registers a publisher for one topic and replies to it
+
+        :param str topic: A string topic
+        :param str address: the address of the publisher. String with
+            format <scheme>://<ip_addr>:<port>
+        """
+        self.process_pub_registrations([topic], address)
+
+    def process_sub_registration(self, topic, address):
+        """ Registers a subscriber for one topic and replies to it
+
+        :param str topic: A string topic
+        :param str address: the address of the subscriber. String with
+            format <scheme>://<ip_addr>:<port>
+        """
+        self.process_sub_registrations([topic], address)
+
+    @abstractmethod
+    def process_pub_registrations(self, topics, address):
         pass
 
     @abstractmethod
-    def process_sub_registration(self, topic, address):
+    def process_sub_registrations(self, topics, address):
         pass
 
 
@@ -75,19 +468,86 @@ class RoutingBroker(AbstractBroker):
     - Receiving messages from publishers to route to subscribers
 
     There is a method to process each of these events that must be run in
-    loops in threads
+    loops in threads, or `serve` handles both in a single thread.
+
+    The sending socket is an XPUB so that `serve` can also see subscriptions
+    arriving from subscribers. Sending works exactly as with a PUB socket.
+
+    The receiving socket only subscribes to the registered topics some
+    subscriber is interested in, so publishers do not send the broker messages
+    it would drop. Interest comes from subscriber registrations and from the
+    subscription events `serve` reads: a topic is subscribed upstream when the
+    first topic prefix or pattern matching it appears and unsubscribed when the
+    last one goes.
+
+    Subscribers may register wildcard patterns, see pubsub.patterns. A message
+    whose topic matches patterns is sent once more per pattern with the
+    pattern tagged in front of its topic, so only the subscribers to that
+    pattern receive the copy. The tags of each topic are memoized until the
+    patterns change.
+
+    With a last value cache the broker keeps the latest message of each topic
+    and sends a registering subscriber that asks for a snapshot the cached
+    messages of the topics it registers in the reply, so it does not wait for
+    the next publication of slow moving topics. Only the registering
+    subscriber receives them: sent on the XPUB they would also reach every
+    other subscriber to the topics. The receiving socket then subscribes to
+    every registered topic, whether a subscriber is interested or not.
 
+    With flow control, see pubsub.flow, messages that find a subscriber's
+    queue full are dropped and counted, or wait for room, as their topic's
+    policy says. Waiting holds up forwarding for every topic, so publishers
+    then fill the queues to the broker and are slowed down or drop in turn.
     """
+    broker_type = BrokerType.ROUTE
 
-    def __init__(self, registration_address):
+    def __init__(self, registration_address, wire_format=WireFormat.COMPACT, stats_address=None, cache=None,
+                 flow=None):
         """ Creates a routing broker instance
 
         :param str registration_address: the address to use by this broker for publishers
             and subscribers to register with. Format: <scheme>://<ip_addr>:<port>
+        :param int wire_format: the newest wire format clients may use, below it the format
+            is negotiated per client. Optional. Default = WireFormat.COMPACT
+        :param str stats_address: the address to serve counters on. Optional.
+            Default = None. Format: <scheme>://<ip_addr>:<port>
+        :param LastValueCache cache: the cache to keep the latest message of each
+            topic in for snapshots. Optional. Default = None, no snapshots
+        :param FlowControl flow: the high-water marks, buffer sizes and policy per
+            topic of the forwarding sockets. Optional. Default = None, the ZMQ
+            defaults, with messages dropped silently
         """
-        super().__init__(registration_address)
+        super().__init__(registration_address, wire_format, stats_address)
         self.message_in = self.context.socket(zmq.SUB)
-        self.message_out = self.context.socket(zmq.PUB)
+        self.message_out = self.context.socket(zmq.XPUB)
+        self.flow = flow
+        if flow is not None:
+            flow.apply(self.message_in)
+            flow.apply_send(self.message_out, SEND_TIMEOUT)
+
+        # Subscribers register once per topic but are connected to only once,
+        # a second connection would get a copy of every message
+        self.subscribers = set()
+
+        # Topic prefixes subscribers are subscribed to, from registrations and
+        # the subscription events read by serve, and whether a message topic
+        # matches any of them
+        self.subscriptions = set()
+        self.routed = {}
+
+        # The topics publishers registered, and the number of prefixes and
+        # patterns matching each topic that has any. message_in subscribes to
+        # exactly the topics in interest
+        self.published = TopicTrie()
+        self.interest = {}
+
+        # Wildcard patterns subscribers registered, and the tagged topic frames
+        # of each message topic, one per pattern it matches
+        self.patterns = PatternIndex()
+        self.tagged = {}
+
+        # The latest message of each topic, None without snapshots. See send_snapshot
+        self.cache = cache
 
     def process(self):
         """ Process messages
@@ -95,42 +555,931 @@ class RoutingBroker(AbstractBroker):
         Receives messages from publishers and publishes
         messages to subscribers
         """
-        LOGGER.debug("Waiting to process message...")
-        message = self.message_in.recv_multipart()
-        LOGGER.info(f"Received message: {message}")
+        # copy=False so large payloads are forwarded without being copied into Python
+        message = self.message_in.recv_multipart(copy=False)
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug("Received message on topic %s", message[0].bytes)
 
-        self.message_out.send_multipart(message)
+        self.forward(message)
+        # subscriptions are only read by serve, so here every message counts as routed
+        self.count_message(message, True)
 
-    def process_pub_registration(self, topic, address):
-        """ Connect address to message receiving socket and
-        send broker type message to publisher.
+    def forward(self, message):
+        """ Sends a message to subscribers, once as it is and once tagged for
+        each pattern its topic matches
 
-        :param str topic: A string topic
+        :param list message: the frames of the message
+        """
+        topic = message[0].bytes
+        self.send(topic, message)
+        if self.cache is not None:
+            self.cache.put(topic, message)
+        if not self.patterns:
+            return
+
+        tagged = self.tagged.get(topic)
+        if tagged is None:
+            tagged = self.tagged[topic] = [tag(pattern) + topic
+                                           for pattern in self.patterns.match(topic.decode('utf-8'))]
+        for frame in tagged:
+            self.send(topic, [frame] + message[1:])
+
+    def send(self, topic, message):
+        """ Sends a message on to subscribers, through the flow control if there
+        is one, counting the messages it drops
+
+        :param bytes topic: the topic of the message, untagged
+        :param list message: the frames to send
+        """
+        if self.flow is None:
+            self.message_out.send_multipart(message, copy=False)
+        elif not self.flow.send(self.message_out, topic, message, False):
+            (self.stats.messages.get(topic) or self.stats.counters(topic))[HWM_DROPS] += 1
+
+    def add_pattern(self, pattern):
+        """ Starts tagging messages for a wildcard pattern
+
+        :param str pattern: the pattern
+        """
+        if self.patterns.add(pattern):
+            self.tagged.clear()
+            self.routed.clear()
+            self.add_interest(self.pattern_topics(pattern))
+            LOGGER.debug("Added pattern \"%s\"", pattern)
+
+    def remove_pattern(self, pattern):
+        """ Stops tagging messages for a wildcard pattern
+
+        :param str pattern: the pattern
+        """
+        if self.patterns.remove(pattern):
+            self.tagged.clear()
+            self.routed.clear()
+            self.remove_interest(self.pattern_topics(pattern))
+            LOGGER.debug("Removed pattern \"%s\"", pattern)
+
+    def pattern_topics(self, pattern):
+        """ Returns the registered topics a pattern matches
+
+        :param str pattern: the pattern
+        :return: list of string topics
+        """
+        return [topic for topic, _ in self.published.items(literal_prefix(pattern)) if matches(pattern, topic)]
+
+    def add_subscription(self, prefix):
+        """ Records a topic prefix a subscriber is subscribed to
+
+        :param bytes prefix: the prefix
+        """
+        if prefix not in self.subscriptions:
+            self.subscriptions.add(prefix)
+            self.routed.clear()
+            self.add_interest([topic for topic, _ in self.published.items(prefix.decode('utf-8'))])
+
+    def remove_subscription(self, prefix):
+        """ Forgets a topic prefix no subscriber is subscribed to any more
+
+        :param bytes prefix: the prefix
+        """
+        if prefix in self.subscriptions:
+            self.subscriptions.discard(prefix)
+            self.routed.clear()
+            self.remove_interest([topic for topic, _ in self.published.items(prefix.decode('utf-8'))])
+
+    def add_interest(self, topics):
+        """ Counts one more prefix or pattern for each topic, subscribing
+        upstream to the topics that had none
+
+        :param list topics: registered string topics
+        """
+        for topic in topics:
+            count = self.interest.get(topic, 0)
+            self.interest[topic] = count + 1
+            if count == 0:
+                self.message_in.setsockopt_string(zmq.SUBSCRIBE, topic)
+                LOGGER.debug("Subscribed upstream to \"%s\"", topic)
+
+    def remove_interest(self, topics):
+        """ Counts one prefix or pattern less for each topic, unsubscribing
+        upstream from the topics left with none
+
+        :param list topics: registered string topics
+        """
+        for topic in topics:
+            count = self.interest.get(topic, 0)
+            if count > 1:
+                self.interest[topic] = count - 1
+            elif count == 1:
+                del self.interest[topic]
+                self.message_in.setsockopt_string(zmq.UNSUBSCRIBE, topic)
+                LOGGER.debug("Unsubscribed upstream from \"%s\"", topic)
+
+    def count_message(self, message, routed=None):
+        """ Adds a forwarded message to the counters
+
+        :param list message: the frames of the message
+        :param bool routed: whether a subscriber is subscribed to the topic. Optional.
+            Default = None, look it up in the subscriptions seen by serve
+        """
+        topic = message[0].bytes
+        size = sum(map(len, message))
+        counters = self.stats.messages.get(topic) or self.stats.counters(topic)
+        counters[MESSAGES_IN] += 1
+        counters[BYTES_IN] += size
+
+        if routed is None:
+            routed = self.routed.get(topic)
+            if routed is None:
+                routed = self.routed[topic] = any(topic.startswith(prefix) for prefix in self.subscriptions) \
+                    or bool(self.patterns and self.patterns.match(topic.decode('utf-8')))
+
+        if routed:
+            counters[MESSAGES_OUT] += 1
+            counters[BYTES_OUT] += size
+        else:
+            counters[DROPS] += 1
+
+    def poll_sockets(self):
+        """ Returns the forwarding sockets for `serve` to wait on
+
+        :return: list of sockets
+        """
+        return [self.message_in, self.message_out]
+
+    def process_ready(self, ready, max_batch):
+        """ Forwards ready messages and reads subscription events
+
+        :param dict ready: the sockets that are ready, as returned by `zmq.Poller.poll`
+        :param int max_batch: the most messages to handle per socket
+        """
+        if self.message_in in ready:
+            for _ in range(max_batch):
+                try:
+                    message = self.message_in.recv_multipart(zmq.NOBLOCK, copy=False)
+                except zmq.Again:
+                    break
+                self.forward(message)
+                self.count_message(message)
+
+        # Subscription events are \x01 (subscribe) or \x00 (unsubscribe)
+        # followed by the topic. The XPUB only passes on the first subscription
+        # and the last unsubscription of a topic, so they give the set of topics
+        # with at least one subscriber, used to count messages nobody receives.
+        # Subscriptions to tags add and remove wildcard patterns
+        if self.message_out in ready:
+            for _ in range(max_batch):
+                try:
+                    event = self.message_out.recv(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                LOGGER.debug("Subscription event: %s", event)
+                if self.process_ready_event(event):
+                    continue
+                if event[1:2] == TAG_START.encode('utf-8'):
+                    self.process_tag_event(event)
+                    continue
+                if event[:1] == b'\x01':
+                    self.add_subscription(event[1:])
+                else:
+                    self.remove_subscription(event[1:])
+
+    def process_tag_event(self, event):
+        """ Adds or removes the pattern of a subscription event for a tag
+
+        :param bytes event: a subscription event read from the XPUB socket
+        """
+        pattern = event[2:-1].decode('utf-8')
+        try:
+            if event[:1] == b'\x01':
+                self.add_pattern(pattern)
+            else:
+                self.remove_pattern(pattern)
+        except ValueError as error:
+            LOGGER.warning("Ignoring subscription to tag: %s", error)
+
+    def process_pub_registrations(self, topics, address):
+        """ Connect address to message receiving socket, subscribe to
+        the topics subscribers are interested in and send broker type
+        message to publisher.
+
+        :param list topics: the string topics
+        :param str address: the address of this publisher. String with
+            format <scheme>://<ip_addr>:<port>
+        """
+        self.message_in.connect(address)
+        for topic in topics:
+            if not self.published.get(topic):
+                # a new topic, interesting to every prefix and pattern matching
+                # it, and to the cache, which needs its messages before anybody
+                # subscribes
+                encoded = topic.encode('utf-8')
+                count = sum(1 for prefix in self.subscriptions if encoded.startswith(prefix)) \
+                    + len(self.patterns.match(topic) if self.patterns else ()) \
+                    + (self.cache is not None)
+                if count:
+                    self.interest[topic] = count
+                    self.message_in.setsockopt_string(zmq.SUBSCRIBE, topic)
+            self.published.add(topic, address)
+
+        # Complete registration with reply containing broker type, telling the
+        # publisher which of its topics this broker subscribes to
+        if self.reply_options is not None:
+            subscribed = [topic for topic in topics if topic in self.interest]
+            if len(subscribed) == len(topics):
+                self.reply_options["subscribes"] = True
+            elif subscribed:
+                self.reply_options["subscribed"] = subscribed
+        self.send_reply(BrokerType.ROUTE)
+        LOGGER.debug("Connected to publisher at %s for topics %s", address, topics)
+
+    def process_sub_registrations(self, topics, address):
+        """ Connect the message sending socket to the new subscriber and
+        send broker type message to subscriber registered for the topics.
+
+        :param list topics: the string topics
         :param str address: the address of this subscriber. String with
             format <scheme>://<ip_addr>:<port>
         """
+        if address not in self.subscribers:
+            self.subscribers.add(address)
+            self.message_out.connect(address)
 
-        self.message_in.connect(address)
-        self.message_in.setsockopt_string(zmq.SUBSCRIBE, topic)
+        # Prefixes and patterns are also added when they are subscribed, but
+        # brokers driven by process loops never read subscriptions
+        for topic in topics:
+            try:
+                if is_pattern(topic):
+                    self.add_pattern(topic)
+                else:
+                    self.add_subscription(topic.encode('utf-8'))
+            except ValueError as error:
+                LOGGER.warning("Ignoring pattern: %s", error)
 
-        # Complete registration with reply containing broker type
-        self.registration.send_string(BrokerType.ROUTE)
-        LOGGER.debug(f"Connected to publisher at {address} for topic \"{topic}\"")
+        # Complete registration with reply containing broker type, and the
+        # cached messages when asked for. They are looked up when the reply is
+        # sent, so the snapshot has the messages forwarded while it was held
+        if self.cache is not None and self.request_options.get("snapshot"):
+            self.reply_when_ready(lambda: self.send_snapshot(topics))
+        else:
+            self.reply_when_ready(lambda: self.send_reply(BrokerType.ROUTE))
+        LOGGER.debug("Connected to subscriber at \"%s\"", address)
 
-    def process_sub_registration(self, topic, address):
+    def send_snapshot(self, topics):
+        """ Sends the reply to a subscriber registration with the cached
+        messages of the topics it registered
+
+        The "snapshot" option of the reply lists the number of frames of each
+        message, whose frames follow the options frame.
+
+        :param list topics: the registered string topics and patterns
+        """
+        cached = []
+        for topic in topics:
+            try:
+                if is_pattern(topic):
+                    cached.extend(self.pattern_topics(topic))
+                else:
+                    cached.extend(published for published, _ in self.published.items(topic))
+            except ValueError:
+                continue
+
+        messages = self.cache.snapshot(dict.fromkeys(topic.encode('utf-8') for topic in cached))
+        if messages:
+            self.reply_options["snapshot"] = [len(message) for message in messages]
+        self.send_reply(BrokerType.ROUTE, [frame for message in messages for frame in message])
+
+
+class ProxyRoutingBroker(AbstractBroker):
+    """ Routing Broker that forwards messages inside libzmq
+
+    Instead of pulling every message into Python, this broker hands the
+    message_in to message_out path to a steerable libzmq proxy running in a
+    background thread. It is not a RoutingBroker: none of the Python
+    forwarding, flow control, patterns or cache applies, though clients see
+    the same BrokerType.ROUTE.
+
+    Upstream subscriptions follow interest natively: the XSUB only carries
+    the subscriptions of connected subscribers to publishers, so publishers
+    send nothing nobody wants. The receiving socket is an XSUB and the sending socket
+    is an XPUB so the proxy also carries subscriptions upstream. Registration
+    is still processed in Python through `process_registration`.
+
+    The forwarding sockets belong to the proxy thread, which is the only one
+    that touches them. When a registration needs to connect one of them, the
+    broker sends the address through the control socket and the proxy thread
+    connects it between two calls to the proxy and goes straight back to
+    forwarding. The thread and its sockets stay up and messages arriving in
+    the meantime are queued by ZMQ, not dropped.
+
+    The proxy publishes a copy of every forwarded message (and of
+    subscriptions travelling upstream, which are single frames starting with
+    \\x00 or \\x01) on a capture PUB socket. If a capture address is supplied
+    the socket is also bound to it. This is the pass-through hook for sampling
+    or metrics: it is only read by whoever subscribes to it and never slows
+    down forwarding. The broker itself reads the subscriptions, so `serve`
+    confirms subscriber connections like the routing broker does and tells
+    publishers which of their topics subscribers want.
+    """
+    broker_type = BrokerType.ROUTE
+    instance_ids = itertools.count()
+
+    def __init__(self, registration_address, capture_address=None, wire_format=WireFormat.COMPACT,
+                 stats_address=None):
+        """ Creates a proxy routing broker instance
+
+        :param str registration_address: the address to use by this broker for publishers
+            and subscribers to register with. Format: <scheme>://<ip_addr>:<port>
+        :param str capture_address: address to publish a copy of every forwarded message on.
+            Optional. Default is None (no capture). Format: <scheme>://<ip_addr>:<port>
+        :param int wire_format: the newest wire format clients may use, below it the format
+            is negotiated per client. Optional. Default = WireFormat.COMPACT
+        :param str stats_address: the address to serve counters on. Optional.
+            Default = None. Format: <scheme>://<ip_addr>:<port>
+        """
+        super().__init__(registration_address, wire_format, stats_address)
+        self.message_in = self.context.socket(zmq.XSUB)
+        self.message_out = self.context.socket(zmq.XPUB)
+        self.subscribers = set()
+
+        # The subscription events this broker reads are published by the
+        # proxy on the capture socket
+        instance_id = next(self.instance_ids)
+        events_address = f"inproc://proxy-events-{instance_id}"
+        self.capture = self.context.socket(zmq.PUB)
+        self.capture.bind(events_address)
+        if capture_address is not None:
+            self.capture.bind(capture_address)
+        self.events = self.context.socket(zmq.SUB)
+        self.events.connect(events_address)
+        for event in [b'\x01', b'\x00']:
+            self.events.setsockopt(zmq.SUBSCRIBE, event)
+
+        # Topic prefixes subscribers are subscribed to, from registrations and
+        # the subscription events read by serve
+        self.subscriptions = set()
+
+        # The control pair steers the proxy. This broker keeps one end and
+        # the proxy thread listens on the other.
+        control_address = f"inproc://proxy-control-{instance_id}"
+        self.control = self.context.socket(zmq.PAIR)
+        self.control.bind(control_address)
+        self.proxy_control = self.context.socket(zmq.PAIR)
+        self.proxy_control.connect(control_address)
+
+        self.proxy_thread = None
+        self.start()
+        LOGGER.info("Created proxy routing broker at %s", registration_address)
+
+    def start(self):
+        """ Starts forwarding messages in a background thread """
+        if self.proxy_thread is not None:
+            return
+
+        self.proxy_thread = threading.Thread(target=self.run_proxy, daemon=True)
+        self.proxy_thread.start()
+
+    def run_proxy(self):
+        """ Forwards messages until `stop` is called, connecting the
+        forwarding sockets when `connect` asks it to
+
+        The proxy only returns when it is sent TERMINATE, which `connect` and
+        `stop` follow with the command for this thread.
+        """
+        while True:
+            zmq.proxy_steerable(self.message_in, self.message_out, self.capture, self.proxy_control)
+            command = self.proxy_control.recv_multipart()
+            if command[0] != b"CONNECT":
+                break
+
+            socket = self.message_in if command[1] == b"in" else self.message_out
+            try:
+                socket.connect(command[2].decode('utf-8'))
+            except zmq.ZMQError as error:
+                self.proxy_control.send_string(str(error.errno))
+            else:
+                self.proxy_control.send_string("")
+
+    def connect(self, socket, address):
+        """ Connects one of the forwarding sockets in the proxy thread and
+        waits until it is done
+
+        :param socket: message_in or message_out
+        :param str address: the address to connect to. String with
+            format <scheme>://<ip_addr>:<port>
+        :raises zmq.ZMQError: if the socket cannot connect to the address
+        """
+        if self.proxy_thread is None:
+            socket.connect(address)
+            return
+
+        self.control.send(b"TERMINATE")
+        self.control.send_multipart([b"CONNECT", b"in" if socket is self.message_in else b"out",
+                                     address.encode('utf-8')])
+        errno = self.control.recv_string()
+        if errno:
+            raise zmq.ZMQError(int(errno))
+
+    def stop(self):
+        """ Stops forwarding messages and waits for the proxy thread to exit """
+        if self.proxy_thread is None:
+            return
+
+        self.control.send(b"TERMINATE")
+        self.control.send(b"STOP")
+        self.proxy_thread.join()
+        self.proxy_thread = None
+
+    def pause(self):
+        """ Suspends forwarding; messages queue up until `resume` is called """
+        self.control.send(b"PAUSE")
+
+    def resume(self):
+        """ Resumes forwarding after `pause` """
+        self.control.send(b"RESUME")
+
+    def statistics(self):
+        """ Returns the proxy's message and byte counters
+
+        The counters are returned as a list of eight integers, in libzmq's order:
+        frontend messages received, frontend bytes received, frontend messages sent,
+        frontend bytes sent, and the same four values for the backend.
+
+        :return: list of int counters
+        """
+        self.control.send(b"STATISTICS")
+        return [struct.unpack('=Q', frame)[0] for frame in self.control.recv_multipart()]
+
+    def process(self):
+        """ Waits for forwarding to stop
+
+        Messages are forwarded by the proxy thread, so there is nothing to do
+        per message. This method only blocks until the proxy is stopped.
+        """
+        if self.proxy_thread is not None:
+            self.proxy_thread.join()
+
+    def stats_snapshot(self):
+        """ Returns the broker's counters
+
+        Messages are forwarded inside libzmq, so there are no per topic message
+        counters. The proxy's own totals are added under "proxy" instead.
+
+        :return: dict returned by `BrokerStats.snapshot` with the broker type and proxy counters added
+        """
+        snapshot = super().stats_snapshot()
+        names = ["frontend_messages_in", "frontend_bytes_in", "frontend_messages_out", "frontend_bytes_out",
+                 "backend_messages_in", "backend_bytes_in", "backend_messages_out", "backend_bytes_out"]
+        snapshot["proxy"] = dict(zip(names, self.statistics()))
+        return snapshot
+
+    def poll_sockets(self):
+        """ Returns the socket subscription events are read from, the
+        forwarding sockets belong to the proxy thread
+
+        :return: list of sockets
+        """
+        return [self.events]
+
+    def process_ready(self, ready, max_batch):
+        """ Reads the subscription events captured by the proxy
+
+        :param dict ready: the sockets that are ready, as returned by `zmq.Poller.poll`
+        :param int max_batch: the most events to handle
+        """
+        if self.events not in ready:
+            return
+        for _ in range(max_batch):
+            try:
+                event = self.events.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            # forwarded messages whose topic starts with \x00 or \x01 have more frames
+            if len(event) > 1 or self.process_ready_event(event[0]):
+                continue
+            if event[0][1:2] == TAG_START.encode('utf-8'):
+                continue
+            if event[0][:1] == b'\x01':
+                self.subscriptions.add(event[0][1:])
+            else:
+                self.subscriptions.discard(event[0][1:])
+
+    def process_pub_registrations(self, topics, address):
+        """ Connect address to message receiving socket and send broker type
+        message to publisher.
+
+        The XSUB passes the subscriptions of connected subscribers on to the
+        publisher, so it is only sent the topics somebody wants. The reply
+        tells the publisher which of its topics those are.
+
+        :param list topics: the string topics
+        :param str address: the address of the publisher. String with
+            format <scheme>://<ip_addr>:<port>
+        """
+        self.connect(self.message_in, address)
+
+        if self.reply_options is not None:
+            subscribed = [topic for topic in topics
+                          if any(topic.encode('utf-8').startswith(prefix) for prefix in self.subscriptions)]
+            if len(subscribed) == len(topics):
+                self.reply_options["subscribes"] = True
+            elif subscribed:
+                self.reply_options["subscribed"] = subscribed
+        self.send_reply(BrokerType.ROUTE)
+        LOGGER.debug("Connected to publisher at %s for topics %s", address, topics)
+
+    def process_sub_registrations(self, topics, address):
         """ Connect the message sending socket to the new subscriber and
-        send broker type message to subscriber registered for that topic.
+        send broker type message to subscriber registered for the topics.
 
-        :param str topic: A string topic
+        Wildcard patterns are not routed. They are listed in the "rejected"
+        option of the reply, which makes the subscriber drop them.
+
+        :param list topics: the string topics
         :param str address: the address of this subscriber. String with
             format <scheme>://<ip_addr>:<port>
         """
-        #
-        self.message_out.connect(address)
+        if address not in self.subscribers:
+            self.subscribers.add(address)
+            self.connect(self.message_out, address)
+
+        # libzmq only matches prefixes, nothing here could tag messages for a
+        # wildcard pattern. Prefixes are also added when they are subscribed,
+        # but brokers driven by process loops never read subscriptions
+        rejected = []
+        for topic in topics:
+            try:
+                if is_pattern(topic):
+                    rejected.append(topic)
+                else:
+                    self.subscriptions.add(topic.encode('utf-8'))
+            except ValueError:
+                rejected.append(topic)
+        if rejected:
+            LOGGER.warning("Rejecting wildcard patterns %s, the proxy only routes plain topics", rejected)
+            if self.reply_options is not None:
+                self.reply_options["rejected"] = rejected
+
+        self.reply_when_ready(lambda: self.send_reply(BrokerType.ROUTE))
+        LOGGER.debug("Connected to subscriber at \"%s\"", address)
+
+
+def run_shard(control_address, index, num_shards, max_batch=100):
+    """ Runs a forwarding shard until it is told to stop
+
+    This is the target of each shard process started by `ShardedRoutingBroker`.
+    The shard owns its own context and SUB/XPUB socket pair and polls them
+    together with a PAIR socket on which it reports that it is ready and the
+    front broker sends commands:
+    - [REGISTER_PUBLISHER, address, topic, ...]: connect to a publisher, once
+      per address, and subscribe to the topics
+    - [REGISTER_SUBSCRIBER, address]: connect to a subscriber
+    - [STOP]: exit the loop
+
+    Subscriptions are prefixes, so the shard may receive topics of other
+    shards that start with one of its own. It only forwards the topics
+    `shard_for_topic` gives it. SIGINT is ignored, the front broker stops
+    the shard.
+
+    Subscription events for ready tokens are passed back to the front broker
+    as [EVENT, event]. They are dropped rather than waited for if the front
+    broker is not reading them. Subscriptions to tags add and remove wildcard
+    patterns, whose matching messages are sent again tagged, as RoutingBroker
+    does.
+
+    :param str control_address: address the front broker bound its command socket to
+    :param int index: the index of this shard
+    :param int num_shards: the number of shards
+    :param int max_batch: maximum number of messages forwarded per poll
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    context = zmq.Context()
+    control = context.socket(zmq.PAIR)
+    control.connect(control_address)
+    message_in = context.socket(zmq.SUB)
+    message_out = context.socket(zmq.XPUB)
+    control.send_string(ShardedRoutingBroker.READY)
+
+    poller = zmq.Poller()
+    poller.register(control, zmq.POLLIN)
+    poller.register(message_in, zmq.POLLIN)
+    poller.register(message_out, zmq.POLLIN)
+
+    # Whether each topic received belongs to this shard, and the addresses of
+    # the publishers connected to
+    owned = {}
+    publishers = set()
+
+    # The wildcard patterns subscribed to, and the tagged topic frames of each
+    # message topic
+    patterns = PatternIndex()
+    tagged = {}
+
+    running = True
+    while running:
+        events = dict(poller.poll())
+
+        if message_in in events:
+            for _ in range(max_batch):
+                try:
+                    message = message_in.recv_multipart(flags=zmq.NOBLOCK, copy=False)
+                except zmq.Again:
+                    break
+                topic = message[0].bytes
+                mine = owned.get(topic)
+                if mine is None:
+                    mine = owned[topic] = shard_for_topic(topic.decode('utf-8', 'replace'), num_shards) == index
+                if not mine:
+                    continue
+
+                message_out.send_multipart(message, copy=False)
+                if not patterns:
+                    continue
+
+                frames = tagged.get(topic)
+                if frames is None:
+                    frames = tagged[topic] = [tag(pattern) + topic for pattern in patterns.match(topic.decode('utf-8'))]
+                for frame in frames:
+                    message_out.send_multipart([frame] + message[1:], copy=False)
+
+        if message_out in events:
+            for _ in range(max_batch):
+                try:
+                    event = message_out.recv(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                if event[1:2] == TAG_START.encode('utf-8'):
+                    try:
+                        changed = patterns.add(event[2:-1].decode('utf-8')) if event[:1] == b'\x01' \
+                            else patterns.remove(event[2:-1].decode('utf-8'))
+                    except ValueError as error:
+                        LOGGER.warning("Ignoring subscription to tag: %s", error)
+                        continue
+                    if changed:
+                        tagged.clear()
+                elif event[1:].startswith(pubsub.READY_PREFIX):
+                    try:
+                        control.send_multipart([ShardedRoutingBroker.EVENT.encode('utf-8'), event], zmq.NOBLOCK)
+                    except zmq.Again:
+                        pass
+
+        if control in events:
+            command = control.recv_multipart()
+            reg_type = command[0].decode('utf-8')
+            try:
+                if reg_type == pubsub.REG_PUB:
+                    address = command[1].decode('utf-8')
+                    if address not in publishers:
+                        message_in.connect(address)
+                        publishers.add(address)
+                    for topic in command[2:]:
+                        message_in.setsockopt(zmq.SUBSCRIBE, topic)
+                elif reg_type == pubsub.REG_SUB:
+                    message_out.connect(command[1].decode('utf-8'))
+                elif reg_type == ShardedRoutingBroker.STOP:
+                    running = False
+            except zmq.ZMQError as error:
+                LOGGER.warning("Shard %s failed to process %s: %s", index, command, error)
+
+    context.destroy(linger=0)
+
 
-        # Complete registration with reply containing broker type
-        self.registration.send_string(BrokerType.ROUTE)
-        LOGGER.debug(f"Connected to subscriber at \"{address}\"")
+class ShardedRoutingBroker(AbstractBroker):
+    """ Routing Broker that spreads forwarding over several processes
+
+    Topics are partitioned over N shard processes by `shard_for_topic`. Each
+    shard has its own SUB/PUB socket pair and forwards only the topics in its
+    partition, so forwarding is no longer limited to one core.
+
+    This process only serves registrations. A publisher registration is passed
+    to the shards that own its topics, which connect to the publisher and
+    subscribe to those topics only. A subscriber is connected to the shards
+    owning its topics and, since ZMQ subscriptions are prefix matches, the
+    topics registered by publishers that start with one of them. A publisher
+    registering such a topic later connects the subscriber to the topic's
+    shard as well. Wildcard patterns may match topics of any shard, so a
+    subscriber with a pattern is connected to every shard. The registration
+    protocol is unchanged and clients still receive BrokerType.ROUTE.
+
+    Shards subscribe to every topic of their partition that a publisher
+    registers, whether a subscriber is interested or not: interest driven
+    upstream subscriptions are left to RoutingBroker and ProxyRoutingBroker.
+
+    Wildcard patterns are matched by the shards, each tagging the messages of
+    its own partition, see run_shard. A subscriber's ready token reaches every
+    shard it is connected to, which pass it back to this process. `serve`
+    confirms the connection once each of those shards has seen the token, and
+    stops the shards when it returns.
+    """
+    broker_type = BrokerType.ROUTE
+    READY = "READY"
+    STOP = "STOP"
+    EVENT = "EVENT"
+
+    def __init__(self, registration_address, num_shards=None, wire_format=WireFormat.COMPACT,
+                 stats_address=None):
+        """ Creates a sharded routing broker and starts its shard processes
+
+        :param str registration_address: the address to use by this broker for publishers
+            and subscribers to register with. Format: <scheme>://<ip_addr>:<port>
+        :param int num_shards: the number of shard processes. Optional. Default is
+            the number of CPUs
+        :param int wire_format: the newest wire format clients may use, below it the format
+            is negotiated per client. Optional. Default = WireFormat.COMPACT
+        :param str stats_address: the address to serve registration counters on.
+            Optional. Default = None. Format: <scheme>://<ip_addr>:<port>
+        """
+        super().__init__(registration_address, wire_format, stats_address)
+        self.num_shards = num_shards or os.cpu_count() or 1
+
+        # The shards each subscriber is connected to, the plain topics it
+        # registered and the topics publishers registered
+        self.subscribers = {}
+        self.subscriber_topics = {}
+        self.publisher_topics = set()
+
+        # Spawn rather than fork so children do not inherit this process's
+        # ZMQ context and background threads
+        mp_context = multiprocessing.get_context("spawn")
+
+        self.shard_control = []
+        self.shards = []
+        for index in range(self.num_shards):
+            control = self.context.socket(zmq.PAIR)
+            port = control.bind_to_random_port("tcp://127.0.0.1")
+            shard = mp_context.Process(target=run_shard,
+                                       args=[f"tcp://127.0.0.1:{port}", index, self.num_shards],
+                                       name=f"pubsub-shard-{index}",
+                                       daemon=True)
+            shard.start()
+            self.shard_control.append(control)
+            self.shards.append(shard)
+
+        # Wait until every shard is listening for commands
+        for control in self.shard_control:
+            control.recv_string()
+
+        # The number of shards that have seen each ready token, and the number
+        # that have to once its registration is processed
+        self.shard_tokens = {}
+        self.token_shards = {}
+
+        LOGGER.info("Created sharded routing broker at %s with %s shards", registration_address, self.num_shards)
+
+    def serve(self, timeout=.1, max_batch=100, max_registrations=10):
+        """ Serves registrations until `shutdown` is called and then stops the shards
+
+        :param float timeout: seconds to wait for a socket to be ready before checking
+            whether `shutdown` was called. Optional. Default = .1
+        :param int max_batch: the most events handled per shard per wakeup.
+            Optional. Default = 100
+        :param int max_registrations: the most registrations handled per wakeup.
+            Optional. Default = 10
+        """
+        try:
+            super().serve(timeout, max_batch, max_registrations)
+        finally:
+            self.stop()
+
+    def stop(self, timeout=5.0):
+        """ Tells every shard to stop and waits for the shard processes to exit
+
+        Shards that have not exited within `timeout` seconds are terminated.
+        Stopping shards that have exited already does nothing.
+
+        :param float timeout: seconds to wait for the shards to exit. Optional. Default = 5
+        """
+        for control, shard in zip(self.shard_control, self.shards):
+            if shard.is_alive():
+                try:
+                    control.send_string(self.STOP, zmq.NOBLOCK)
+                except zmq.Again:
+                    pass
+
+        deadline = time.time() + timeout
+        for shard in self.shards:
+            shard.join(max(0.0, deadline - time.time()))
+            if shard.is_alive():
+                LOGGER.warning("Shard %s did not stop within %s seconds, terminating it", shard.name, timeout)
+                shard.terminate()
+                shard.join()
+
+    def poll_sockets(self):
+        """ Returns the control sockets shards pass subscription events back on
+
+        :return: list of sockets
+        """
+        return self.shard_control
+
+    def process_ready(self, ready, max_batch):
+        """ Confirms the ready tokens every shard has seen
+
+        :param dict ready: the sockets that are ready, as returned by `zmq.Poller.poll`
+        :param int max_batch: the most events to handle per shard
+        """
+        for control in self.shard_control:
+            if control not in ready:
+                continue
+            for _ in range(max_batch):
+                try:
+                    command = control.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                if command[0].decode('utf-8') == self.EVENT:
+                    self.process_shard_event(command[1])
+
+    def process_shard_event(self, event):
+        """ Counts a ready token event passed back by a shard
+
+        :param bytes event: the subscription event
+        """
+        token = event[1:]
+        if event[:1] != b'\x01':
+            self.shard_tokens.pop(token, None)
+            self.token_shards.pop(token, None)
+            self.process_ready_event(event)
+            return
+
+        self.shard_tokens[token] = self.shard_tokens.get(token, 0) + 1
+        self.confirm_token(token)
+
+    def confirm_token(self, token):
+        """ Confirms a ready token once every shard its subscriber is
+        connected to has seen it
+
+        :param bytes token: the ready token
+        """
+        expected = self.token_shards.get(token)
+        if expected is None or self.shard_tokens.get(token, 0) < expected:
+            return
+        del self.token_shards[token]
+        self.shard_tokens.pop(token, None)
+        self.process_ready_event(b'\x01' + token)
+
+    def connect_subscriber(self, address, shards):
+        """ Tells the shards a subscriber is not connected to yet to connect to it
+
+        :param str address: the address of the subscriber. String with
+            format <scheme>://<ip_addr>:<port>
+        :param shards: the indexes of the shards
+        """
+        connected = self.subscribers.setdefault(address, set())
+        for shard in shards:
+            if shard not in connected:
+                connected.add(shard)
+                self.shard_control[shard].send_multipart([pubsub.REG_SUB.encode('utf-8'), address.encode('utf-8')])
+                LOGGER.debug("Shard %s connecting to subscriber at \"%s\"", shard, address)
+
+    def process_pub_registrations(self, topics, address):
+        """ Tell the shards owning the topics to connect to the publisher and
+        send broker type message to publisher.
+
+        Subscribers to a prefix of a topic are connected to its shard too.
+
+        :param list topics: the string topics
+        :param str address: the address of the publisher. String with
+            format <scheme>://<ip_addr>:<port>
+        """
+        owned = {}
+        for topic in topics:
+            owned.setdefault(shard_for_topic(topic, self.num_shards), []).append(topic)
+
+        for shard, shard_topics in owned.items():
+            for subscriber, prefixes in self.subscriber_topics.items():
+                if any(topic.startswith(prefix) for topic in shard_topics for prefix in prefixes):
+                    self.connect_subscriber(subscriber, [shard])
+            self.shard_control[shard].send_multipart([pubsub.REG_PUB.encode('utf-8'), address.encode('utf-8')] +
+                                                     [topic.encode('utf-8') for topic in shard_topics])
+            LOGGER.debug("Shard %s connecting to publisher at %s for topics %s", shard, address, shard_topics)
+        self.publisher_topics.update(topics)
+
+        if self.reply_options is not None:
+            self.reply_options["subscribes"] = True
+        self.send_reply(BrokerType.ROUTE)
+
+    def process_sub_registrations(self, topics, address):
+        """ Tell the shards the subscriber needs to connect to it and send
+        broker type message to subscriber.
+
+        :param list topics: the string topics
+        :param str address: the address of the subscriber. String with
+            format <scheme>://<ip_addr>:<port>
+        """
+        plain = [topic for topic in topics if not is_pattern(topic)]
+        if len(plain) < len(topics):
+            # a pattern may match the topics of any shard
+            shards = range(self.num_shards)
+        else:
+            shards = {shard_for_topic(topic, self.num_shards) for topic in topics}
+            shards.update(shard_for_topic(published, self.num_shards) for published in self.publisher_topics
+                          if any(published.startswith(topic) for topic in topics))
+        self.subscriber_topics.setdefault(address, set()).update(plain)
+        self.connect_subscriber(address, shards)
+
+        if self.ready_token is not None:
+            self.token_shards[self.ready_token] = len(self.subscribers[address])
+            self.confirm_token(self.ready_token)
+        self.reply_when_ready(lambda: self.send_reply(BrokerType.ROUTE))
 
 
 class DirectBroker(AbstractBroker):
@@ -150,54 +1499,130 @@ class DirectBroker(AbstractBroker):
     loops in threads
 
     """
+    broker_type = BrokerType.DIRECT
+
+    def __init__(self, registration_address, wire_format=WireFormat.COMPACT, stats_address=None, flow=None):
+        """ Creates a direct broker instance
 
-    def __init__(self, registration_address):
+        :param str registration_address: the address to use by this broker for publishers
+            and subscribers to register with. Format: <scheme>://<ip_addr>:<port>
+        :param int wire_format: the newest wire format clients may use, below it the format
+            is negotiated per client. Optional. Default = WireFormat.COMPACT
+        :param str stats_address: the address to serve counters on. Optional.
+            Default = None. Format: <scheme>://<ip_addr>:<port>
+        :param FlowControl flow: the high-water mark and buffer size of the socket
+            publisher registrations are sent to subscribers on. Messages do not go
+            through the broker, so they are not dropped or blocked here, see the
+            publishers' flow control. Optional. Default = None, the ZMQ defaults
+        """
         # call super class constructor
-        super().__init__(registration_address)
+        super().__init__(registration_address, wire_format, stats_address)
 
-        # add data structure that maps a topic to a list of
-        # publisher addresses publishing on that topic
-        self.registry = defaultdict(list)
+        # maps a topic to the addresses of the publishers publishing on
+        # it, each once. A trie so that subscribers are sent the publishers
+        # of every topic their subscription matches as a prefix
+        self.registry = TopicTrie()
 
         # add socket that can publish newly registered publishers
-        # to registered subscribers
-        self.message_out = self.context.socket(zmq.PUB)
-        LOGGER.info(f"Created direct broker at {registration_address}")
+        # to registered subscribers. It is an XPUB so that serve can
+        # confirm that subscribers are connected
+        self.message_out = self.context.socket(zmq.XPUB)
+        if flow is not None:
+            flow.apply(self.message_out)
+        self.subscribers = set()
+        LOGGER.info("Created direct broker at %s", registration_address)
 
-    def process_pub_registration(self, topic, address):
+    def poll_sockets(self):
+        """ Returns the notification socket for `serve` to wait on
+
+        :return: list of sockets
+        """
+        return [self.message_out]
+
+    def process_ready(self, ready, max_batch):
+        """ Reads subscription events, which only matter for ready tokens
+
+        :param dict ready: the sockets that are ready, as returned by `zmq.Poller.poll`
+        :param int max_batch: the most events to handle
+        """
+        if self.message_out in ready:
+            for _ in range(max_batch):
+                try:
+                    self.process_ready_event(self.message_out.recv(zmq.NOBLOCK))
+                except zmq.Again:
+                    break
+
+    def process_pub_registrations(self, topics, address):
         """
         Adds a publisher's address to a dictionary topic and
-        send message to subscribers registered for that topic.
-        :param str topic: A string topic
+        send message to subscribers registered for each topic.
+        :param list topics: the string topics
         :param str address: the address of the publisher. String with
             format <scheme>://<ip_addr>:<port>
         """
-        # add publisher to map of topics to addresses
         encoded_address = address.encode('utf-8')
-        self.registry[topic].append(encoded_address)
+        for topic in topics:
+            # add publisher to map of topics to addresses
+            self.registry.add(topic, encoded_address)
 
-        # publish topic and address of new publisher to subscribers
-        self.message_out.send_string(topic, flags=zmq.SNDMORE)
-        self.message_out.send_string(address)
+            # publish topic and address of new publisher to subscribers
+            self.message_out.send_string(topic, flags=zmq.SNDMORE)
+            self.message_out.send_string(address)
 
         # Send broker type reply
-        self.registration.send_string(BrokerType.DIRECT)
+        self.send_reply(BrokerType.DIRECT)
 
-    def process_sub_registration(self, topic, address):
+    def process_sub_registrations(self, topics, address):
         """Connect subscriber address to socket that publishes new
         publisher connection information and send registration reply
 
-        :param str topic: A string topic
+        The reply lists the publishers of every topic, and of every topic
+        starting with one of them, each address once.
+
+        :param list topics: the string topics
         :param str address: the address of the subscriber. String with
             format <scheme>://<ip_addr>:<port>
         """
         # connect subscriber address to socket that publishes new
-        # publisher connection information
-        self.message_out.connect(address)
+        # publisher connection information, once per subscriber
+        if address not in self.subscribers:
+            self.subscribers.add(address)
+            self.message_out.connect(address)
+
+        self.reply_when_ready(lambda: self.send_addresses(topics))
+
+    def send_addresses(self, topics):
+        """ Replies to a subscriber registration with the publishers of its topics
+
+        The addresses are looked up when the reply is sent, so a reply held
+        until the subscriber is ready includes publishers registered meanwhile.
+        A topic matches the publishers of every topic it is a prefix of, as
+        subscriptions do on the message sockets, and a wildcard pattern those
+        of every topic it matches.
 
+        :param list topics: the string topics
+        """
         # send multipart message with broker type, number of addresses
         # being sent, and a list of addresses
-        self.registration.send_string(BrokerType.DIRECT, flags=zmq.SNDMORE)
-        has_addresses = b'\x00' if len(self.registry[topic]) == 0 else b'\x01'
-        messages = [has_addresses] + self.registry[topic]
-        self.registration.send_multipart(messages)
+        addresses = list(dict.fromkeys(address for topic in topics for address in self.lookup(topic)))
+        has_addresses = b'\x00' if len(addresses) == 0 else b'\x01'
+        messages = [has_addresses] + addresses
+        self.send_reply(BrokerType.DIRECT, messages)
+
+    def lookup(self, topic):
+        """ Returns the publishers of every topic a subscription matches
+
+        :param str topic: a topic, matched as a prefix, or a wildcard pattern
+        :return: list of bytes addresses
+        """
+        try:
+            pattern = is_pattern(topic)
+        except ValueError as error:
+            LOGGER.warning("Ignoring pattern: %s", error)
+            return []
+        if not pattern:
+            return self.registry.match(topic)
+
+        # every topic the pattern matches starts with its literal prefix
+        return [address for registered, addresses in self.registry.items(literal_prefix(topic))
+                if matches(topic, registered) for address in addresses]
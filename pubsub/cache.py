@@ -0,0 +1,70 @@
+from collections import OrderedDict
+
+
+class LastValueCache:
+    """ The latest message of each topic, bounded in topics and bytes
+
+    Messages are kept as the frames they were received as, so caching one does
+    not copy its payload, and are sent again as they are. When a bound is
+    exceeded the topics used least recently, by a message or by a snapshot,
+    are evicted first.
+    """
+
+    def __init__(self, max_topics=10000, max_bytes=64 << 20):
+        """ Creates an empty cache
+
+        :param int max_topics: the most topics kept. Optional. Default = 10000
+        :param int max_bytes: the most bytes of messages kept, a message larger
+            than this is not cached. Optional. Default = 64 MiB
+        """
+        self.max_topics = max_topics
+        self.max_bytes = max_bytes
+        self.messages = OrderedDict()
+        self.size = 0
+        self.evictions = 0
+
+    def put(self, topic, message):
+        """ Keeps a message as the latest of its topic
+
+        :param bytes topic: the topic of the message
+        :param list message: the frames of the message, as bytes or zmq.Frame
+        """
+        size = sum(map(len, message))
+        previous = self.messages.pop(topic, None)
+        if previous is not None:
+            self.size -= previous[1]
+        if size > self.max_bytes:
+            return
+
+        self.messages[topic] = (message, size)
+        self.size += size
+        while len(self.messages) > self.max_topics or self.size > self.max_bytes:
+            _, (_, evicted) = self.messages.popitem(last=False)
+            self.size -= evicted
+            self.evictions += 1
+
+    def get(self, topic):
+        """ Returns the latest message of a topic and marks the topic used
+
+        :param bytes topic: the topic
+        :return: list of frames, None if the topic has no cached message
+        """
+        entry = self.messages.get(topic)
+        if entry is None:
+            return None
+        self.messages.move_to_end(topic)
+        return entry[0]
+
+    def snapshot(self, topics):
+        """ Returns the latest message of each topic that has one
+
+        :param topics: bytes topics
+        :return: list of messages, each a list of frames
+        """
+        return [message for message in map(self.get, topics) if message is not None]
+
+    def __contains__(self, topic):
+        return topic in self.messages
+
+    def __len__(self):
+        return len(self.messages)
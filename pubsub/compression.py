@@ -0,0 +1,373 @@
+""" Payload compression per topic
+
+Small text and JSON payloads hardly compress on their own, there is too
+little in one message for its repetitions to show. A preset dictionary holding
+the strings common to a topic's messages, trained from samples of its traffic
+with `train_dictionary`, lets zlib refer back to them from the first byte.
+
+Compressed payloads are marked by flags in the compact header, see pubsub.util,
+and are raw streams without the container headers, which would outweigh the
+savings on small messages. A payload compressed with a dictionary starts with
+the 4 byte id of the dictionary, the CRC-32 of its bytes.
+
+Publishers send their dictionaries to the broker when they register, and
+subscribers receive the dictionaries of the topics they register in the reply.
+A subscriber that receives a message compressed with a dictionary it does not
+have, because the publisher registered after it, asks the broker for it.
+
+Decompressed payloads are limited to `max_size` bytes, so that a small
+malicious or corrupt payload cannot make a subscriber allocate without bound.
+"""
+import base64
+import heapq
+import lzma
+import struct
+import time
+import zlib
+from collections import Counter
+
+from pubsub.patterns import untag
+from pubsub.util import FLAG_DICTIONARY, FLAG_LZMA, FLAG_ZLIB
+
+ZLIB = "zlib"
+LZMA = "lzma"
+
+codec_flags = {ZLIB: FLAG_ZLIB, LZMA: FLAG_LZMA}
+
+DICTIONARY_ID = struct.Struct('<I')
+
+# Raw deflate streams, without the zlib header and checksum
+ZLIB_WBITS = -15
+
+# Raw LZMA streams carry no filter settings, so both ends use the same
+# dictionary size, which every preset leaves the other settings of alone. A
+# small one keeps the memory each decompression allocates down
+LZMA_DICT_SIZE = 1 << 16
+LZMA_FILTERS = [{"id": lzma.FILTER_LZMA2, "dict_size": LZMA_DICT_SIZE}]
+
+# zlib only looks back 32 KiB, so that is all of a dictionary it can use
+MAX_DICTIONARY_SIZE = 1 << 15
+
+# The largest payload decompressed by default
+MAX_DECOMPRESSED_SIZE = 1 << 26
+
+# Counters per topic, see Compression.statistics
+MESSAGES = "messages"
+COMPRESSED = "compressed"
+BYTES_IN = "bytes_in"
+BYTES_OUT = "bytes_out"
+SECONDS = "seconds"
+
+
+class TopicCompression:
+    """ How the payloads of a topic are compressed """
+    __slots__ = ("codec", "flags", "threshold", "level", "dictionary", "dictionary_id")
+
+    def __init__(self, codec=ZLIB, threshold=64, level=6, dictionary=None):
+        """ Creates the settings of a topic
+
+        :param str codec: ZLIB or LZMA. Optional. Default = ZLIB
+        :param int threshold: the size in bytes below which payloads are sent
+            uncompressed. Optional. Default = 64
+        :param int level: the compression level, 0 to 9. Optional. Default = 6
+        :param bytes dictionary: preset dictionary, see `train_dictionary`. Only
+            zlib supports one. Optional. Default = None
+        :raises ValueError: if the codec is unknown or does not support the dictionary
+        """
+        if codec not in codec_flags:
+            raise ValueError(f"Unknown compression codec \"{codec}\"")
+        if dictionary is not None and codec != ZLIB:
+            raise ValueError(f"Compression codec \"{codec}\" does not support preset dictionaries")
+
+        self.codec = codec
+        self.threshold = threshold
+        self.level = level
+        self.dictionary = dictionary
+        self.flags = codec_flags[codec]
+        self.dictionary_id = None
+        if dictionary is not None:
+            self.flags |= FLAG_DICTIONARY
+            self.dictionary_id = DICTIONARY_ID.pack(zlib.crc32(dictionary))
+
+
+class Compression:
+    """ Compresses and decompresses payloads, with settings per topic
+
+    Publishers only compress the topics configured with `configure`, or every
+    topic if a default is given. Decompressing needs no settings, only the
+    dictionaries of the topics, so subscribers decode whatever they receive.
+
+    The bytes before and after compression and the seconds spent are counted
+    per topic, see `statistics`, to tell which topics are worth compressing.
+    """
+
+    def __init__(self, default=None, samples=0, max_size=MAX_DECOMPRESSED_SIZE):
+        """ Creates compression settings
+
+        :param TopicCompression default: the settings of topics that are not
+            configured. Optional. Default = None, they are not compressed
+        :param int samples: the number of payloads kept per topic to train a
+            dictionary from. Optional. Default = 0, none
+        :param int max_size: the most bytes a payload decompresses to. Optional.
+            Default = 64 MiB
+        """
+        self.default = default
+        self.max_size = max_size
+        self.topics = {}
+        self.dictionaries = {}
+        if default is not None and default.dictionary is not None:
+            self.dictionaries[default.dictionary_id] = default.dictionary
+        self.counters = {}
+
+        self.max_samples = samples
+        self.samples = {}
+
+    def configure(self, topic, settings):
+        """ Sets how the payloads of a topic are compressed
+
+        :param str topic: the topic
+        :param TopicCompression settings: the settings, None to stop compressing the topic
+        """
+        if settings is None:
+            self.topics.pop(topic, None)
+            return
+        self.topics[topic] = settings
+        if settings.dictionary is not None:
+            self.dictionaries[settings.dictionary_id] = settings.dictionary
+
+    def settings(self, topic):
+        """ Returns how the payloads of a topic are compressed
+
+        :param str topic: the topic
+        :return: TopicCompression, None if they are not
+        """
+        return self.topics.get(topic, self.default)
+
+    def compress(self, topic, payload):
+        """ Compresses a payload if its topic is configured and it is large enough
+
+        Payloads that would not get smaller are sent as they are.
+
+        :param str topic: the topic of the payload
+        :param bytes payload: the encoded message or batch
+        :return: tuple of the header flags and the payload to send, 0 if it is not compressed
+        """
+        if self.max_samples and len(self.samples.setdefault(topic, [])) < self.max_samples:
+            self.samples[topic].append(bytes(payload))
+
+        settings = self.topics.get(topic, self.default)
+        if settings is None:
+            return 0, payload
+
+        counters = self.counters.get(topic) or self.counters.setdefault(topic, dict.fromkeys(
+            [MESSAGES, COMPRESSED, BYTES_IN, BYTES_OUT, SECONDS], 0))
+        counters[MESSAGES] += 1
+        counters[BYTES_IN] += len(payload)
+        if len(payload) < settings.threshold:
+            counters[BYTES_OUT] += len(payload)
+            return 0, payload
+
+        start = time.perf_counter()
+        if settings.codec == ZLIB:
+            if settings.dictionary is None:
+                compressor = zlib.compressobj(settings.level, zlib.DEFLATED, ZLIB_WBITS)
+            else:
+                compressor = zlib.compressobj(settings.level, zlib.DEFLATED, ZLIB_WBITS, zdict=settings.dictionary)
+            compressed = compressor.compress(payload) + compressor.flush()
+            if settings.dictionary_id is not None:
+                compressed = settings.dictionary_id + compressed
+        else:
+            compressed = lzma.compress(payload, format=lzma.FORMAT_RAW, filters=[
+                {"id": lzma.FILTER_LZMA2, "preset": settings.level, "dict_size": LZMA_DICT_SIZE}])
+        counters[SECONDS] += time.perf_counter() - start
+
+        if len(compressed) >= len(payload):
+            counters[BYTES_OUT] += len(payload)
+            return 0, payload
+        counters[COMPRESSED] += 1
+        counters[BYTES_OUT] += len(compressed)
+        return settings.flags, compressed
+
+    def decompress(self, topic, flags, payload):
+        """ Decompresses a payload
+
+        :param str topic: the topic of the payload, possibly tagged with a pattern
+        :param int flags: the flags of the compact header
+        :param payload: the compressed payload, as bytes or zmq.Frame
+        :return: bytes
+        :raises UnknownDictionaryError: if the payload was compressed with a dictionary
+            that has not been added
+        :raises PayloadTooLargeError: if the payload decompresses to more than `max_size` bytes
+        """
+        start = time.perf_counter()
+        data = memoryview(payload)
+        if flags & FLAG_ZLIB:
+            if flags & FLAG_DICTIONARY:
+                dictionary_id = bytes(data[:DICTIONARY_ID.size])
+                dictionary = self.dictionaries.get(dictionary_id)
+                if dictionary is None:
+                    raise UnknownDictionaryError(untag(topic)[1], DICTIONARY_ID.unpack(dictionary_id)[0])
+                decompressor = zlib.decompressobj(ZLIB_WBITS, zdict=dictionary)
+                data = data[DICTIONARY_ID.size:]
+            else:
+                decompressor = zlib.decompressobj(ZLIB_WBITS)
+            decompressed = decompressor.decompress(data, self.max_size + 1)
+            if not decompressor.unconsumed_tail and len(decompressed) <= self.max_size:
+                decompressed += decompressor.flush()
+        else:
+            decompressor = lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=LZMA_FILTERS)
+            decompressed = decompressor.decompress(data, self.max_size + 1)
+        if len(decompressed) > self.max_size:
+            raise PayloadTooLargeError(untag(topic)[1], self.max_size)
+
+        _, topic = untag(topic)
+        counters = self.counters.get(topic) or self.counters.setdefault(topic, dict.fromkeys(
+            [MESSAGES, COMPRESSED, BYTES_IN, BYTES_OUT, SECONDS], 0))
+        counters[MESSAGES] += 1
+        counters[COMPRESSED] += 1
+        counters[BYTES_IN] += len(decompressed)
+        counters[BYTES_OUT] += len(payload)
+        counters[SECONDS] += time.perf_counter() - start
+        return decompressed
+
+    def train(self, topic, size=1 << 14):
+        """ Trains a dictionary for a topic from its sampled payloads
+
+        The topic is not compressed with it until the settings returned are
+        passed to `configure`, which a publisher does once the broker has the
+        dictionary, see `Publisher.train_dictionary`. Sampling starts over.
+
+        :param str topic: the topic
+        :param int size: the most bytes in the dictionary. Optional. Default = 16 KiB
+        :return: TopicCompression with the settings of the topic and the dictionary
+        :raises ValueError: if no payloads of the topic were sampled
+        """
+        samples = self.samples.pop(topic, None)
+        if not samples:
+            raise ValueError(f"No payloads of topic \"{topic}\" were sampled")
+
+        settings = self.settings(topic) or TopicCompression()
+        return TopicCompression(ZLIB, settings.threshold, settings.level, train_dictionary(samples, size))
+
+    def export_dictionaries(self, topics):
+        """ Returns the dictionaries of topics, to send to the broker
+
+        :param list topics: string topics
+        :return: dict of topic to base64 encoded dictionary, for the topics that have one
+        """
+        exported = {}
+        for topic in topics:
+            settings = self.settings(topic)
+            if settings is not None and settings.dictionary is not None:
+                exported[topic] = encode_dictionary(settings.dictionary)
+        return exported
+
+    def add_dictionaries(self, dictionaries):
+        """ Adds dictionaries received from the broker for decompressing
+
+        :param dict dictionaries: topic to base64 encoded dictionary
+        """
+        for encoded in dictionaries.values():
+            dictionary = base64.b64decode(encoded)
+            self.dictionaries[DICTIONARY_ID.pack(zlib.crc32(dictionary))] = dictionary
+
+    def has_dictionary(self, dictionary_id):
+        """ Returns whether a dictionary was added
+
+        :param int dictionary_id: the id of the dictionary
+        :return: bool
+        """
+        return DICTIONARY_ID.pack(dictionary_id) in self.dictionaries
+
+    def statistics(self):
+        """ Returns the counters of every topic
+
+        For publishers bytes in are the encoded payloads and bytes out what was
+        sent, for subscribers bytes in are the decompressed payloads and bytes
+        out what was received. Only compressed messages are counted by
+        subscribers.
+
+        :return: dict of topic to counters, with the ratio of bytes in to bytes out
+        """
+        return {topic: dict(counters, ratio=counters[BYTES_IN] / counters[BYTES_OUT] if counters[BYTES_OUT] else 1.0)
+                for topic, counters in self.counters.items()}
+
+
+def encode_dictionary(dictionary):
+    """ Encodes a dictionary for the JSON options of a registration
+
+    :param bytes dictionary: the dictionary
+    :return: str
+    """
+    return base64.b64encode(dictionary).decode('ascii')
+
+
+def train_dictionary(samples, size=1 << 14, segment=64, match=8):
+    """ Builds a preset dictionary from sample payloads
+
+    A simplified version of the cover algorithm of zstd's trainer: the samples
+    are cut into overlapping segments, each scored by how many samples contain
+    each of its substrings of `match` bytes, and the best segments are picked
+    until the dictionary is full. Substrings in a picked segment no longer
+    count, so the dictionary covers as much of the samples' content as it can
+    rather than repeating the most common strings. Scores only go down as
+    segments are picked, so a segment is only scored again when it reaches
+    the top of the heap.
+
+    zlib encodes references to the end of the dictionary most cheaply, so the
+    best segments are placed last.
+
+    :param list samples: payloads, as bytes
+    :param int size: the most bytes in the dictionary, at most 32 KiB are used. Optional.
+        Default = 16 KiB
+    :param int segment: the length of the segments. Optional. Default = 64
+    :param int match: the length of the substrings segments are scored by. Optional. Default = 8
+    :return: bytes
+    """
+    size = min(size, MAX_DICTIONARY_SIZE)
+    counts = Counter()
+    for sample in samples:
+        counts.update({sample[index:index + match] for index in range(len(sample) - match + 1)})
+
+    covered = set()
+
+    def score(candidate):
+        return sum(counts[substring] for substring in
+                   {candidate[index:index + match] for index in range(len(candidate) - match + 1)}
+                   if substring not in covered)
+
+    heap = [(-score(sample[start:start + segment]), sample[start:start + segment])
+            for sample in samples for start in range(0, max(len(sample) - match + 1, 1), segment // 2)]
+    heapq.heapify(heap)
+
+    picked = []
+    total = 0
+    while heap and total < size:
+        _, candidate = heapq.heappop(heap)
+        current = score(candidate)
+        # a substring seen in a single sample is not worth the space
+        if current <= 1:
+            continue
+        if heap and current < -heap[0][0]:
+            heapq.heappush(heap, (-current, candidate))
+            continue
+        picked.append(candidate)
+        total += len(candidate)
+        covered.update(candidate[index:index + match] for index in range(len(candidate) - match + 1))
+    return b"".join(reversed(picked))[-size:]
+
+
+class UnknownDictionaryError(Exception):
+
+    def __init__(self, topic, dictionary_id):
+        self.topic = topic
+        self.dictionary_id = dictionary_id
+        super(Exception, self).__init__(f"No dictionary {dictionary_id:08x} for topic {topic}")
+
+
+class PayloadTooLargeError(Exception):
+
+    def __init__(self, topic, max_size):
+        self.topic = topic
+        self.max_size = max_size
+        super(Exception, self).__init__(f"Payload of topic {topic} decompresses to more than {max_size} bytes")
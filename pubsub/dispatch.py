@@ -0,0 +1,139 @@
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pubsub import LOGGER
+from pubsub.util import shard_for_topic
+
+
+class DispatchMode:
+    THREAD = "THREAD"
+    PROCESS = "PROCESS"
+
+
+def timed_call(callback, topic, message):
+    """ Calls the callback and returns how long it ran for
+
+    Module level so that it can be sent to a process pool.
+
+    :param callback: the function to call with the topic and message
+    :param str topic: the string topic of the message
+    :param message: the message content
+    :return: float number of seconds the callback took
+    """
+    start = time.perf_counter()
+    callback(topic, message)
+    return time.perf_counter() - start
+
+
+class Dispatcher:
+    """ Runs subscriber callbacks on a pool of workers
+
+    The pool is split into lanes, each of which is a single worker executor.
+    Every topic is assigned to one lane, so messages on the same topic are
+    delivered in the order they were received while different topics run
+    concurrently.
+
+    With DispatchMode.PROCESS the callback, topic and message are pickled,
+    so the callback must be a module level function.
+    """
+
+    def __init__(self, num_workers=4, mode=DispatchMode.THREAD, max_pending=None):
+        """ Creates a dispatcher
+
+        :param int num_workers: the number of lanes. Optional. Default = 4
+        :param str mode: DispatchMode.THREAD or DispatchMode.PROCESS. Optional.
+            Default = DispatchMode.THREAD
+        :param int max_pending: the number of callbacks that may be queued on a lane
+            before `submit` blocks. Optional. Default = None, no limit
+        """
+        executor_type = ProcessPoolExecutor if mode == DispatchMode.PROCESS else ThreadPoolExecutor
+        self.mode = mode
+        self.lanes = [executor_type(max_workers=1) for _ in range(num_workers)]
+        self.slots = [threading.BoundedSemaphore(max_pending) if max_pending else None
+                      for _ in range(num_workers)]
+
+        self.lock = threading.Lock()
+        self.depths = [0] * num_workers
+        self.max_depths = [0] * num_workers
+        self.callbacks = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.total_wait = 0.0
+
+    def submit(self, callback, topic, message):
+        """ Queues a callback on the lane for the topic
+
+        :param callback: the function to call with the topic and message
+        :param str topic: the string topic of the message
+        :param message: the message content
+        """
+        lane = shard_for_topic(topic, len(self.lanes))
+        if self.slots[lane] is not None:
+            self.slots[lane].acquire()
+
+        with self.lock:
+            self.depths[lane] += 1
+            self.max_depths[lane] = max(self.max_depths[lane], self.depths[lane])
+
+        queued = time.perf_counter()
+        future = self.lanes[lane].submit(timed_call, callback, topic, message)
+        future.add_done_callback(lambda done: self.complete(lane, queued, done))
+
+    def complete(self, lane, queued, future):
+        """ Records the result of a callback once it has run
+
+        :param int lane: the index of the lane the callback ran on
+        :param float queued: `time.perf_counter()` when the callback was submitted
+        :param future: the future of the callback
+        """
+        elapsed = time.perf_counter() - queued
+        # cancelled callbacks were never run, they only leave the queue
+        error = None if future.cancelled() else future.exception()
+
+        with self.lock:
+            self.depths[lane] -= 1
+            if not future.cancelled():
+                self.callbacks += 1
+            if error is not None:
+                self.errors += 1
+            elif not future.cancelled():
+                latency = future.result()
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+                self.total_wait += elapsed - latency
+
+        if self.slots[lane] is not None:
+            self.slots[lane].release()
+
+        if error is not None:
+            LOGGER.error("Callback failed: %r", error)
+
+    def statistics(self):
+        """ Returns queue depth and callback latency statistics
+
+        Latency is the time the callback itself ran for, wait is the time between
+        submitting it and it finishing minus the latency. Times are in seconds.
+
+        :return: dict of statistics
+        """
+        with self.lock:
+            completed = self.callbacks - self.errors
+            return {
+                "queue_depth": list(self.depths),
+                "max_queue_depth": list(self.max_depths),
+                "callbacks": self.callbacks,
+                "errors": self.errors,
+                "mean_latency": self.total_latency / completed if completed else 0.0,
+                "max_latency": self.max_latency,
+                "mean_wait": self.total_wait / completed if completed else 0.0,
+            }
+
+    def shutdown(self, wait=True):
+        """ Stops the workers
+
+        :param bool wait: wait for queued callbacks to finish. Optional. Default = True
+        """
+        for lane in self.lanes:
+            lane.shutdown(wait=wait)
+        LOGGER.info("Dispatcher statistics: %s", self.statistics())
@@ -0,0 +1,249 @@
+""" Flow control of the message sockets
+
+ZMQ queues at most a high-water mark of messages per connection, 1000 by
+default, and a PUB socket silently drops messages for a connection whose
+queue is full. `FlowControl` sets the high-water marks and kernel buffer sizes
+of a role's message sockets and decides, per topic, what happens when a queue
+is full: the message is dropped and counted, or the send blocks until there is
+room, slowing the sender down to what its subscribers keep up with.
+
+Sending sockets are XPUBs with XPUB_NODROP set, which makes a send fail
+instead of dropping silently, so every message dropped at a full queue is
+counted. A send fails if any subscriber matching the topic is full, so a slow
+subscriber makes a message dropped, or waited for, for every subscriber of the
+topic rather than only for itself.
+
+Receiving sockets never drop: once their high-water mark is reached they stop
+reading from the connection and the sender's queue fills up instead, so drops
+are counted where messages are sent, by publishers and routing brokers.
+
+Publishers may also be limited to a rate with a `TokenBucket`. Messages over
+the rate wait for a token or are dropped, as the topic's policy says.
+"""
+import time
+from collections import Counter
+
+import zmq
+
+DROP = "drop"
+BLOCK = "block"
+
+policies = (DROP, BLOCK)
+
+
+class TokenBucket:
+    """ Limits a rate of messages, allowing bursts
+
+    The bucket holds up to `burst` tokens and gains `rate` tokens a second.
+    Taking more tokens than it holds puts it in debt, which the next takers
+    wait for, so a batch larger than the burst is still let through.
+    """
+
+    def __init__(self, rate, burst=None):
+        """ Creates a full bucket
+
+        :param float rate: the tokens gained per second
+        :param float burst: the most tokens held. Optional. Default = one second of tokens
+        """
+        if rate <= 0:
+            raise ValueError(f"Rate must be positive, not {rate}")
+        self.rate = rate
+        self.burst = max(burst if burst is not None else rate, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        """ Adds the tokens gained since the last refill """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, count=1):
+        """ Takes tokens if the bucket has them
+
+        :param int count: the number of tokens. Optional. Default = 1
+        :return: True if they were taken
+        """
+        self.refill()
+        if self.tokens < min(count, self.burst):
+            return False
+        self.tokens -= count
+        return True
+
+    def acquire(self, count=1):
+        """ Takes tokens, sleeping until the bucket has them
+
+        :param int count: the number of tokens. Optional. Default = 1
+        :return: the seconds slept
+        """
+        self.refill()
+        self.tokens -= count
+        if self.tokens >= 0:
+            return 0.0
+        wait = -self.tokens / self.rate
+        time.sleep(wait)
+        return wait
+
+
+class FlowControl:
+    """ Socket options and the drop or block policy of a role's messages
+
+    Policies are set per topic prefix, the longest prefix of a topic decides.
+    Counters are kept per topic: messages dropped because a queue was full, or
+    by subscribers because they could not be decompressed, messages dropped
+    over the rate, and sends and rate limits that had to wait.
+    """
+
+    def __init__(self, sndhwm=None, rcvhwm=None, sndbuf=None, rcvbuf=None, policy=DROP, send_timeout=None,
+                 rate=None, burst=None):
+        """ Creates the flow control settings of a role
+
+        :param int sndhwm: the most messages queued per connection for sending, 0 for
+            no limit. Optional. Default = None, the ZMQ default of 1000
+        :param int rcvhwm: the most messages queued per connection on receipt, 0 for
+            no limit. Optional. Default = None, the ZMQ default of 1000
+        :param int sndbuf: the kernel send buffer size in bytes. Optional. Default = None,
+            the OS default
+        :param int rcvbuf: the kernel receive buffer size in bytes. Optional. Default = None,
+            the OS default
+        :param str policy: DROP or BLOCK, for topics without a policy of their own.
+            Optional. Default = DROP
+        :param float send_timeout: the most seconds a blocking send waits before the
+            message is dropped. Optional. Default = None, no limit
+        :param float rate: the most messages a second a publisher sends. Optional.
+            Default = None, no limit
+        :param float burst: the most messages sent at once over the rate. Optional.
+            Default = one second of messages
+        """
+        if policy not in policies:
+            raise ValueError(f"Unknown flow control policy \"{policy}\"")
+        self.sndhwm = sndhwm
+        self.rcvhwm = rcvhwm
+        self.sndbuf = sndbuf
+        self.rcvbuf = rcvbuf
+        self.send_timeout = send_timeout
+        self.default = policy
+        self.bucket = TokenBucket(rate, burst) if rate is not None else None
+
+        # Policies by topic prefix, and the policy of each topic seen, keyed by
+        # the topic as it was given, string or bytes
+        self.policies = {}
+        self.resolved = {}
+
+        self.dropped = Counter()
+        self.throttled = Counter()
+        self.blocked = Counter()
+
+    def set_policy(self, prefix, policy):
+        """ Sets the policy of the topics starting with a prefix
+
+        :param str prefix: the topic prefix
+        :param str policy: DROP or BLOCK
+        """
+        if policy not in policies:
+            raise ValueError(f"Unknown flow control policy \"{policy}\"")
+        self.policies[prefix] = policy
+        self.resolved.clear()
+
+    def policy(self, topic):
+        """ Returns the policy of a topic
+
+        :param topic: the topic, string or bytes
+        :return: DROP or BLOCK
+        """
+        policy = self.resolved.get(topic)
+        if policy is None:
+            name = topic.decode('utf-8', 'replace') if isinstance(topic, bytes) else topic
+            matching = [prefix for prefix in self.policies if name.startswith(prefix)]
+            policy = self.policies[max(matching, key=len)] if matching else self.default
+            self.resolved[topic] = policy
+        return policy
+
+    def apply_send(self, socket, send_timeout=None):
+        """ Configures a socket that messages are sent with `send`
+
+        Sets XPUB_NODROP so that a full queue makes the send fail, and the
+        message is counted as dropped or waited for, instead of being dropped
+        silently.
+
+        Must be called before the socket binds or connects.
+
+        :param socket: an XPUB socket
+        :param float send_timeout: the most seconds a blocking send waits if this flow
+            control has no send timeout. Optional. Default = None, no limit
+        """
+        self.apply(socket)
+        socket.setsockopt(zmq.XPUB_NODROP, 1)
+        timeout = self.send_timeout if self.send_timeout is not None else send_timeout
+        if timeout is not None:
+            socket.setsockopt(zmq.SNDTIMEO, int(timeout * 1000))
+
+    def apply(self, socket):
+        """ Sets the high-water marks and buffer sizes of a socket
+
+        Must be called before the socket binds or connects.
+
+        :param socket: a ZMQ socket
+        """
+        for option, value in [(zmq.SNDHWM, self.sndhwm), (zmq.RCVHWM, self.rcvhwm),
+                              (zmq.SNDBUF, self.sndbuf), (zmq.RCVBUF, self.rcvbuf)]:
+            if value is not None:
+                socket.setsockopt(option, value)
+
+    def admit(self, topic, count=1):
+        """ Applies the rate limit to messages about to be sent
+
+        :param topic: the topic, string or bytes
+        :param int count: the number of messages. Optional. Default = 1
+        :return: True if the messages may be sent, False if they were dropped
+        """
+        if self.bucket is None:
+            return True
+        if self.policy(topic) == BLOCK:
+            if self.bucket.acquire(count):
+                self.blocked[topic] += 1
+            return True
+        if self.bucket.try_acquire(count):
+            return True
+        self.throttled[topic] += count
+        return False
+
+    def send(self, socket, topic, frames, copy=True, count=1):
+        """ Sends a message as the policy of its topic says
+
+        :param socket: a socket configured with `apply_send`
+        :param topic: the topic the policy and counters are kept by, string or bytes
+        :param list frames: the frames of the message
+        :param bool copy: passed to send_multipart. Optional. Default = True
+        :param int count: the number of messages counted if it is dropped, more than
+            one for a batch. Optional. Default = 1
+        :return: True if the message was sent, False if it was dropped
+        """
+        try:
+            socket.send_multipart(frames, zmq.NOBLOCK, copy=copy)
+            return True
+        except zmq.Again:
+            if self.policy(topic) == DROP:
+                self.dropped[topic] += count
+                return False
+
+        self.blocked[topic] += 1
+        try:
+            socket.send_multipart(frames, copy=copy)
+            return True
+        except zmq.Again:
+            # the send timeout passed
+            self.dropped[topic] += count
+            return False
+
+    def statistics(self):
+        """ Returns the counters of every topic
+
+        :return: dict of string topic to a dict of counter name to count
+        """
+        counters = {}
+        for name, counter in [("dropped", self.dropped), ("throttled", self.throttled), ("blocked", self.blocked)]:
+            for topic, count in counter.items():
+                key = topic.decode('utf-8', 'replace') if isinstance(topic, bytes) else topic
+                counters.setdefault(key, {"dropped": 0, "throttled": 0, "blocked": 0})[name] += count
+        return counters
@@ -0,0 +1,300 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import struct
+import threading
+from pubsub import LOGGER, PERF_LOGGER, default_formatter, perf_formatter
+
+
+class PerfMode:
+    TEXT = "TEXT"
+    RING = "RING"
+    BINARY = "BINARY"
+
+
+# One record per received message: latency, time received, topic length, message length
+PERF_RECORD = struct.Struct('<ddII')
+
+
+class PerfRing:
+    """ Fixed size binary buffer of per message performance records
+
+    Recording a message packs four numbers into a preallocated buffer, with no
+    string formatting and no I/O. When the buffer is full the oldest records
+    are overwritten. `dump` writes the records that are left to a file that
+    `read_perf_records` reads back.
+    """
+
+    def __init__(self, capacity=1 << 18):
+        """ Creates a ring buffer
+
+        :param int capacity: the number of records kept. Optional. Default = 262144
+        """
+        self.capacity = capacity
+        self.buffer = bytearray(capacity * PERF_RECORD.size)
+        self.written = 0
+        self.lock = threading.Lock()
+
+    def record(self, delta_time, time_recv, topic_size, message_size):
+        """ Records one received message
+
+        :param float delta_time: seconds between the message being sent and received
+        :param float time_recv: time the message was received
+        :param int topic_size: length of the topic
+        :param int message_size: length of the message
+        """
+        with self.lock:
+            offset = (self.written % self.capacity) * PERF_RECORD.size
+            self.written += 1
+        PERF_RECORD.pack_into(self.buffer, offset, delta_time, time_recv, topic_size, message_size)
+
+    @property
+    def overwritten(self):
+        """ The number of records lost because the buffer was full """
+        return max(0, self.written - self.capacity)
+
+    def data(self):
+        """ Returns the packed records in the buffer, oldest first
+
+        :return: bytes holding whole `PERF_RECORD` records
+        """
+        with self.lock:
+            count = min(self.written, self.capacity)
+            start = self.written % self.capacity if self.written > self.capacity else 0
+            return bytes(self.buffer[start * PERF_RECORD.size:count * PERF_RECORD.size] +
+                         self.buffer[:start * PERF_RECORD.size])
+
+    def records(self):
+        """ Returns the records in the buffer, oldest first
+
+        :return: list of (delta_time, time_recv, topic_size, message_size) tuples
+        """
+        return list(PERF_RECORD.iter_unpack(self.data()))
+
+    def dump(self, path):
+        """ Writes the records in the buffer to a file, oldest first
+
+        :param str path: the file to write
+        """
+        with open(path, 'wb') as file:
+            file.write(self.data())
+
+
+class PerfFile:
+    """ Binary file of per message performance records
+
+    Records are packed into a buffer that is appended to the file whenever it
+    is full, so every message is kept, unlike with `PerfRing`, without the cost
+    of formatting text. The file holds whole `PERF_RECORD` records and is read
+    with `read_perf_records`.
+    """
+
+    def __init__(self, path, buffer_records=4096):
+        """ Opens the file for appending
+
+        :param str path: the file to write
+        :param int buffer_records: the number of records written at a time. Optional. Default = 4096
+        """
+        self.file = open(path, 'ab')
+        self.buffer = bytearray(buffer_records * PERF_RECORD.size)
+        self.buffered = 0
+        self.capacity = buffer_records
+        self.lock = threading.Lock()
+
+    def record(self, delta_time, time_recv, topic_size, message_size):
+        """ Records one received message
+
+        :param float delta_time: seconds between the message being sent and received
+        :param float time_recv: time the message was received
+        :param int topic_size: length of the topic
+        :param int message_size: length of the message
+        """
+        with self.lock:
+            PERF_RECORD.pack_into(self.buffer, self.buffered * PERF_RECORD.size,
+                                  delta_time, time_recv, topic_size, message_size)
+            self.buffered += 1
+            if self.buffered == self.capacity:
+                self.file.write(self.buffer)
+                self.buffered = 0
+
+    def flush(self):
+        """ Writes the buffered records to the file """
+        with self.lock:
+            self.file.write(self.buffer[:self.buffered * PERF_RECORD.size])
+            self.buffered = 0
+            self.file.flush()
+
+    def close(self):
+        """ Writes the buffered records and closes the file """
+        self.flush()
+        self.file.close()
+
+
+def read_perf_records(path, start=0, end=None):
+    """ Reads a file written by `PerfRing.dump` or `PerfFile`
+
+    :param str path: the file to read
+    :param int start: the offset of the first byte to read, a multiple of
+        `PERF_RECORD.size`. Optional. Default = 0
+    :param int end: the offset after the last byte to read. Optional. Default = the end of the file
+    :return: iterator of (delta_time, time_recv, topic_size, message_size) tuples
+    """
+    with open(path, 'rb') as file:
+        file.seek(start)
+        data = file.read() if end is None else file.read(end - start)
+    # a file that is still being written may end with part of a record
+    return PERF_RECORD.iter_unpack(data[:len(data) - len(data) % PERF_RECORD.size])
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """ Queue handler that leaves formatting to the listener thread
+
+    The standard QueueHandler formats the message in the logging thread. Records
+    whose arguments are all strings, numbers or None, such as the performance
+    records, cannot change before the listener formats them, so they are passed
+    to it unformatted. Records with other arguments, which may be changed by the
+    logging thread in the meantime, are formatted here as the standard handler does.
+    """
+    IMMUTABLE = (str, bytes, int, float, type(None))
+
+    def prepare(self, record):
+        if record.args and not (isinstance(record.args, tuple) and
+                                all(isinstance(arg, self.IMMUTABLE) for arg in record.args)):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+# The listener, ring buffer and binary file set up by configure_logging, if any
+listener = None
+perf_ring = None
+perf_ring_file = None
+perf_file = None
+
+
+def configure_logging(log_file='pubsub.log', perf_log_file='pubsub_perf.log', level=logging.INFO,
+                      perf_mode=PerfMode.TEXT, ring_capacity=1 << 18):
+    """ Sends the package's logs to files through a background thread
+
+    Nothing is logged until this is called. Log calls put records on a queue and
+    a listener thread formats them and writes them to the files.
+
+    In PerfMode.TEXT the per message performance log is written as text lines
+    to `perf_log_file`, the format read by latency_analysis.py. In PerfMode.RING
+    it is kept in a `PerfRing` that is written to `perf_log_file` by
+    `stop_logging`, which is also called at exit. In PerfMode.BINARY every
+    record is appended to `perf_log_file` through a `PerfFile`.
+
+    :param str log_file: the application log file. None to not write it. Optional.
+        Default = 'pubsub.log'
+    :param str perf_log_file: the performance log file. None to not record
+        performance. Optional. Default = 'pubsub_perf.log'
+    :param int level: the level of the application log. Optional. Default = logging.INFO
+    :param str perf_mode: PerfMode.TEXT, PerfMode.RING or PerfMode.BINARY. Optional.
+        Default = PerfMode.TEXT
+    :param int ring_capacity: the number of records kept in PerfMode.RING. Optional.
+        Default = 262144
+    """
+    global listener, perf_ring, perf_ring_file, perf_file
+    stop_logging()
+
+    handlers = []
+    if log_file is not None:
+        handler = logging.FileHandler(log_file)
+        handler.setFormatter(default_formatter)
+        handler.addFilter(lambda record: record.name == LOGGER.name)
+        handlers.append(handler)
+        LOGGER.setLevel(level)
+
+    if perf_log_file is not None and perf_mode == PerfMode.TEXT:
+        handler = logging.FileHandler(perf_log_file)
+        handler.setFormatter(perf_formatter)
+        handler.addFilter(lambda record: record.name == PERF_LOGGER.name)
+        handlers.append(handler)
+        PERF_LOGGER.setLevel(logging.INFO)
+    elif perf_log_file is not None and perf_mode == PerfMode.RING:
+        perf_ring = PerfRing(ring_capacity)
+        perf_ring_file = perf_log_file
+    elif perf_log_file is not None and perf_mode == PerfMode.BINARY:
+        perf_file = PerfFile(perf_log_file)
+
+    if handlers:
+        records = queue.SimpleQueue()
+        queue_handler = DeferredQueueHandler(records)
+        for logger in [LOGGER, PERF_LOGGER]:
+            logger.addHandler(queue_handler)
+        listener = logging.handlers.QueueListener(records, *handlers)
+        listener.start()
+
+
+def stop_logging():
+    """ Writes out everything logged so far and removes the handlers added by
+    `configure_logging`
+    """
+    global listener, perf_ring, perf_ring_file, perf_file
+    if perf_file is not None:
+        perf_file.close()
+        perf_file = None
+
+    if perf_ring is not None:
+        perf_ring.dump(perf_ring_file)
+        if perf_ring.overwritten:
+            LOGGER.warning("%s performance records were overwritten", perf_ring.overwritten)
+        perf_ring = None
+        perf_ring_file = None
+
+    if listener is not None:
+        for logger in [LOGGER, PERF_LOGGER]:
+            for handler in list(logger.handlers):
+                if isinstance(handler, DeferredQueueHandler):
+                    logger.removeHandler(handler)
+            logger.setLevel(logging.NOTSET)
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+        listener = None
+
+
+atexit.register(stop_logging)
+
+
+def perf_enabled():
+    """ Returns whether performance records are kept, so that callers can skip computing them
+
+    :return: bool
+    """
+    return perf_ring is not None or perf_file is not None or PERF_LOGGER.isEnabledFor(logging.INFO)
+
+
+def message_size(message):
+    """ Returns the length of a message for the performance log
+
+    :param message: the decoded message
+    :return: int length, 0 for messages without one, such as numbers and 0-d arrays
+    """
+    try:
+        return len(message)
+    except TypeError:
+        return 0
+
+
+def log_perf(delta_time, time_recv, topic_size, message_size):
+    """ Records the performance of one received message
+
+    Goes to the ring buffer in PerfMode.RING, the binary file in
+    PerfMode.BINARY, otherwise to the performance logger if it is enabled.
+    Does nothing when performance logging is off. Check `perf_enabled` first
+    to skip computing the arguments.
+
+    :param float delta_time: seconds between the message being sent and received
+    :param float time_recv: time the message was received
+    :param int topic_size: length of the topic
+    :param int message_size: length of the message
+    """
+    if perf_ring is not None:
+        perf_ring.record(delta_time, time_recv, topic_size, message_size)
+    elif perf_file is not None:
+        perf_file.record(delta_time, time_recv, topic_size, message_size)
+    elif PERF_LOGGER.isEnabledFor(logging.INFO):
+        PERF_LOGGER.info("%s, %s, %s, %s", delta_time, time_recv, topic_size, message_size)
@@ -0,0 +1,291 @@
+import json
+import math
+import time
+from collections import defaultdict
+import zmq
+
+# Names and values of the percentiles reported in summaries
+PERCENTILES = [("p50", 50), ("p99", 99), ("p999", 99.9)]
+
+
+class Histogram:
+    """ Log bucketed histogram of non-negative integer values
+
+    Like HdrHistogram, values below 2 ** precision_bits have a bucket each and
+    every power of two above that is split into 2 ** (precision_bits - 1)
+    buckets, so a value is always reported within 1 / 2 ** (precision_bits - 1)
+    of what was recorded (under 1% with the default of 8 bits) while the
+    number of buckets only grows with the log of the largest value.
+
+    Recording is a few integer operations and a list increment. Histograms
+    with the same precision can be merged by adding their counts.
+    """
+
+    def __init__(self, precision_bits=8):
+        """ Creates an empty histogram
+
+        :param int precision_bits: number of significant bits kept per value. Optional. Default = 8
+        """
+        self.precision_bits = precision_bits
+        self.linear = 1 << precision_bits
+        self.half = self.linear >> 1
+        self.counts = [0] * self.linear
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def index(self, value):
+        """ Returns the bucket index of a value
+
+        :param int value: a non-negative integer
+        :return: int index into `counts`
+        """
+        if value < self.linear:
+            return value
+        shift = value.bit_length() - self.precision_bits
+        return self.linear + (shift - 1) * self.half + (value >> shift) - self.half
+
+    def highest_equivalent(self, index):
+        """ Returns the largest value that is recorded in the bucket at index
+
+        :param int index: a bucket index
+        :return: int value
+        """
+        if index < self.linear:
+            return index
+        shift, offset = divmod(index - self.linear, self.half)
+        shift += 1
+        return ((self.half + offset + 1) << shift) - 1
+
+    def record(self, value, count=1):
+        """ Records a value
+
+        :param int value: a non-negative integer, negative values are recorded as 0
+        :param int count: the number of times to record it. Optional. Default = 1
+        """
+        if value < 0:
+            value = 0
+        index = self.index(value)
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] += count
+        self.count += count
+        self.total += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """ Adds the counts of another histogram to this one
+
+        :param Histogram other: a histogram with the same precision
+        """
+        if other.precision_bits != self.precision_bits:
+            raise ValueError(f"Cannot merge histograms with precision {other.precision_bits} "
+                             f"and {self.precision_bits}")
+        if len(other.counts) > len(self.counts):
+            self.counts.extend([0] * (len(other.counts) - len(self.counts)))
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percentile):
+        """ Returns the value below which the given percent of values fall
+
+        :param float percentile: a percentile between 0 and 100
+        :return: int value, 0 if nothing has been recorded
+        """
+        if self.count == 0:
+            return 0
+        # rounded first so that float error, as in 99.9 / 100, does not move the rank
+        target = max(1, math.ceil(round(self.count * percentile / 100, 6)))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self.highest_equivalent(index), self.max)
+        return self.max
+
+    def mean(self):
+        """ Returns the mean of the recorded values, 0 if nothing has been recorded """
+        return self.total / self.count if self.count else 0
+
+    def to_dict(self):
+        """ Returns the histogram as a JSON serializable dict with sparse counts
+
+        :return: dict read by `Histogram.from_dict`
+        """
+        return {
+            "precision_bits": self.precision_bits,
+            "count": self.count,
+            "total": self.total,
+            "min": self.min,
+            "max": self.max,
+            "counts": [[index, count] for index, count in enumerate(self.counts) if count],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """ Creates a histogram from the dict returned by `to_dict`
+
+        :param dict data: the exported histogram
+        :return: Histogram
+        """
+        histogram = cls(data["precision_bits"])
+        for index, count in data["counts"]:
+            if index >= len(histogram.counts):
+                histogram.counts.extend([0] * (index + 1 - len(histogram.counts)))
+            histogram.counts[index] = count
+        histogram.count = data["count"]
+        histogram.total = data["total"]
+        histogram.min = data["min"]
+        histogram.max = data["max"]
+        return histogram
+
+
+class TopicMetrics:
+    """ Latency and message size histograms per topic
+
+    Latency is recorded in microseconds and size in bytes. When an export file
+    or address is given, the histograms are exported every `interval` seconds
+    and then cleared, so each export covers one interval. Exports are driven by
+    `record`, so nothing runs in the background and no locking is needed.
+
+    Every export is one JSON object holding the time, the interval and for each
+    topic p50, p99, p999, max and the count in seconds and bytes, followed by
+    the histograms themselves so that exports can be merged with `read_exports`.
+    It is appended as a line to the export file and/or published on a PUB
+    socket bound to the export address with the topic "metrics".
+
+    At most `max_topics` topics are kept per interval. Messages of further
+    topics are recorded together under the topic OTHER_TOPIC, so a subscriber
+    receiving many distinct topics keeps bounded memory.
+    """
+    EXPORT_TOPIC = b"metrics"
+    OTHER_TOPIC = "<other>"
+
+    def __init__(self, export_file=None, export_address=None, interval=10.0, precision_bits=8, max_topics=10000):
+        """ Creates an empty set of histograms
+
+        :param str export_file: the file to append exports to. Optional. Default = None
+        :param str export_address: the address to publish exports on. Optional. Default = None
+        :param float interval: seconds between exports. Optional. Default = 10
+        :param int precision_bits: number of significant bits kept per value. Optional. Default = 8
+        :param int max_topics: the most topics kept before recording under OTHER_TOPIC.
+            Optional. Default = 10000
+        """
+        if max_topics < 1:
+            raise ValueError(f"max_topics must be positive, not {max_topics}")
+        self.precision_bits = precision_bits
+        self.max_topics = max_topics
+        self.latency = defaultdict(self.new_histogram)
+        self.size = defaultdict(self.new_histogram)
+
+        self.export_file = export_file
+        self.export_socket = None
+        if export_address is not None:
+            self.export_socket = zmq.Context.instance().socket(zmq.PUB)
+            self.export_socket.bind(export_address)
+
+        self.interval = interval
+        self.interval_start = time.time()
+        self.exporting = export_file is not None or export_address is not None
+
+    def new_histogram(self):
+        return Histogram(self.precision_bits)
+
+    def record(self, topic, latency, size, now):
+        """ Records one received message and exports if the interval has passed
+
+        :param str topic: the topic of the message
+        :param float latency: seconds between the message being sent and received
+        :param int size: the length of the message
+        :param float now: the time the message was received
+        """
+        if topic not in self.latency and len(self.latency) >= self.max_topics:
+            topic = self.OTHER_TOPIC
+        self.latency[topic].record(int(latency * 1000000))
+        self.size[topic].record(size)
+
+        if self.exporting and now - self.interval_start >= self.interval:
+            self.export(now)
+
+    def summary(self):
+        """ Returns count, p50, p99, p999 and max per topic
+
+        :return: dict of topic to a dict with the count, "latency" in seconds
+            and "size" in bytes
+        """
+        summary = {}
+        for topic, latency in self.latency.items():
+            size = self.size[topic]
+            summary[topic] = {
+                "count": latency.count,
+                "latency": {name: latency.percentile(percentile) / 1000000
+                            for name, percentile in PERCENTILES},
+                "size": {name: size.percentile(percentile) for name, percentile in PERCENTILES},
+            }
+            summary[topic]["latency"]["max"] = latency.max / 1000000
+            summary[topic]["size"]["max"] = size.max
+        return summary
+
+    def export(self, now=None):
+        """ Exports the histograms and clears them
+
+        :param float now: the end of the interval. Optional. Default = the current time
+        """
+        now = time.time() if now is None else now
+        data = {
+            "time": now,
+            "interval": now - self.interval_start,
+            "summary": self.summary(),
+            "histograms": {topic: {"latency": self.latency[topic].to_dict(), "size": self.size[topic].to_dict()}
+                           for topic in self.latency},
+        }
+        line = json.dumps(data, separators=(',', ':'))
+
+        if self.export_file is not None:
+            with open(self.export_file, 'a') as file:
+                file.write(line + "\n")
+        if self.export_socket is not None:
+            self.export_socket.send_multipart([self.EXPORT_TOPIC, line.encode('utf-8')])
+
+        self.latency.clear()
+        self.size.clear()
+        self.interval_start = now
+
+    def close(self):
+        """ Exports what has been recorded since the last export and closes the socket """
+        if self.exporting and self.latency:
+            self.export()
+        if self.export_socket is not None:
+            self.export_socket.close(linger=1000)
+            self.export_socket = None
+
+
+def read_exports(path):
+    """ Reads a file written by `TopicMetrics` and merges every interval
+
+    :param str path: the export file
+    :return: tuple of two dicts of topic to Histogram, latency in microseconds and size in bytes
+    """
+    latency = {}
+    size = {}
+    with open(path) as file:
+        for line in file:
+            if not line.strip():
+                continue
+            for topic, histograms in json.loads(line)["histograms"].items():
+                for merged, name in [(latency, "latency"), (size, "size")]:
+                    histogram = Histogram.from_dict(histograms[name])
+                    if topic in merged:
+                        merged[topic].merge(histogram)
+                    else:
+                        merged[topic] = histogram
+    return latency, size
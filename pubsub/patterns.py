@@ -0,0 +1,205 @@
+""" Wildcard topic patterns
+
+Topics are split into segments by "/". In a pattern, a "*" segment matches
+exactly one segment and a "#" segment, which must be the last one, matches
+any number of segments, none included. So "plant/*/temperature" matches
+"plant/boiler/temperature" and "plant/#" matches "plant" and "plant/boiler/pressure".
+
+ZMQ subscriptions only match prefixes, so a routing broker sends each message
+that matches a pattern a second time with the pattern tagged in front of the
+topic. Subscribers to the pattern subscribe to the tag and strip it again.
+"""
+
+SEPARATOR = "/"
+SINGLE = "*"
+MULTI = "#"
+
+# Tagged topics start with a byte no topic or subscription starts with and end
+# the pattern with a byte no topic contains, so a tag only matches itself
+TAG_START = "\x01"
+TAG_END = "\x00"
+
+
+def is_pattern(topic):
+    """ Returns whether a topic has wildcard segments
+
+    :param str topic: a topic or a pattern
+    :return: bool
+    """
+    if SINGLE not in topic and MULTI not in topic:
+        return False
+    segments = topic.split(SEPARATOR)
+    if MULTI in segments[:-1]:
+        raise ValueError(f"\"{MULTI}\" must be the last segment of pattern \"{topic}\"")
+    return SINGLE in segments or segments[-1] == MULTI
+
+
+def literal_prefix(pattern):
+    """ Returns the part of a pattern before its first wildcard
+
+    Every topic the pattern matches starts with it, so it is what a ZMQ socket
+    subscribes to where nothing filters by the pattern.
+
+    :param str pattern: the pattern
+    :return: str
+    """
+    literal = []
+    for segment in pattern.split(SEPARATOR):
+        if segment == SINGLE:
+            # the wildcard still needs a segment after the separator
+            return "".join(literal_segment + SEPARATOR for literal_segment in literal)
+        if segment == MULTI:
+            break
+        literal.append(segment)
+    return SEPARATOR.join(literal)
+
+
+def tag(pattern):
+    """ Returns the tag subscribers to a pattern subscribe to
+
+    :param str pattern: the pattern
+    :return: bytes
+    """
+    return (TAG_START + pattern + TAG_END).encode('utf-8')
+
+
+def untag(topic):
+    """ Splits a tagged topic into its pattern and topic
+
+    :param str topic: a topic received on a message socket
+    :return: tuple of the pattern and the topic, the pattern is None if the topic is not tagged
+    """
+    if not topic.startswith(TAG_START):
+        return None, topic
+    pattern, _, topic = topic[1:].partition(TAG_END)
+    return pattern, topic
+
+
+class PatternNode:
+    """ Node of a `PatternIndex`, one per pattern segment """
+    __slots__ = ("children", "patterns")
+
+    def __init__(self):
+        self.children = {}
+        self.patterns = []
+
+
+class PatternIndex:
+    """ Segment trie of patterns with the matches of each topic memoized
+
+    Matching a topic follows its segments down the trie, taking the literal,
+    "*" and "#" branches at each level, so it costs the depth of the topic
+    rather than the number of patterns. The matches of a topic are memoized
+    until a pattern is added or removed, so a stream of messages on the same
+    topics is a dict lookup per message however many patterns there are.
+    """
+
+    def __init__(self, memo_size=1 << 16):
+        """ Creates an empty index
+
+        :param int memo_size: the most topics whose matches are kept. Optional. Default = 65536
+        """
+        self.root = PatternNode()
+        self.patterns = set()
+        self.memo = {}
+        self.memo_size = memo_size
+
+    def add(self, pattern):
+        """ Adds a pattern
+
+        :param str pattern: the pattern
+        :return: True if the pattern was added, False if it was already there
+        """
+        if pattern in self.patterns:
+            return False
+        if not is_pattern(pattern):
+            raise ValueError(f"\"{pattern}\" has no wildcard segments")
+
+        node = self.root
+        for segment in pattern.split(SEPARATOR):
+            child = node.children.get(segment)
+            if child is None:
+                child = node.children[segment] = PatternNode()
+            node = child
+        node.patterns.append(pattern)
+        self.patterns.add(pattern)
+        self.memo.clear()
+        return True
+
+    def remove(self, pattern):
+        """ Removes a pattern
+
+        :param str pattern: the pattern
+        :return: True if the pattern was removed, False if it was not there
+        """
+        if pattern not in self.patterns:
+            return False
+
+        path = [self.root]
+        for segment in pattern.split(SEPARATOR):
+            path.append(path[-1].children[segment])
+        path[-1].patterns.remove(pattern)
+
+        # drop the nodes left without patterns or children
+        for segment, parent, node in zip(reversed(pattern.split(SEPARATOR)), reversed(path[:-1]), reversed(path)):
+            if node.patterns or node.children:
+                break
+            del parent.children[segment]
+
+        self.patterns.discard(pattern)
+        self.memo.clear()
+        return True
+
+    def match(self, topic):
+        """ Returns the patterns a topic matches
+
+        :param str topic: a topic without wildcards
+        :return: tuple of patterns
+        """
+        matched = self.memo.get(topic)
+        if matched is not None:
+            return matched
+
+        segments = topic.split(SEPARATOR)
+        found = []
+        stack = [(self.root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            multi = node.children.get(MULTI)
+            if multi is not None:
+                found.extend(multi.patterns)
+            if depth == len(segments):
+                found.extend(node.patterns)
+                continue
+            for segment in (segments[depth], SINGLE):
+                child = node.children.get(segment)
+                if child is not None:
+                    stack.append((child, depth + 1))
+
+        matched = tuple(found)
+        if len(self.memo) >= self.memo_size:
+            self.memo.clear()
+        self.memo[topic] = matched
+        return matched
+
+    def __contains__(self, pattern):
+        return pattern in self.patterns
+
+    def __len__(self):
+        return len(self.patterns)
+
+
+def matches(pattern, topic):
+    """ Returns whether a topic matches one pattern
+
+    :param str pattern: the pattern
+    :param str topic: a topic without wildcards
+    :return: bool
+    """
+    segments = topic.split(SEPARATOR)
+    for depth, segment in enumerate(pattern.split(SEPARATOR)):
+        if segment == MULTI:
+            return True
+        if depth == len(segments) or segment != SINGLE and segment != segments[depth]:
+            return False
+    return len(segments) == len(pattern.split(SEPARATOR))
@@ -1,9 +1,12 @@
-import struct
 import time
+from collections import defaultdict
 import zmq
 import pubsub
 from pubsub import LOGGER
-from pubsub.util import MessageType, TopicNotRegisteredError
+from pubsub.compression import encode_dictionary
+from pubsub.registration import PendingRegistrations
+from pubsub.util import MessageType, TopicNotRegisteredError, WireFormat, get_codec, pack_batch, pack_envelope, \
+    pack_options, pack_topics, split_reply
 
 
 class Publisher:
@@ -16,49 +19,248 @@ class Publisher:
     publisher = Publisher("http://127.0.0.1:5555")
     publisher.register("topic1", "http://127.0.0.1:5556")
     publisher.publish("topic1", "message goes here")
+
+    Messages can also be batched so that many of them travel in one ZMQ message,
+    either explicitly with `publish_batch` or automatically by constructing the
+    publisher with a batch size and/or age. Subscribers unbatch them transparently.
+
+    Payloads of single frames, messages and batches, can be compressed per
+    topic, see pubsub.compression. Compression needs the compact wire format,
+    in the legacy format payloads are always sent as they are.
+
+    With flow control, see pubsub.flow, messages that find a subscriber's queue
+    full are dropped and counted, or wait for room, as their topic's policy
+    says, and publishing can be limited to a rate.
     """
     ctx = zmq.Context()
 
-    def __init__(self, address, registration_address):
+    def __init__(self, address, registration_address, batch_size=1, batch_age=None, wire_format=WireFormat.COMPACT,
+                 ready_timeout=5.0, compression=None, flow=None):
         """ Creates a publisher instance
 
         :param str address: the address of this publisher. String with format <scheme>://<ip_addr>:<port>
         :param str registration_address: address of the broker with which this publisher
             registers topics. String with format <scheme>://<ip_addr>:<port>
+        :param int batch_size: the number of messages `publish` collects per topic and message type
+            before sending them as one batch. Optional. Default = 1 (no batching)
+        :param float batch_age: the number of seconds after which a pending batch is sent by the
+            next call to `publish`, even if it is not full. Optional. Default = None (no age limit)
+        :param int wire_format: the newest wire format this publisher offers the broker at registration.
+            Optional. Default = WireFormat.COMPACT
+        :param float ready_timeout: the most seconds `register` waits for a routing broker to
+            subscribe to this publisher. Optional. Default = 5 seconds
+        :param Compression compression: the topics to compress and how. Optional.
+            Default = None, nothing is compressed
+        :param FlowControl flow: the high-water mark, buffer size, rate limit and
+            policy per topic of the message socket. Optional. Default = None, the ZMQ
+            defaults, with messages dropped silently
         """
         self.address = address
         self.topics = []
-        self.message_pub = self.ctx.socket(zmq.PUB)
+        self.batch_size = batch_size
+        self.ready_timeout = ready_timeout
+        self.broker_type = None
+        self.batch_age = batch_age
+        self.compression = compression
+        self.flow = flow
+
+        # pending batches keyed by (topic, message type), each a list of
+        # (time published, message) tuples
+        self.batches = {}
+
+        # An XPUB sends like a PUB but also reports subscriptions, so that this
+        # publisher knows when the broker or subscribers are connected. Verbose
+        # so that every subscriber's subscription is reported, not only the first
+        self.message_pub = self.ctx.socket(zmq.XPUB)
+        self.message_pub.setsockopt(zmq.XPUB_VERBOSE, 1)
+        if flow is not None:
+            flow.apply_send(self.message_pub)
         self.message_pub.bind(address)
 
-        self.registration = self.ctx.socket(zmq.REQ)
+        # Number of subscriptions per topic prefix, read from the XPUB
+        self.subscriptions = defaultdict(int)
+
+        # Registrations are sent on a DEALER so that several can be in flight,
+        # see PendingRegistrations
+        self.registration = self.ctx.socket(zmq.DEALER)
         self.registration.connect(registration_address)
+        self.requests = PendingRegistrations(self.registration)
 
-        self.type2sender = {MessageType.STRING: self.message_pub.send_string,
-                            MessageType.PYOBJ: self.message_pub.send_pyobj,
-                            MessageType.JSON: self.message_pub.send_json}
+        # Messages are sent in the legacy format until the broker agrees to a
+        # newer one at registration
+        self.wire_formats = list(range(WireFormat.LEGACY, wire_format + 1))
+        self.wire_format = WireFormat.LEGACY
 
-        LOGGER.info(f"Bound to {address}. Registering with broker at {registration_address}.")
+        LOGGER.info("Bound to %s. Registering with broker at %s.", address, registration_address)
 
-    def register(self, topic):
+    def register(self, topic, wait=True):
         """ Register a topic and address with the broker
 
         Registering a topic tells the broker to expect messages about `topic`
         to be published by this publisher. This method must be called before publishing
         an messages about the topic on the address.
 
+        With `wait` False the registration is only sent, so that several can be
+        in flight at once. The reply is handled when the returned future, or any
+        later one, is waited on, or by `process_replies`. Replies must be handled
+        in the thread that registers.
+
+        :param str topic: a string topic
+        :param bool wait: whether to wait for the reply. Optional. Default = True
+        :return: RegistrationFuture with the broker type as its result
+        """
+        LOGGER.info("Publisher registering for topic %s at address %s", topic, self.address)
+        return self.send_registration(pubsub.REG_PUB, topic.encode('utf-8'), [topic], wait)
+
+    def register_many(self, topics, wait=True):
+        """ Registers several topics with the broker in one round trip
+
+        Same as calling `register` for each topic, but the broker handles all
+        of them in one request.
+
+        :param list topics: the string topics
+        :param bool wait: whether to wait for the reply. Optional. Default = True
+        :return: RegistrationFuture with the broker type as its result, None if there are no topics
+        """
+        if not topics:
+            return None
+
+        LOGGER.info("Publisher registering for %s topics at address %s", len(topics), self.address)
+        return self.send_registration(pubsub.REG_PUB_MANY, pack_topics(topics), topics, wait)
+
+    def process_replies(self):
+        """ Handles the replies to registrations that have arrived, without blocking
+
+        :return: the number of replies handled
+        """
+        return self.requests.process_replies()
+
+    def send_registration(self, reg_type, topic_frame, topics, wait=True, trained=None):
+        """ Sends a registration
+
+        The preset dictionaries of the topics are sent along, for the broker to
+        pass on to subscribers.
+
+        :param str reg_type: REGISTER_PUBLISHER or REGISTER_PUBLISHER_MANY
+        :param bytes topic_frame: the topic frame of the request
+        :param list topics: the string topics being registered
+        :param bool wait: whether to wait for the reply. Optional. Default = True
+        :param dict trained: topic to TopicCompression settings with a new dictionary,
+            applied once the broker has the dictionary. Optional. Default = None
+        :return: RegistrationFuture
+        """
+        registered = set(self.topics)
+        self.topics.extend(topic for topic in topics if topic not in registered)
+
+        options = {"wire_formats": self.wire_formats}
+        if self.compression is not None:
+            dictionaries = self.compression.export_dictionaries(topics)
+            for topic, settings in (trained or {}).items():
+                dictionaries[topic] = encode_dictionary(settings.dictionary)
+            if dictionaries:
+                options["dictionaries"] = dictionaries
+
+        future = self.requests.send([reg_type.encode('utf-8'),
+                                     topic_frame,
+                                     self.address.encode('utf-8'),
+                                     pack_options(options)],
+                                    lambda reply: self.handle_reply(reply, topics, trained))
+        if wait:
+            future.result()
+        return future
+
+    def handle_reply(self, reply, topics, trained=None):
+        """ Applies the reply to a registration
+
+        :param list reply: the frames of the reply
+        :param list topics: the string topics that were registered
+        :param dict trained: topic to TopicCompression settings to apply. Optional. Default = None
+        :return: the broker type
+        """
+        broker_type, options, _ = split_reply(reply)
+        for topic, settings in (trained or {}).items():
+            self.compression.configure(topic, settings)
+        self.broker_type = broker_type
+        self.wire_format = options.get("wire_format", WireFormat.LEGACY)
+
+        # Messages published before the broker has subscribed would be dropped.
+        # A routing broker only subscribes to topics subscribers want
+        subscribed = topics if options.get("subscribes") else options.get("subscribed", [])
+        if subscribed and not self.wait_for_subscribers(1, self.ready_timeout, subscribed):
+            LOGGER.warning("Broker did not subscribe to topics %s within %s seconds", subscribed, self.ready_timeout)
+
+        LOGGER.info("Connected to %s broker using wire format %s", broker_type, self.wire_format)
+        return broker_type
+
+    def train_dictionary(self, topic, size=1 << 14, wait=True):
+        """ Trains a preset dictionary for a topic and sends it to the broker
+
+        The dictionary is trained from the payloads the compression settings
+        sampled, see `Compression`. The topic is registered again with the
+        dictionary, and compressed with it once the broker has replied, so that
+        subscribers can always get it from the broker.
+
+        :param str topic: a registered string topic
+        :param int size: the most bytes in the dictionary. Optional. Default = 16 KiB
+        :param bool wait: whether to wait for the reply. Optional. Default = True
+        :return: RegistrationFuture with the broker type as its result
+        :raises ValueError: if no payloads of the topic were sampled
+        """
+        if topic not in self.topics:
+            raise TopicNotRegisteredError(topic, self.address, "Topic has not been registered with publisher. Cannot "
+                                                               "train a dictionary")
+
+        settings = self.compression.train(topic, size)
+        LOGGER.info("Trained a dictionary of %s bytes for topic %s", len(settings.dictionary), topic)
+        return self.send_registration(pubsub.REG_PUB, topic.encode('utf-8'), [topic], wait, {topic: settings})
+
+    def read_subscriptions(self):
+        """ Reads the subscription events that have arrived without blocking
+
+        Subscribing is reported by every subscriber, unsubscribing only by the
+        last one, so an unsubscription clears the count of the topic prefix.
+        """
+        while True:
+            try:
+                event = self.message_pub.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            if event[:1] == b'\x01':
+                self.subscriptions[event[1:]] += 1
+            else:
+                self.subscriptions.pop(event[1:], None)
+
+    def count_subscribers(self, topic):
+        """ Returns the number of subscriptions that match a topic
+
         :param str topic: a string topic
+        :return: int count, from the events read so far
         """
-        LOGGER.info(f"Publisher registering for topic {topic} at address {self.address}")
+        encoded = topic.encode('utf-8')
+        return sum(count for prefix, count in self.subscriptions.items() if encoded.startswith(prefix))
 
-        self.topics.append(topic)
+    def wait_for_subscribers(self, count=1, timeout=None, topics=None):
+        """ Waits until enough subscribers have subscribed to every topic
 
-        self.registration.send_string(pubsub.REG_PUB, flags=zmq.SNDMORE)
-        self.registration.send_string(topic, flags=zmq.SNDMORE)
-        self.registration.send_string(self.address)
+        With a routing broker the broker is the only subscriber, and `register`
+        already waits for it. With a direct broker, this waits for subscribers to
+        connect instead of sleeping before publishing.
 
-        broker_type = self.registration.recv_string()
-        LOGGER.info(f"Connected to {broker_type} broker")
+        :param int count: the number of subscriptions to wait for. Optional. Default = 1
+        :param float timeout: the most seconds to wait. Optional. Default = None, no limit
+        :param list topics: the topics to wait for. Optional. Default = every registered topic
+        :return: True if every topic has enough subscriptions, False if the timeout passed first
+        """
+        topics = self.topics if topics is None else topics
+        deadline = None if timeout is None else time.time() + timeout
+        self.read_subscriptions()
+        while any(self.count_subscribers(topic) < count for topic in topics):
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                return False
+            if self.message_pub.poll(None if remaining is None else remaining * 1000):
+                self.read_subscriptions()
+        return True
 
     def publish(self, topic, message, message_type=MessageType.STRING):
         """ Publishes message with the given topic
@@ -66,18 +268,120 @@ class Publisher:
         :param str topic: the topic of the message to publish, should be a registered string
         :param str message: the message to publish
         :param str message_type: the type of the message to send. Optional. Default = MessageType.STRING
-            (valid values are MessageType.STRING, MessageType.PYOBJ, and MessageType.JSON)
+            (valid values are MessageType.STRING, MessageType.PYOBJ, MessageType.JSON and the names
+            of codecs registered with `pubsub.util.register_codec`)
+
+        If this publisher was constructed with a batch size or age, the message is
+        added to the pending batch for its topic instead of being sent right away.
+
+        With a rate limit, the message waits for the rate or is dropped, see
+        `FlowControl.admit`.
         """
 
         if topic not in self.topics:
             raise TopicNotRegisteredError(topic, self.address, "Topic has not been registered with publisher. Cannot "
                                                                "be published")
 
+        if self.flow is not None and not self.flow.admit(topic):
+            return
+
         time_sent = time.time()
-        time_sent_b = struct.pack('d', time_sent)
-        self.message_pub.send_string(topic, flags=zmq.SNDMORE)
-        self.message_pub.send(time_sent_b, flags=zmq.SNDMORE)
-        self.message_pub.send_string(message_type, flags=zmq.SNDMORE)
-        self.type2sender[message_type](message)
+        if self.batch_size > 1 or self.batch_age is not None:
+            self.add_to_batch(topic, message, message_type, time_sent)
+            return
 
-        LOGGER.info(f"Message sent at {time_sent} ({time_sent_b})")
+        payload = get_codec(message_type).encode_frames(message)
+        flags = 0
+        if self.compression is not None and self.wire_format == WireFormat.COMPACT and len(payload) == 1:
+            flags, compressed = self.compression.compress(topic, payload[0])
+            payload = [compressed]
+        self.send(topic, pack_envelope(topic, message_type, time_sent, payload, self.wire_format, flags=flags))
+
+        LOGGER.debug("Message sent at %s", time_sent)
+
+    def publish_batch(self, topic, messages, message_type=MessageType.STRING):
+        """ Publishes several messages with the given topic as one batch
+
+        All the messages travel in a single ZMQ message. Subscribers deliver them
+        to their callback one at a time, in order.
+
+        :param str topic: the topic of the messages to publish, should be a registered string
+        :param list messages: the messages to publish
+        :param str message_type: the type of every message in the batch. Optional.
+            Default = MessageType.STRING
+
+        An empty list of messages sends nothing.
+        """
+        if topic not in self.topics:
+            raise TopicNotRegisteredError(topic, self.address, "Topic has not been registered with publisher. Cannot "
+                                                               "be published")
+        if not messages:
+            return
+
+        if self.flow is not None and not self.flow.admit(topic, len(messages)):
+            return
+
+        time_sent = time.time()
+        self.send_batch(topic, [(time_sent, message) for message in messages], message_type)
+
+    def add_to_batch(self, topic, message, message_type, time_sent):
+        """ Adds a message to the pending batch for its topic and sends the
+        batch if it has reached the batch size or age limit
+        """
+        key = (topic, message_type)
+        batch = self.batches.setdefault(key, [])
+        batch.append((time_sent, message))
+
+        if len(batch) >= self.batch_size or \
+                (self.batch_age is not None and time_sent - batch[0][0] >= self.batch_age):
+            del self.batches[key]
+            self.send_batch(topic, batch, message_type)
+
+    def flush(self):
+        """ Sends all pending batches
+
+        When auto-batching, a batch that is not full is only sent by a later call
+        to `publish` once it is old enough. Call this method to send pending
+        messages right away, for example periodically or before exiting.
+        """
+        batches = self.batches
+        self.batches = {}
+        for (topic, message_type), batch in batches.items():
+            self.send_batch(topic, batch, message_type)
+
+    def send_batch(self, topic, batch, message_type):
+        """ Sends a batch of messages
+
+        In the legacy wire format the batch is sent as topic, the time the batch was
+        sent, MessageType.BATCH, the type of the messages and a payload holding every
+        message with the time it was published. In the compact format the batch flag
+        is set in the header instead.
+
+        :param str topic: the topic of the messages
+        :param list batch: list of (time published, message) tuples
+        :param str message_type: the type of every message in the batch
+        """
+        if not batch:
+            return
+        payload = pack_batch(batch, message_type)
+        flags = 0
+        if self.compression is not None and self.wire_format == WireFormat.COMPACT:
+            flags, payload = self.compression.compress(topic, payload)
+        self.send(topic, pack_envelope(topic, message_type, time.time(), [payload], self.wire_format, batch=True,
+                                       flags=flags), len(batch))
+
+        LOGGER.debug("Batch of %s messages sent on topic %s", len(batch), topic)
+
+    def send(self, topic, frames, count=1):
+        """ Sends a message, through the flow control if there is one
+
+        :param str topic: the topic of the message
+        :param list frames: the frames of the message
+        :param int count: the number of messages in it. Optional. Default = 1
+        """
+        # copy=False lets large payloads, such as array buffers, be sent without
+        # copying; ZMQ still copies small frames, where that is cheaper
+        if self.flow is None:
+            self.message_pub.send_multipart(frames, copy=False)
+        elif not self.flow.send(self.message_pub, topic, frames, False, count):
+            LOGGER.debug("Dropped %s messages on topic %s", count, topic)
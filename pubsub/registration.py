@@ -0,0 +1,111 @@
+import itertools
+import time
+from concurrent.futures import Future
+import zmq
+
+
+class RegistrationFuture(Future):
+    """ Future of a registration sent by `PendingRegistrations`
+
+    Replies are only received by a thread calling into the client, so waiting
+    on the result receives replies until this registration's reply arrives.
+    """
+
+    def __init__(self, requests):
+        """ Creates a future for a registration
+
+        :param PendingRegistrations requests: the registrations the reply is received by
+        """
+        super().__init__()
+        self.requests = requests
+
+    def result(self, timeout=None):
+        """ Waits for the reply and returns the result of handling it
+
+        :param float timeout: the most seconds to wait. Optional. Default = None, no limit
+        :return: what the reply handler returned
+        """
+        if not self.done():
+            self.requests.wait(self, timeout)
+        return super().result(0)
+
+
+class PendingRegistrations:
+    """ Registrations sent on a DEALER socket and not answered yet
+
+    Every request starts with a request ID and an empty delimiter, so a broker
+    sends replies back in whatever order it finishes the registrations and
+    each reply is matched to its request by the ID. Brokers with a REP socket
+    treat the ID as part of the envelope and return it as well.
+    """
+
+    def __init__(self, socket, watch=()):
+        """ Creates an empty set of registrations
+
+        :param socket: DEALER socket connected to the broker's registration address
+        :param watch: sockets whose events are read while waiting for a reply, so
+            they attach incoming connections. Optional. Default = none
+        """
+        self.socket = socket
+        self.watch = watch
+        self.request_ids = itertools.count()
+        self.pending = {}
+
+    def send(self, frames, handler):
+        """ Sends a registration without waiting for the reply
+
+        :param list frames: the frames of the registration
+        :param handler: function called with the frames of the reply, its
+            return value is the result of the future
+        :return: RegistrationFuture
+        """
+        request_id = str(next(self.request_ids)).encode('utf-8')
+        future = RegistrationFuture(self)
+        self.pending[request_id] = (future, handler)
+        self.socket.send_multipart([request_id, b""] + frames)
+        return future
+
+    def process_replies(self):
+        """ Handles the replies that have arrived without blocking
+
+        :return: the number of replies handled
+        """
+        handled = 0
+        while True:
+            try:
+                frames = self.socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return handled
+
+            future, handler = self.pending.pop(frames[0], (None, None))
+            if future is None:
+                continue
+            handled += 1
+            try:
+                future.set_result(handler(frames[2:]))
+            except Exception as error:
+                future.set_exception(error)
+
+    def wait(self, future, timeout=None):
+        """ Handles replies until a future is done
+
+        :param RegistrationFuture future: the registration to wait for
+        :param float timeout: the most seconds to wait. Optional. Default = None, no limit
+        """
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        for socket in self.watch:
+            poller.register(socket.getsockopt(zmq.FD), zmq.POLLIN)
+
+        deadline = None if timeout is None else time.time() + timeout
+        while not future.done():
+            for socket in self.watch:
+                socket.getsockopt(zmq.EVENTS)
+            self.process_replies()
+            if future.done():
+                return
+
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                return
+            poller.poll(None if remaining is None else remaining * 1000)
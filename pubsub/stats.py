@@ -0,0 +1,114 @@
+import json
+import time
+from collections import defaultdict
+import pubsub
+
+# Indexes into the per topic message counters
+MESSAGES_IN = 0
+BYTES_IN = 1
+MESSAGES_OUT = 2
+BYTES_OUT = 3
+DROPS = 4
+HWM_DROPS = 5
+
+
+class BrokerStats:
+    """ Counters kept by a broker
+
+    Message counters are kept per message topic, as received on the wire, in a
+    list indexed by MESSAGES_IN, BYTES_IN, MESSAGES_OUT, BYTES_OUT, DROPS and
+    HWM_DROPS so that counting a forwarded message is a dict lookup and a few
+    additions. DROPS counts the messages no subscriber was interested in, and
+    HWM_DROPS the ones flow control dropped because a subscriber's queue was full.
+    Registrations are kept per registered topic, which may be a prefix of the
+    message topics it matches.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.messages = {}
+        self.publishers = defaultdict(set)
+        self.subscribers = defaultdict(set)
+        self.registrations = {pubsub.REG_PUB: 0, pubsub.REG_SUB: 0}
+
+    def counters(self, topic):
+        """ Returns the message counters for a topic, creating them if needed
+
+        :param bytes topic: the topic frame of the message
+        :return: list of six int counters
+        """
+        counters = self.messages.get(topic)
+        if counters is None:
+            counters = self.messages[topic] = [0, 0, 0, 0, 0, 0]
+        return counters
+
+    def register(self, reg_type, topic, address):
+        """ Records a registration
+
+        :param str reg_type: REGISTER_PUBLISHER or REGISTER_SUBSCRIBER
+        :param str topic: the registered topic
+        :param str address: the address of the publisher or subscriber
+        """
+        self.registrations[reg_type] += 1
+        if reg_type == pubsub.REG_PUB:
+            self.publishers[topic].add(address)
+        else:
+            self.subscribers[topic].add(address)
+
+    def snapshot(self):
+        """ Returns every counter as a JSON serializable dict
+
+        :return: dict with the time, uptime, registration counts and a dict of topics
+        """
+        now = time.time()
+        topics = {}
+        for topic, counters in self.messages.items():
+            topics[topic.decode('utf-8', 'replace')] = {
+                "messages_in": counters[MESSAGES_IN],
+                "bytes_in": counters[BYTES_IN],
+                "messages_out": counters[MESSAGES_OUT],
+                "bytes_out": counters[BYTES_OUT],
+                "drops": counters[DROPS],
+                "hwm_drops": counters[HWM_DROPS],
+            }
+
+        for topic in set(self.publishers) | set(self.subscribers):
+            entry = topics.setdefault(topic, {})
+            entry["publishers"] = sorted(self.publishers.get(topic, ()))
+            entry["subscribers"] = sorted(self.subscribers.get(topic, ()))
+
+        return {
+            "time": now,
+            "uptime": now - self.started,
+            "registrations": {
+                "publishers": self.registrations[pubsub.REG_PUB],
+                "subscribers": self.registrations[pubsub.REG_SUB],
+            },
+            "topics": topics,
+        }
+
+
+def encode_snapshot(snapshot):
+    """ Encodes a snapshot to send on the stats socket
+
+    :param dict snapshot: the snapshot returned by `BrokerStats.snapshot`
+    :return: bytes
+    """
+    return json.dumps(snapshot, separators=(',', ':')).encode('utf-8')
+
+
+def rates(previous, current):
+    """ Returns per second rates of the message counters between two snapshots
+
+    :param dict previous: the older snapshot
+    :param dict current: the newer snapshot
+    :return: dict of topic to a dict of counter name to rate per second
+    """
+    elapsed = current["time"] - previous["time"]
+    result = {}
+    for topic, counters in current["topics"].items():
+        before = previous["topics"].get(topic, {})
+        result[topic] = {name: (counters[name] - before.get(name, 0)) / elapsed if elapsed > 0 else 0.0
+                         for name in ["messages_in", "bytes_in", "messages_out", "bytes_out", "drops", "hwm_drops"]
+                         if name in counters}
+    return result
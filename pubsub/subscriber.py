@@ -1,11 +1,20 @@
-import struct
+import itertools
 import time
+from collections import deque
 from time import sleep
 import zmq
+from zmq.utils.monitor import recv_monitor_message
 import pubsub
-from pubsub import PERF_LOGGER, LOGGER
+from pubsub import LOGGER
 from pubsub.broker import BrokerType
-from pubsub.util import MessageType, TopicNotRegisteredError
+from pubsub.compression import Compression, PayloadTooLargeError, UnknownDictionaryError
+from pubsub.flow import FlowControl
+from pubsub.logs import log_perf, message_size, perf_enabled
+from pubsub.metrics import TopicMetrics
+from pubsub.patterns import TAG_START, PatternIndex, is_pattern, literal_prefix, tag, untag
+from pubsub.registration import PendingRegistrations
+from pubsub.util import TopicNotRegisteredError, WireFormat, decode_payload, pack_options, pack_topics, \
+    split_reply, unpack_envelope
 
 
 def printing_callback(topic, message):
@@ -26,10 +35,17 @@ class Subscriber:
 
     The code above should be running in a thread, the application will supply the
     code the notify the application through the registered callback
+
+    Alternatively `run()`, or `run_once()` from the application's own loop,
+    waits on messages and publisher registrations together in one thread.
     """
     ctx = zmq.Context()
 
-    def __init__(self, address, registration_address, conn_sec=.5):
+    # The most messages kept per dictionary being asked for
+    MAX_WAITING = 1000
+
+    def __init__(self, address, registration_address, conn_sec=.5, dispatcher=None, metrics=None,
+                 ready_timeout=5.0, snapshot=True, compression=None, flow=None):
         """Creates a subscriber instance
 
         :param str address: the address of this subscriber. String with
@@ -37,12 +53,42 @@ class Subscriber:
         :param str registration_address: address of the broker with which this publisher
             registers topics. String with format <scheme>://<ip_addr>:<port>
         :param float conn_sec: the number of seconds it takes this subscriber to
-            connect to a publisher when using a direct broker. Optional. Default is .5 seconds
+            connect to a publisher when using a direct broker that cannot confirm
+            connections. Optional. Default is .5 seconds
+        :param Dispatcher dispatcher: runs the callback on a pool of workers instead of
+            in the thread calling `wait_for_msg`. Optional. Default is None
+        :param TopicMetrics metrics: the latency and size histograms to record received
+            messages in. Optional. Default is histograms that are not exported
+        :param float ready_timeout: the most seconds `register` waits for connections
+            to publishers to be made. Optional. Default is 5 seconds
+        :param bool snapshot: whether to ask routing brokers with a last value cache
+            for the latest message of each registered topic. Optional. Default is True
+        :param Compression compression: decompresses payloads and counts the savings.
+            Optional. Default is a Compression that only decompresses
+        :param FlowControl flow: the high-water mark and buffer size of the message
+            sockets, and the counters of dropped messages. Optional. Default is the
+            ZMQ defaults
         """
         self.conn_sec = conn_sec
+        self.ready_timeout = ready_timeout
         self.address = address
         self.topics = []
         self.callback = printing_callback
+        self.dispatcher = dispatcher
+        self.metrics = metrics if metrics is not None else TopicMetrics()
+
+        # Compressed payloads are decompressed with the preset dictionaries the
+        # broker sends with registration replies, or on request for those that
+        # arrive later. Dictionaries the broker did not have are not asked for again.
+        # While a request is answered the messages needing its dictionary wait in
+        # lookups, by dictionary id, see await_dictionary
+        self.compression = compression if compression is not None else Compression()
+        self.missing_dictionaries = set()
+        self.lookups = {}
+
+        # Messages are dropped by senders once the queues fill up, the
+        # subscriber only counts the ones it cannot decompress
+        self.flow = flow if flow is not None else FlowControl()
 
         # The message sub socket receives messages. If using the
         # ROUTING broker it is bound to the address of this subscriber.
@@ -54,81 +100,297 @@ class Subscriber:
         # This socket will only be used with the DIRECT router. When it is
         # used it will be be bound to this subscribers address
         self.publisher_sub = self.ctx.socket(zmq.SUB)
+        self.flow.apply(self.message_sub)
+        self.flow.apply(self.publisher_sub)
 
         # Bind the address here to force the construction to fail if the address
-        # is already bound. However if the broker is a ROUTING broker, we will need
-        # to bind to the message subscriber. In that case, we will unbind this socket
-        # and bind to the other once we know which subscriber we are using (in the
-        # register method. To make sure that we only make that switch once, we use
-        # the message_sub_bound flag
+        # is already bound. However if the broker is a ROUTING broker, the bound
+        # socket has to receive the messages. Both sockets subscribe to the same
+        # topics, so in that case register swaps the two once it knows the broker
+        # type. To make sure that we only make that switch once, we use the
+        # message_sub_bound flag
         self.publisher_sub.bind(self.address)
         self.message_sub_bound = False
         self.publisher_sub_ready = False
 
-        self.registration = self.ctx.socket(zmq.REQ)
+        # Brokers running serve confirm that they are connected to the bound
+        # socket by waiting for it to subscribe to a ready token. Connections
+        # to publishers are confirmed by the handshake events of message_sub
+        self.ready_tokens = itertools.count()
+        self.monitor = None
+        self.publishers = set()
+
+        # Wildcard patterns among the topics, and which copy of each topic's
+        # messages is delivered. See filter_topic
+        self.broker_type = None
+        self.patterns = PatternIndex()
+        self.wanted = {}
+
+        # Cached messages sent with registration replies, delivered before
+        # anything read from message_sub, and the time each topic's was sent.
+        # The same message may also arrive live if it was forwarded while the
+        # reply was held, so messages sent no later than it are dropped until
+        # a newer one arrives
+        self.snapshot = snapshot
+        self.snapshots = deque()
+        self.snapshot_times = {}
+
+        # Registrations are sent on a DEALER so that several can be in flight,
+        # see PendingRegistrations. libzmq only attaches a connection made to a
+        # bound socket, and sends the socket's subscriptions over it, when the
+        # thread owning the socket uses it. A broker may hold its reply until
+        # it sees the ready token, so the events of the SUB sockets are read
+        # while waiting for replies
+        self.registration = self.ctx.socket(zmq.DEALER)
         self.registration.connect(registration_address)
+        self.requests = PendingRegistrations(self.registration, [self.message_sub, self.publisher_sub])
 
-        self.type2receiver = {MessageType.STRING: self.message_sub.recv_string,
-                              MessageType.PYOBJ: self.message_sub.recv_pyobj,
-                              MessageType.JSON: self.message_sub.recv_json}
+        # run_once waits on both sockets with a single poller, and on the
+        # registration socket while dictionaries are looked up. Polling
+        # publisher_sub after the swap for a ROUTING broker is harmless, it is
+        # not connected to anything so it never becomes readable
+        self.poller = zmq.Poller()
+        self.poller.register(self.message_sub, zmq.POLLIN)
+        self.poller.register(self.publisher_sub, zmq.POLLIN)
+        self.batch_callback = None
+        self.running = False
 
-        LOGGER.info(f"Bound to {address}. Registering with broker at {registration_address}.")
+        # Subscribers decode every wire format, so they offer all of them
+        self.wire_formats = [WireFormat.LEGACY, WireFormat.COMPACT]
 
-    def register(self, topic):
+        LOGGER.info("Bound to %s. Registering with broker at %s.", address, registration_address)
+
+    def register(self, topic, wait=True):
         """ Registers a topic and address with the broker
 
         Registering a topic tells the broker to send messages about `topic` to this
         subscriber. This method must be called before any messages about the topic
         will be received.
 
+        The topic may be a wildcard pattern, such as "plant/*/temperature" or
+        "plant/#", see pubsub.patterns. Routing brokers send messages that match
+        it tagged with the pattern, which is removed again before the callback
+        sees the topic. With a direct broker the subscriber receives everything
+        under the pattern's literal prefix and drops what does not match. The
+        proxy routing broker rejects patterns.
+
+        With `wait` False the registration is only sent, so that several can be
+        in flight at once. The reply is handled when the returned future, or any
+        later one, is waited on, or by `process_replies`. Replies must be handled
+        in the thread that registers.
+
         :param str topic: A string topic
+        :param bool wait: whether to wait for the reply. Optional. Default = True
+        :return: RegistrationFuture with the broker type as its result
+        :raises ValueError: if the topic is a pattern with "#" before its last segment,
+            or when waiting, if the broker rejected the pattern
+        """
+        LOGGER.info("Subscriber registering to topic %s at address %s", topic, self.address)
+        return self.send_registration(pubsub.REG_SUB, topic.encode('utf-8'), [topic], wait)
+
+    def register_many(self, topics, wait=True):
+        """ Registers several topics with the broker in one round trip
+
+        Same as calling `register` for each topic, but the broker handles all
+        of them in one request and, if it is a direct broker, replies with the
+        publishers of every topic at once.
+
+        :param list topics: the string topics
+        :param bool wait: whether to wait for the reply. Optional. Default = True
+        :return: RegistrationFuture with the broker type as its result, None if there are no topics
         """
-        LOGGER.info(f"Subscriber registering to topic {topic} at address {self.address}")
+        if not topics:
+            return None
 
-        self.topics.append(topic)
+        LOGGER.info("Subscriber registering to %s topics at address %s", len(topics), self.address)
+        return self.send_registration(pubsub.REG_SUB_MANY, pack_topics(topics), topics, wait)
 
-        self.registration.send_string(pubsub.REG_SUB, flags=zmq.SNDMORE)
-        self.registration.send_string(topic, flags=zmq.SNDMORE)
-        self.registration.send_string(self.address)
+    def process_replies(self):
+        """ Handles the replies to registrations that have arrived, without blocking
 
-        self.message_sub.setsockopt_string(zmq.SUBSCRIBE, topic)
+        :return: the number of replies handled
+        """
+        return self.requests.process_replies()
 
-        # socket listening for new publishers should also subscribe to the topic
-        # This allows it to only receive notifications about publishers it wants to
-        # connect to
-        self.publisher_sub.setsockopt_string(zmq.SUBSCRIBE, topic)
+    def send_registration(self, reg_type, topic_frame, topics, wait=True):
+        """ Subscribes to topics and sends a registration
 
-        broker_type = self.registration.recv_string()
+        :param str reg_type: REGISTER_SUBSCRIBER or REGISTER_SUBSCRIBER_MANY
+        :param bytes topic_frame: the topic frame of the request
+        :param list topics: the string topics being registered
+        :param bool wait: whether to wait for the reply. Optional. Default = True
+        :return: RegistrationFuture
+        """
+        patterns = [topic for topic in topics if is_pattern(topic)]
+        self.topics.extend(topics)
+        for pattern in patterns:
+            self.patterns.add(pattern)
+        self.wanted.clear()
+
+        # Until the broker type is known, patterns are subscribed for both types
+        broker_type = self.broker_type
+        for topic in topics:
+            for subscription in self.subscriptions(topic, broker_type):
+                self.message_sub.setsockopt(zmq.SUBSCRIBE, subscription)
+
+                # socket listening for new publishers should also subscribe to the topic
+                # This allows it to only receive notifications about publishers it wants to
+                # connect to
+                self.publisher_sub.setsockopt(zmq.SUBSCRIBE, subscription)
+
+        # The ready token is subscribed after the topic on the socket the broker
+        # connects to, see AbstractBroker.reply_when_ready
+        ready = f"{self.address} {next(self.ready_tokens)}"
+        token = pubsub.READY_PREFIX + ready.encode('utf-8')
+        bound_sub = self.message_sub if self.message_sub_bound else self.publisher_sub
+        bound_sub.setsockopt(zmq.SUBSCRIBE, token)
+
+        options = {"wire_formats": self.wire_formats, "ready": ready, "dictionaries": True}
+        if self.snapshot:
+            options["snapshot"] = True
+        future = self.requests.send([reg_type.encode('utf-8'),
+                                     topic_frame,
+                                     self.address.encode('utf-8'),
+                                     pack_options(options)],
+                                    lambda reply: self.handle_reply(reply, bound_sub, token, patterns, broker_type))
+        if wait:
+            future.result()
+        return future
+
+    def subscriptions(self, topic, broker_type):
+        """ Returns what the message sockets subscribe to for a topic
+
+        :param str topic: a topic or a wildcard pattern
+        :param str broker_type: the type of the broker, None if it is not known yet
+        :return: list of bytes subscriptions
+        """
+        if topic not in self.patterns:
+            return [topic.encode('utf-8')]
+        subscriptions = []
+        if broker_type != BrokerType.DIRECT:
+            subscriptions.append(tag(topic))
+        if broker_type != BrokerType.ROUTE:
+            subscriptions.append(literal_prefix(topic).encode('utf-8'))
+        return subscriptions
+
+    def handle_reply(self, reply, bound_sub, token, patterns=(), sent_broker_type=None):
+        """ Connects as the reply to a registration says
+
+        :param list reply: the frames of the reply
+        :param bound_sub: the socket the ready token was subscribed on
+        :param bytes token: the ready token of the registration
+        :param list patterns: the wildcard patterns that were registered. Optional
+        :param str sent_broker_type: the broker type known when the registration was sent,
+            None if it was not known. Optional. Default = None
+        :return: the broker type
+        :raises ValueError: if the broker rejected patterns, which are then unregistered
+        """
+        broker_type, options, frames = split_reply(reply)
+        bound_sub.setsockopt(zmq.UNSUBSCRIBE, token)
+        self.broker_type = broker_type
+        self.wanted.clear()
+        self.compression.add_dictionaries(options.get("dictionaries", {}))
+
+        # Drop the subscriptions made for the other broker type
+        for pattern in patterns:
+            kept = self.subscriptions(pattern, broker_type)
+            for subscription in self.subscriptions(pattern, sent_broker_type):
+                if subscription not in kept:
+                    self.message_sub.setsockopt(zmq.UNSUBSCRIBE, subscription)
+                    self.publisher_sub.setsockopt(zmq.UNSUBSCRIBE, subscription)
 
         # process response from registration
-        # If broker is ROUTING we need to the socket accepting messages to be bound
-        # to this subscriber's address
+        # If broker is ROUTING the socket accepting messages has to be the one
+        # bound to this subscriber's address, which the broker connects to
         # If broker is DIRECT we need to connect the socket accepting messages to
         # each address received. Additionally, if we are using the DIRECT broker
         # we need to be able to receive notifications about new publishers so
         # we need to connect the appropriate socket to this subscriber's address
         if broker_type == BrokerType.ROUTE:
             if not self.message_sub_bound:
-                self.publisher_sub.unbind(self.address)
-                sleep(.5)
-                self.message_sub.bind(self.address)
+                self.message_sub, self.publisher_sub = self.publisher_sub, self.message_sub
                 self.message_sub_bound = True
+            if "snapshot" in options:
+                self.add_snapshot(options["snapshot"], frames)
         elif broker_type == BrokerType.DIRECT:
 
             # Ensure that publisher_sub is receiving new publishers
             # before we get the list of existing publishers otherwise
-            # we could miss a publisher registration
+            # we could miss a publisher registration. Brokers that confirmed
+            # the connection already made sure of that
             if not self.publisher_sub_ready:
-                sleep(self.conn_sec)
+                if not options.get("ready"):
+                    sleep(self.conn_sec)
                 self.publisher_sub_ready = True
 
-            has_addresses = self.registration.recv()
+            has_addresses = frames[0]
             if has_addresses == b'\x01':
-                addresses = self.registration.recv_multipart()
-                for address in addresses:
-                    self.message_sub.connect(address.decode('utf-8'))
+                self.connect_and_wait([address.decode('utf-8') for address in frames[1:]])
+
+        # Brokers that cannot route wildcard patterns reject them
+        rejected = options.get("rejected", [])
+        for topic in rejected:
+            self.unregister(topic)
+        if rejected:
+            raise ValueError(f"The broker rejected wildcard patterns {rejected}")
 
-        LOGGER.info(f"Connected to {broker_type} broker")
+        LOGGER.info("Connected to %s broker", broker_type)
+        return broker_type
+
+    def add_snapshot(self, sizes, frames):
+        """ Queues the cached messages of a registration reply for delivery
+
+        Only the latest message of a cached batch is kept.
+
+        :param list sizes: the number of frames of each message
+        :param list frames: the frames of the messages
+        """
+        position = 0
+        for size in sizes:
+            message = frames[position:position + size]
+            position += size
+            try:
+                topic, time_sent, message_type, batch, payload = unpack_envelope(message, self.compression.decompress)
+            except (UnknownDictionaryError, PayloadTooLargeError) as error:
+                LOGGER.warning("Dropping cached message: %s", error)
+                self.flow.dropped[error.topic] += 1
+                continue
+            messages = decode_payload(time_sent, message_type, batch, payload)
+            if not messages:
+                continue
+            time_sent, message = messages[-1]
+            self.snapshots.append((topic, message))
+            self.snapshot_times[topic] = max(time_sent, self.snapshot_times.get(topic, time_sent))
+
+    def connect_and_wait(self, addresses):
+        """ Connects to publishers and waits until the connections are made
+
+        Waits for the handshake of every new connection, at most `ready_timeout`
+        seconds. Publishers may still drop the first messages until they see the
+        subscriptions, `Publisher.wait_for_subscribers` confirms them.
+        Publishers that are already connected are skipped.
+
+        :param list addresses: the addresses of the publishers
+        :return: True if every connection was made, False if the timeout passed first
+        """
+        if self.monitor is None:
+            self.monitor = self.message_sub.get_monitor_socket(zmq.EVENT_HANDSHAKE_SUCCEEDED)
+
+        pending = set(addresses) - self.publishers
+        for address in pending:
+            self.message_sub.connect(address)
+            self.publishers.add(address)
+
+        deadline = time.time() + self.ready_timeout
+        while pending:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not self.monitor.poll(remaining * 1000):
+                LOGGER.warning("Timed out connecting to publishers %s", sorted(pending))
+                return False
+            event = recv_monitor_message(self.monitor)
+            pending.discard(event["endpoint"].decode('utf-8'))
+
+        return True
 
     def unregister(self, topic):
         """ Unregisters a topic and address
@@ -142,11 +404,15 @@ class Subscriber:
             raise TopicNotRegisteredError(topic, self.address, "Topic has not been registered with subscriber. Cannot "
                                                                "unregister.")
 
-        self.topics.remove(topic)
-        self.message_sub.setsockopt_string(zmq.UNSUBSCRIBE, topic)
+        for subscription in self.subscriptions(topic, self.broker_type):
+            self.message_sub.setsockopt(zmq.UNSUBSCRIBE, subscription)
 
-        # unsubscribe registration socket
-        self.publisher_sub.setsockopt_string(zmq.UNSUBSCRIBE, topic)
+            # unsubscribe registration socket
+            self.publisher_sub.setsockopt(zmq.UNSUBSCRIBE, subscription)
+        self.topics.remove(topic)
+        if topic not in self.topics:
+            self.patterns.remove(topic)
+        self.wanted.clear()
         # For now, we won't worry about unbinding the address on the broker
         # There could be other subscribers listening to that topic. Because
         # we've disconnected the address and unsubscribed from the topic here,
@@ -155,30 +421,207 @@ class Subscriber:
     def notify(self, topic, message):
         """ Notifies the application that a message has been received
 
-        Notify is implemented by the user through registering a callback
+        Notify is implemented by the user through registering a callback. If the
+        subscriber has a dispatcher, the callback is queued on it and this method
+        returns without waiting for it to run.
 
         :param str topic: the string topic of the message
         :param str message: the message content
         """
-        self.callback(topic, message)
+        if self.dispatcher is not None:
+            self.dispatcher.submit(self.callback, topic, message)
+        else:
+            self.callback(topic, message)
+
+    def receive(self, flags=0):
+        """ Receives one ZMQ message and decodes the messages in it
+
+        Cached messages that came with registration replies are returned
+        first, all at once, without reading the socket, then messages whose
+        preset dictionary has arrived, see `await_dictionary`.
+
+        :param int flags: flags passed to the socket, zmq.NOBLOCK to raise
+            zmq.Again instead of blocking
+        :return: list of (topic, message) tuples, more than one if the message is a batch
+        """
+        if self.snapshots:
+            received = list(self.snapshots)
+            self.snapshots.clear()
+            return received
+
+        if self.lookups:
+            received = self.process_lookups()
+            while not received and self.lookups and not flags & zmq.NOBLOCK:
+                # wait for a message or the dictionaries, at most until the next lookup gives up
+                poller = zmq.Poller()
+                poller.register(self.message_sub, zmq.POLLIN)
+                poller.register(self.registration, zmq.POLLIN)
+                timeout = min(deadline for _, deadline, _ in self.lookups.values()) - time.time()
+                if self.message_sub in dict(poller.poll(max(timeout, 0) * 1000)):
+                    break
+                received = self.process_lookups()
+            if received:
+                return received
+
+        # copy=False so that large payloads, such as array buffers, are not
+        # copied out of the ZMQ message
+        return self.decode(self.message_sub.recv_multipart(flags, copy=False))
+
+    def decode(self, frames):
+        """ Decodes the messages in a ZMQ message and records their metrics
+
+        :param list frames: the frames of the ZMQ message
+        :return: list of (topic, message) tuples, empty if it was dropped or waits for a dictionary
+        """
+        try:
+            topic, time_sent, message_type, batch, payload = unpack_envelope(frames, self.compression.decompress)
+        except UnknownDictionaryError as error:
+            self.await_dictionary(error, frames)
+            return []
+        except PayloadTooLargeError as error:
+            LOGGER.warning("Dropping message: %s", error)
+            self.flow.dropped[error.topic] += 1
+            return []
+        if self.patterns or topic.startswith(TAG_START):
+            topic = self.filter_topic(topic)
+            if topic is None:
+                return []
+        messages = decode_payload(time_sent, message_type, batch, payload)
+        if not messages:
+            # an empty batch, which current publishers do not send
+            return []
+        if self.snapshot_times and topic in self.snapshot_times:
+            messages = self.drop_snapshotted(topic, messages)
+            if not messages:
+                return []
+
+        # the size recorded is the bytes on the wire, shared evenly by the messages in a batch
+        time_recv = time.time()
+        size = sum(len(frame) for frame in frames[len(frames) - len(payload):]) // len(messages)
+        perf = perf_enabled()
+        for time_sent, message in messages:
+            if perf:
+                log_perf(time_recv - time_sent, time_recv, len(topic), message_size(message))
+            self.metrics.record(topic, time_recv - time_sent, size, time_recv)
+
+        return [(topic, message) for _, message in messages]
+
+    def await_dictionary(self, error, frames):
+        """ Asks the broker for a missing preset dictionary without waiting for the reply
+
+        The message waits until the dictionary arrives, at most `ready_timeout`
+        seconds, and is then returned by `receive`. Messages using other
+        dictionaries, or none, are not held up by it. Each dictionary is only
+        asked for once, messages compressed with one the broker did not have
+        are dropped, as are messages beyond MAX_WAITING per dictionary.
+
+        :param UnknownDictionaryError error: the error raised for the missing dictionary
+        :param list frames: the frames of the message
+        """
+        if error.dictionary_id in self.missing_dictionaries:
+            LOGGER.warning("Dropping message: %s", error)
+            self.flow.dropped[error.topic] += 1
+            return
+
+        if error.dictionary_id not in self.lookups:
+            future = self.requests.send([pubsub.LOOKUP_DICTIONARIES.encode('utf-8'),
+                                         error.topic.encode('utf-8'),
+                                         self.address.encode('utf-8'),
+                                         pack_options({"dictionaries": True})],
+                                        lambda reply: self.compression.add_dictionaries(
+                                            split_reply(reply)[1].get("dictionaries", {})))
+            self.lookups[error.dictionary_id] = (future, time.time() + self.ready_timeout, [])
+            self.poller.register(self.registration, zmq.POLLIN)
+
+        waiting = self.lookups[error.dictionary_id][2]
+        if len(waiting) >= self.MAX_WAITING:
+            LOGGER.warning("Dropping message: %s", error)
+            self.flow.dropped[error.topic] += 1
+            return
+        waiting.append((error.topic, frames))
+
+    def process_lookups(self):
+        """ Handles the replies to dictionary lookups that have arrived, without blocking
+
+        :return: list of (topic, message) tuples of the messages that were waiting
+            for the dictionaries that arrived
+        """
+        self.requests.process_replies()
+        now = time.time()
+        received = []
+        for dictionary_id, (future, deadline, waiting) in list(self.lookups.items()):
+            if self.compression.has_dictionary(dictionary_id):
+                del self.lookups[dictionary_id]
+                for _, frames in waiting:
+                    received.extend(self.decode(frames))
+            elif future.done() or now >= deadline:
+                del self.lookups[dictionary_id]
+                self.missing_dictionaries.add(dictionary_id)
+                LOGGER.warning("Dropping %s messages, the broker has no dictionary %08x", len(waiting), dictionary_id)
+                for topic, _ in waiting:
+                    self.flow.dropped[topic] += 1
+
+        if not self.lookups:
+            self.poller.unregister(self.registration)
+        return received
+
+    def drop_snapshotted(self, topic, messages):
+        """ Drops the messages of a topic already delivered with a snapshot
+
+        :param str topic: the topic of the messages
+        :param list messages: (time sent, message) tuples
+        :return: list of the messages sent after the snapshot
+        """
+        time_cached = self.snapshot_times[topic]
+        newer = [(time_sent, message) for time_sent, message in messages if time_sent > time_cached]
+        if newer:
+            del self.snapshot_times[topic]
+        return newer
+
+    def filter_topic(self, topic):
+        """ Removes the tag from a topic and checks that it was asked for
+
+        A routing broker sends a message once untagged and once tagged for
+        every pattern it matches, so overlapping subscriptions would deliver it
+        several times. Only one copy is kept: the untagged one if the topic
+        starts with a topic registered as is or, with a direct broker, where
+        nobody sends tagged copies, matches a pattern. Otherwise the copy
+        tagged with the first of this subscriber's patterns that it matches.
+
+        :param str topic: the topic of a received message
+        :return: the topic without a tag, None if the message is to be dropped
+        """
+        pattern, topic = untag(topic)
+        wanted = self.wanted.get(topic)
+        if wanted is None:
+            wanted = self.wanted[topic] = self.wanted_copy(topic)
+        return topic if wanted == (pattern or "") else None
+
+    def wanted_copy(self, topic):
+        """ Returns which copy of a topic's messages `filter_topic` keeps
+
+        :param str topic: the topic without a tag
+        :return: "" for the untagged copy, the pattern of the tagged copy, or
+            False if no copy is wanted
+        """
+        if any(topic.startswith(prefix) for prefix in self.topics if prefix not in self.patterns):
+            return ""
+        matching = self.patterns.match(topic) if self.patterns else []
+        if not matching:
+            return False
+        return "" if self.broker_type == BrokerType.DIRECT else min(matching)
 
     def wait_for_msg(self):
         """ Waits for a message to be received
 
         Block until a message has been received and then invoke the callback to
-        notify the application code.
-        """
-        topic = self.message_sub.recv_string()
-        time_published = self.message_sub.recv()
-        message_type = self.message_sub.recv_string()
-        message = self.type2receiver[message_type]()
+        notify the application code. If the message is a batch, the callback is
+        invoked once for each message in it, in the order they were published.
 
-        time_sent = struct.unpack('d', time_published)[0]
-        time_recv = time.time()
-        delta_time = time_recv - time_sent
-        PERF_LOGGER.info(f"{delta_time}, {time_recv}, {len(topic)}, {len(message)}")
-
-        self.notify(topic, message)
+        Messages in both the legacy and the compact wire format are accepted.
+        """
+        for topic, message in self.receive():
+            self.notify(topic, message)
 
     def register_callback(self, callback):
         """ Register the call back to notify the application of a message
@@ -194,6 +637,17 @@ class Subscriber:
         """
         self.callback = callback
 
+    def register_batch_callback(self, callback):
+        """ Register a callback that receives every message read in one `run_once` call
+
+        Accepts a function or method that takes a list of (topic, message) tuples.
+        When set, `run_once` and `run` call it instead of the per message callback.
+        Pass None to go back to the per message callback.
+
+        :param callback: the function or method to call with the received messages
+        """
+        self.batch_callback = callback
+
     def wait_for_registration(self):
         """ Waits for a registration to be published
 
@@ -201,9 +655,82 @@ class Subscriber:
         subscriber so that it can begin receiving messages on that address
         """
         # receive notification of new publisher
-        message = self.publisher_sub.recv_multipart()
+        self.connect_publisher(self.publisher_sub.recv_multipart())
+
+    def connect_publisher(self, message):
+        """ Connects to the publisher in a registration published by a direct broker
+
+        :param list message: the frames of the registration, topic then address
+        """
+        if self.patterns and self.filter_topic(message[0].decode('utf-8')) is None:
+            return
         address = message[1].decode('utf-8')
 
         # connect message receiving socket to new publisher address
-        self.message_sub.connect(address)
+        if address not in self.publishers:
+            self.message_sub.connect(address)
+            self.publishers.add(address)
+
+    def run_once(self, timeout=None, max_batch=100):
+        """ Handles messages and publisher registrations that are ready
+
+        Waits up to `timeout` seconds for either socket to be readable, then reads
+        up to `max_batch` ZMQ messages from each without blocking. This replaces
+        the threads running `wait_for_msg` and `wait_for_registration`, and a
+        timeout lets the subscriber be driven from the application's own loop.
+
+        The messages are passed to the batch callback if one is registered,
+        otherwise to `notify` one at a time.
+
+        :param float timeout: seconds to wait, None waits until something arrives,
+            0 returns immediately. Optional. Default = None
+        :param int max_batch: the most ZMQ messages read from each socket. Optional. Default = 100
+        :return: the number of messages received, counting each message in a batch
+        """
+        if self.snapshots:
+            timeout = 0
+        if self.lookups:
+            # wake up when the next dictionary lookup gives up
+            remaining = max(min(deadline for _, deadline, _ in self.lookups.values()) - time.time(), 0)
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        ready = dict(self.poller.poll(None if timeout is None else timeout * 1000))
+
+        if self.publisher_sub in ready:
+            for _ in range(max_batch):
+                try:
+                    self.connect_publisher(self.publisher_sub.recv_multipart(zmq.NOBLOCK))
+                except zmq.Again:
+                    break
+
+        received = []
+        if self.message_sub in ready or self.snapshots or self.lookups:
+            for _ in range(max_batch):
+                try:
+                    received.extend(self.receive(zmq.NOBLOCK))
+                except zmq.Again:
+                    break
+
+        if received:
+            if self.batch_callback is not None:
+                self.batch_callback(received)
+            else:
+                for topic, message in received:
+                    self.notify(topic, message)
+
+        return len(received)
+
+    def run(self, timeout=.1, max_batch=100):
+        """ Calls `run_once` until `stop` is called
+
+        :param float timeout: seconds each `run_once` waits, which bounds how long
+            `stop` takes to be noticed. Optional. Default = .1
+        :param int max_batch: the most ZMQ messages read from each socket per
+            wakeup. Optional. Default = 100
+        """
+        self.running = True
+        while self.running:
+            self.run_once(timeout, max_batch)
 
+    def stop(self):
+        """ Makes `run` return after its current iteration """
+        self.running = False
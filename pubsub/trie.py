@@ -0,0 +1,173 @@
+class TopicNode:
+    """ Node of a `TopicTrie`
+
+    The label is the part of the topic on the edge from the parent. Children
+    are keyed by the first character of their label and only created when
+    needed, and values are kept in a tuple, so a leaf costs a few small objects.
+    """
+    __slots__ = ("label", "children", "values")
+
+    def __init__(self, label):
+        self.label = label
+        self.children = None
+        self.values = None
+
+
+class TopicTrie:
+    """ Radix trie of topics, each with an ordered set of values
+
+    Topics that share a prefix share the nodes along it, and chains of nodes
+    with a single child are merged into one edge, so the trie stays compact
+    with many topics under the same hierarchy. Looking up every value whose
+    topic starts with a prefix, which is how ZMQ matches subscriptions, walks
+    down the prefix once and then over the matching subtree only.
+
+    Topics are expected to have a few values each, such as the publishers of a
+    topic, so values are checked for duplicates with a linear scan.
+    """
+
+    def __init__(self):
+        self.root = TopicNode("")
+        self.topics = 0
+
+    def add(self, topic, value):
+        """ Adds a value to a topic, unless it is there already
+
+        :param str topic: the topic
+        :param value: the value, such as an address
+        :return: True if the value was added, False if it was already there
+        """
+        node = self.root
+        position = 0
+        while position < len(topic):
+            if node.children is None:
+                node.children = {}
+            child = node.children.get(topic[position])
+            if child is None:
+                child = node.children[topic[position]] = TopicNode(topic[position:])
+                node = child
+                break
+
+            label = child.label
+            if topic.startswith(label, position):
+                common = len(label)
+            else:
+                # split the edge where the topic leaves it
+                common = common_prefix_length(label, topic, position)
+                middle = TopicNode(label[:common])
+                child.label = label[common:]
+                middle.children = {child.label[0]: child}
+                node.children[topic[position]] = middle
+                child = middle
+            node = child
+            position += common
+
+        if node.values is None:
+            node.values = (value,)
+            self.topics += 1
+            return True
+        if value in node.values:
+            return False
+        node.values += (value,)
+        return True
+
+    def find(self, prefix):
+        """ Returns the node under which every topic starting with a prefix is
+
+        :param str prefix: the prefix
+        :return: tuple of the TopicNode and the topic it ends, (None, None) if no
+            topic starts with the prefix
+        """
+        node = self.root
+        position = 0
+        while position < len(prefix):
+            child = node.children.get(prefix[position]) if node.children else None
+            if child is None:
+                return None, None
+            if len(prefix) - position <= len(child.label):
+                if not child.label.startswith(prefix[position:]):
+                    return None, None
+                return child, prefix[:position] + child.label
+            if not prefix.startswith(child.label, position):
+                return None, None
+            node = child
+            position += len(child.label)
+        return node, prefix
+
+    def get(self, topic):
+        """ Returns the values of exactly one topic
+
+        :param str topic: the topic
+        :return: list of values, empty if the topic has none
+        """
+        node = self.root
+        position = 0
+        while position < len(topic):
+            child = node.children.get(topic[position]) if node.children else None
+            if child is None or not topic.startswith(child.label, position):
+                return []
+            node = child
+            position += len(child.label)
+        return list(node.values) if node.values else []
+
+    def match(self, prefix):
+        """ Returns the values of every topic that starts with a prefix
+
+        :param str prefix: the prefix, the empty string matches every topic
+        :return: list of values, each once, in no particular order
+        """
+        node, _ = self.find(prefix)
+        if node is None:
+            return []
+
+        values = {}
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node.values:
+                values.update(dict.fromkeys(node.values))
+            if node.children:
+                stack.extend(reversed(node.children.values()))
+        return list(values)
+
+    def items(self, prefix=""):
+        """ Yields every topic that starts with a prefix, with its values
+
+        :param str prefix: the prefix. Optional. Default = "", every topic
+        :return: generator of (topic, list of values) tuples
+        """
+        node, topic = self.find(prefix)
+        if node is None:
+            return
+        stack = [(topic[:len(topic) - len(node.label)], node)]
+        while stack:
+            topic, node = stack.pop()
+            topic += node.label
+            if node.values is not None:
+                yield topic, list(node.values)
+            if node.children:
+                stack.extend((topic, child) for child in reversed(node.children.values()))
+
+    def __getitem__(self, topic):
+        return self.get(topic)
+
+    def __contains__(self, topic):
+        return bool(self.get(topic))
+
+    def __len__(self):
+        return self.topics
+
+
+def common_prefix_length(label, topic, position):
+    """ Returns the length of the longest common prefix of a label and a topic
+
+    :param str label: a label
+    :param str topic: a topic
+    :param int position: the index in the topic to compare from
+    :return: int
+    """
+    length = min(len(label), len(topic) - position)
+    for index in range(length):
+        if label[index] != topic[position + index]:
+            return index
+    return length
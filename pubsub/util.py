@@ -1,7 +1,455 @@
+import json
+import pickle
+import struct
+import zlib
+from abc import ABC, abstractmethod
+from collections import namedtuple
+
+from pubsub import REG_ERROR
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
 class MessageType:
     STRING = "STRING"
     PYOBJ = "PYOBJ"
     JSON = "JSON"
+    NDARRAY = "NDARRAY"
+    BATCH = "BATCH"
+
+
+class WireFormat:
+    """ Wire formats for data messages
+
+    LEGACY sends four frames per message: the topic, the packed time it was
+    sent, the message type name and the payload.
+
+    COMPACT sends three frames: the topic, a fixed size header and the payload.
+    The header packs a version byte, a one byte type code, two bytes of flags
+    and the time the message was sent.
+
+    Publishers and subscribers agree on the format with the broker at
+    registration. Subscribers decode both formats, so publishers using either
+    can share a topic.
+    """
+    LEGACY = 1
+    COMPACT = 2
+
+
+# version, type code, flags, time sent
+COMPACT_HEADER = struct.Struct('<BBHd')
+COMPACT_VERSION = 1
+
+# Flags set in the compact header
+FLAG_BATCH = 0x0001
+
+# The payload is compressed with zlib or lzma, and zlib's starts with the id of
+# the preset dictionary it was compressed with, see pubsub.compression
+FLAG_ZLIB = 0x0002
+FLAG_LZMA = 0x0004
+FLAG_DICTIONARY = 0x0008
+FLAGS_COMPRESSED = FLAG_ZLIB | FLAG_LZMA
+
+
+class Codec(ABC):
+    """ Encodes messages of one message type to bytes and back
+
+    Codecs are registered by name with `register_codec`. The name is the
+    message type passed to `Publisher.publish` and sent in the legacy wire
+    format; the type code is the byte sent in the compact wire format. Both
+    ends of a topic must register the same codec under the same name and code.
+
+    A codec that wants to send its payload as several frames, for example to
+    avoid copying a large buffer, overrides `encode_frames` and `decode_frames`.
+    `encode` and `decode` are still used when messages are batched.
+    """
+
+    @abstractmethod
+    def encode(self, message):
+        """ Encodes a message
+
+        :param message: the message
+        :return: bytes
+        """
+
+    @abstractmethod
+    def decode(self, data):
+        """ Decodes a message
+
+        :param bytes data: the encoded message
+        :return: the message
+        """
+
+    def encode_frames(self, message):
+        """ Encodes a message into the payload frames of a data message
+
+        :param message: the message
+        :return: list of objects supporting the buffer protocol
+        """
+        return [self.encode(message)]
+
+    def decode_frames(self, frames):
+        """ Decodes a message from the payload frames of a data message
+
+        :param list frames: the payload frames, as bytes or zmq.Frame
+        :return: the message
+        """
+        return self.decode(bytes(frames[0]))
+
+
+class StringCodec(Codec):
+    """ Codec for strings, encoded as UTF-8 like send_string """
+
+    def encode(self, message):
+        return message.encode('utf-8')
+
+    def decode(self, data):
+        return data.decode('utf-8')
+
+
+class PickleCodec(Codec):
+    """ Codec for python objects, encoded with pickle like send_pyobj """
+
+    def encode(self, message):
+        return pickle.dumps(message, pickle.DEFAULT_PROTOCOL)
+
+    def decode(self, data):
+        return pickle.loads(data)
+
+
+class JsonCodec(Codec):
+    """ Codec for JSON serializable objects, encoded like send_json """
+
+    def encode(self, message):
+        return json.dumps(message).encode('utf-8')
+
+    def decode(self, data):
+        return json.loads(data.decode('utf-8'))
+
+
+class StructCodec(Codec):
+    """ Codec for fixed-shape records described by a struct format
+
+    The layout is declared once, typically one codec per topic, and compiled
+    into a `struct.Struct`. Records are tuples (or anything that unpacks into
+    the fields in order) and are decoded into tuples, or named tuples when
+    field names are given.
+
+    With bulk=True a message is a sequence of records that is packed into one
+    payload and decoded into a list, which is much cheaper than sending the
+    records one by one.
+
+    Sample usage:
+    register_codec("position", StructCodec("<dff", ["time", "x", "y"]), 64)
+    publisher.publish("robot/1", (time.time(), 1.5, 2.0), "position")
+    """
+
+    def __init__(self, fmt, fields=None, bulk=False):
+        """ Creates a struct codec
+
+        :param str fmt: the struct format of one record, e.g. "<dff"
+        :param list fields: names of the fields of a record. Optional. Default = None
+            (records are decoded into plain tuples)
+        :param bool bulk: whether a message is a sequence of records. Optional. Default = False
+        """
+        self.struct = struct.Struct(fmt)
+        self.record_type = namedtuple("Record", fields) if fields is not None else None
+        self.bulk = bulk
+
+    def encode(self, message):
+        if not self.bulk:
+            return self.struct.pack(*message)
+
+        pack_into = self.struct.pack_into
+        size = self.struct.size
+        data = bytearray(size * len(message))
+        for index, record in enumerate(message):
+            pack_into(data, index * size, *record)
+        return bytes(data)
+
+    def decode(self, data):
+        if not self.bulk:
+            record = self.struct.unpack(data)
+            return self.record_type._make(record) if self.record_type is not None else record
+
+        records = self.struct.iter_unpack(data)
+        if self.record_type is not None:
+            return list(map(self.record_type._make, records))
+        return list(records)
+
+
+class NdarrayCodec(Codec):
+    """ Codec for NumPy arrays that avoids copying the array buffer
+
+    The payload is two frames: a small header with the number of dimensions,
+    the shape and the dtype, followed by the raw array buffer. Publishers send
+    the buffer with copy=False and subscribers receive it with copy=False, so
+    the array passed to the callback is an `np.frombuffer` view over the
+    received ZMQ frame.
+
+    Only registered when NumPy can be imported.
+    """
+    NDIM = struct.Struct('<B')
+
+    def pack_header(self, array):
+        shape = struct.pack(f'<{array.ndim}Q', *array.shape)
+        return self.NDIM.pack(array.ndim) + shape + array.dtype.str.encode('ascii')
+
+    def unpack_header(self, header):
+        ndim = self.NDIM.unpack_from(header)[0]
+        shape_end = self.NDIM.size + 8 * ndim
+        shape = struct.unpack_from(f'<{ndim}Q', header, self.NDIM.size)
+        return shape, np.dtype(bytes(header[shape_end:]).decode('ascii'))
+
+    def encode_frames(self, message):
+        array = np.ascontiguousarray(message)
+        return [self.pack_header(array), array]
+
+    def decode_frames(self, frames):
+        shape, dtype = self.unpack_header(bytes(frames[0]))
+        return np.frombuffer(frames[1], dtype=dtype).reshape(shape)
+
+    def encode(self, message):
+        # Used in batches, where the header length has to be sent with the array
+        array = np.ascontiguousarray(message)
+        header = self.pack_header(array)
+        return struct.pack('<H', len(header)) + header + array.tobytes()
+
+    def decode(self, data):
+        header_length = struct.unpack_from('<H', data)[0]
+        shape, dtype = self.unpack_header(data[2:2 + header_length])
+        return np.frombuffer(data, dtype=dtype, offset=2 + header_length).reshape(shape)
+
+
+# Registered codecs and type codes by message type name, and message type
+# names by the type code sent in the compact wire format
+codecs = {}
+type2code = {}
+code2type = {}
+
+
+def register_codec(name, codec, type_code):
+    """ Registers a codec for a message type
+
+    :param str name: the message type name, used as `message_type` when publishing
+    :param Codec codec: the codec
+    :param int type_code: the byte identifying the message type in the compact wire
+        format, 1-255. Codes 1-63 are reserved for built in message types
+    """
+    if not isinstance(codec, Codec):
+        raise TypeError(f"Codec for message type {name} must be a Codec, got {type(codec).__name__}")
+    if not 0 < type_code < 256:
+        raise ValueError(f"Type code must be between 1 and 255, got {type_code}")
+    if code2type.get(type_code, name) != name:
+        raise ValueError(f"Type code {type_code} is already used by message type {code2type[type_code]}")
+
+    codecs[name] = codec
+    type2code[name] = type_code
+    code2type[type_code] = name
+
+
+def get_codec(message_type):
+    """ Returns the codec registered for a message type
+
+    :param str message_type: the message type name
+    :return: Codec
+    """
+    try:
+        return codecs[message_type]
+    except KeyError:
+        raise CodecNotRegisteredError(message_type) from None
+
+
+register_codec(MessageType.STRING, StringCodec(), 1)
+register_codec(MessageType.PYOBJ, PickleCodec(), 2)
+register_codec(MessageType.JSON, JsonCodec(), 3)
+if np is not None:
+    register_codec(MessageType.NDARRAY, NdarrayCodec(), 4)
+
+# Each message in a batch is preceded by the time it was published and the
+# length of its encoded payload
+BATCH_RECORD = struct.Struct('<dI')
+
+
+def pack_batch(messages, message_type):
+    """ Packs messages into a single batch payload
+
+    :param messages: list of (time published, message) tuples
+    :param str message_type: the type of every message in the batch
+    :return: bytes containing all the messages
+    """
+    encoder = get_codec(message_type).encode
+    parts = []
+    for time_sent, message in messages:
+        data = encoder(message)
+        parts.append(BATCH_RECORD.pack(time_sent, len(data)))
+        parts.append(data)
+    return b''.join(parts)
+
+
+def unpack_batch(payload, message_type):
+    """ Unpacks a batch payload created by `pack_batch`
+
+    :param bytes payload: the batch payload
+    :param str message_type: the type of every message in the batch
+    :return: list of (time published, message) tuples
+    """
+    decoder = get_codec(message_type).decode
+    view = memoryview(payload)
+    messages = []
+    offset = 0
+    while offset < len(view):
+        time_sent, length = BATCH_RECORD.unpack_from(view, offset)
+        offset += BATCH_RECORD.size
+        messages.append((time_sent, decoder(bytes(view[offset:offset + length]))))
+        offset += length
+    return messages
+
+
+def pack_envelope(topic, message_type, time_sent, payload, wire_format=WireFormat.LEGACY, batch=False, flags=0):
+    """ Builds the frames of a data message
+
+    :param str topic: the topic of the message
+    :param str message_type: the type of the message, or of every message in a batch
+    :param float time_sent: the time the message was sent
+    :param list payload: the payload frames of the encoded message or batch
+    :param int wire_format: the wire format to use. Optional. Default = WireFormat.LEGACY
+    :param bool batch: whether the payload is a batch created by `pack_batch`. Optional. Default = False
+    :param int flags: compression flags of the payload, only sent in the compact format. Optional. Default = 0
+    :return: list of frames to send with send_multipart
+    """
+    if wire_format == WireFormat.COMPACT:
+        if batch:
+            flags |= FLAG_BATCH
+        header = COMPACT_HEADER.pack(COMPACT_VERSION, type2code[message_type], flags, time_sent)
+        return [topic.encode('utf-8'), header] + payload
+
+    frames = [topic.encode('utf-8'), struct.pack('d', time_sent)]
+    if batch:
+        frames.append(MessageType.BATCH.encode('utf-8'))
+    frames.append(message_type.encode('utf-8'))
+    return frames + payload
+
+
+def unpack_envelope(frames, decompress=None):
+    """ Parses the frames of a data message in either wire format
+
+    The format is recognized by the size of the second frame: the legacy
+    format sends an 8 byte time there, the compact format a larger header.
+
+    :param list frames: the frames received with recv_multipart, as bytes or zmq.Frame
+    :param decompress: function called with the topic, the header flags and the
+        payload frame of a compressed message, such as `Compression.decompress`.
+        Optional. Default = None
+    :return: tuple of the topic, the time sent, the message type, whether the
+        payload is a batch, and the list of payload frames
+    :raises ValueError: if the payload is compressed and no decompress function is given
+    """
+    topic = bytes(frames[0]).decode('utf-8')
+    header = bytes(frames[1])
+
+    if len(header) == COMPACT_HEADER.size:
+        version, type_code, flags, time_sent = COMPACT_HEADER.unpack(header)
+        payload = frames[2:]
+        if flags & FLAGS_COMPRESSED:
+            if decompress is None:
+                raise ValueError(f"Cannot decompress the payload of a message on topic {topic}")
+            payload = [decompress(topic, flags, payload[0])]
+        return topic, time_sent, code2type[type_code], bool(flags & FLAG_BATCH), payload
+
+    time_sent = struct.unpack('d', header)[0]
+    message_type = bytes(frames[2]).decode('utf-8')
+    if message_type == MessageType.BATCH:
+        return topic, time_sent, bytes(frames[3]).decode('utf-8'), True, frames[4:]
+    return topic, time_sent, message_type, False, frames[3:]
+
+
+def decode_payload(time_sent, message_type, batch, payload):
+    """ Decodes the payload of a data message
+
+    :param float time_sent: the time the message was sent
+    :param str message_type: the type of the message, or of every message in a batch
+    :param bool batch: whether the payload is a batch
+    :param list payload: the payload frames of the encoded message or batch
+    :return: list of (time published, message) tuples
+    """
+    if batch:
+        return unpack_batch(bytes(payload[0]), message_type)
+    return [(time_sent, get_codec(message_type).decode_frames(payload))]
+
+
+def pack_options(options):
+    """ Encodes the options frame of a registration request or reply
+
+    :param dict options: the options
+    :return: bytes
+    """
+    return json.dumps(options).encode('utf-8')
+
+
+def pack_topics(topics):
+    """ Encodes the topic frame of a request registering several topics
+
+    :param list topics: the string topics
+    :return: bytes
+    """
+    return json.dumps(list(topics)).encode('utf-8')
+
+
+def unpack_topics(frame):
+    """ Decodes the topic frame of a request registering several topics
+
+    :param bytes frame: the frame made by `pack_topics`
+    :return: list of string topics
+    """
+    return json.loads(frame.decode('utf-8'))
+
+
+def split_reply(reply):
+    """ Splits a registration reply into its parts
+
+    Brokers only include an options frame when the request carried one, so
+    the frame is recognized by its content: it is a JSON object whereas the
+    frame that follows the broker type in older direct broker replies is a
+    single byte.
+
+    :param list reply: the frames received with recv_multipart
+    :return: tuple of the broker type, the options dict (empty if the broker sent
+        none) and the remaining frames
+    :raises RegistrationError: if the broker could not process the registration
+    """
+    broker_type = reply[0].decode('utf-8')
+    if broker_type == REG_ERROR:
+        raise RegistrationError(reply[1].decode('utf-8', 'replace') if len(reply) > 1 else "")
+    if len(reply) > 1 and reply[1][:1] == b'{':
+        return broker_type, json.loads(reply[1].decode('utf-8')), reply[2:]
+    return broker_type, {}, reply[1:]
+
+
+def choose_wire_format(offered, supported):
+    """ Chooses the newest wire format offered by a client that is also supported
+
+    :param list offered: the wire formats the client can use
+    :param int supported: the newest wire format allowed
+    :return: int wire format
+    """
+    return max((wire_format for wire_format in offered if wire_format <= supported), default=WireFormat.LEGACY)
+
+
+def shard_for_topic(topic, num_shards):
+    """ Returns the index of the shard that forwards messages for a topic
+
+    Uses a CRC32 of the topic so that the assignment is the same in every
+    process, unlike the builtin `hash` which is randomized per interpreter.
+
+    :param str topic: A string topic
+    :param int num_shards: the number of shards
+    :return: int in the range [0, num_shards)
+    """
+    return zlib.crc32(topic.encode('utf-8')) % num_shards
 
 
 class TopicNotRegisteredError(Exception):
@@ -14,3 +462,17 @@ class TopicNotRegisteredError(Exception):
 
     def __str__(self):
         return f"{self.message} Topic: {self.topic} Address: {self.address}"
+
+
+class CodecNotRegisteredError(Exception):
+
+    def __init__(self, message_type):
+        self.message_type = message_type
+        super(Exception, self).__init__(f"No codec registered for message type {message_type}")
+
+
+class RegistrationError(Exception):
+
+    def __init__(self, reason):
+        self.reason = reason
+        super(Exception, self).__init__(f"The broker rejected the registration: {reason}")
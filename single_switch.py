@@ -14,10 +14,11 @@ from mininet.log import setLogLevel
 address_format = "tcp://{0}:{1}"
 default_port = "5555"
 broker_cmd_fmt = "python psserver.py --address {0} --port {1} --type {2} &"
-publisher_cmd_fmt = "python ps_publisher.py {0} {1} --topics lorem -r 1000"
-subscriber_cmd_fmt = "python ps_subscriber.py {0} {1} --topics lorem -e {2}"
+publisher_cmd_fmt = "python ps_publisher.py {0} {1} --topics lorem -r 1000 --subscribers {2}"
+subscriber_cmd_fmt = "python ps_subscriber.py {0} {1} --topics lorem -e --metrics pubsub.metrics {2}"
 output_dir = "latency"
 perf_logs = "pubsub_perf.log"
+metrics_exports = "pubsub.metrics"
 banner = "\n" \
          "+-------------------------------------------------\n" \
          "| Running test with {0} subscribers and {1} broker\n" \
@@ -93,7 +94,8 @@ def run_iteration(net, broker_type):
     # Run the publisher process
     publisher_cmd = publisher_cmd_fmt.format(
         address_format.format(publisher.IP(), default_port),
-        broker_address
+        broker_address,
+        len(subscribers)
     )
     print(f"Running {publisher_cmd}")
     publisher_out = publisher.cmd(publisher_cmd)
@@ -130,6 +132,7 @@ def main():
 
                 filename = filename_fmt.format(curr_sub, broker_type)
                 shutil.move(perf_logs, os.path.join(output_dir, filename))
+                shutil.move(metrics_exports, os.path.join(output_dir, filename[:-len(".log")] + ".metrics"))
             curr_sub *= 2
     elif mode == 'single':
         for broker_type in ['r', 'd']:
@@ -139,6 +142,7 @@ def main():
 
             filename = filename_fmt.format(max_subs, broker_type)
             shutil.move(perf_logs, os.path.join(output_dir, filename))
+            shutil.move(metrics_exports, os.path.join(output_dir, filename[:-len(".log")] + ".metrics"))
     else:
         net = create_network(max_subs)
         net.start()
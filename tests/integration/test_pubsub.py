@@ -1,10 +1,12 @@
 import logging
+import time
 from concurrent.futures import ThreadPoolExecutor
-from time import sleep
-
 import pytest
 
 from pubsub.broker import BrokerType, RoutingBroker, DirectBroker
+from pubsub.cache import LastValueCache
+from pubsub.compression import Compression, TopicCompression
+from pubsub.flow import BLOCK, FlowControl
 from pubsub.publisher import Publisher
 from pubsub.subscriber import Subscriber
 
@@ -12,7 +14,7 @@ broker_address = "tcp://127.0.0.1:5562"
 sub_address = "tcp://127.0.0.1:5563"
 pub_address = "tcp://127.0.0.1:5564"
 
-executor = ThreadPoolExecutor(max_workers=3)
+executor = ThreadPoolExecutor(max_workers=4)
 
 
 def wait_loop(func, max_iters=0):
@@ -24,6 +26,11 @@ def wait_loop(func, max_iters=0):
     logging.debug(f"Exiting wait loop")
 
 
+def wait_until(func, done):
+    while not done():
+        func()
+
+
 nl = []
 
 
@@ -33,27 +40,25 @@ def test_publish_routing():
     nl.clear()
 
     broker = RoutingBroker("tcp://127.0.0.1:5562")
-    executor.submit(wait_loop, broker.process, num_msg)
-    executor.submit(wait_loop, broker.process_registration, 2)
+    executor.submit(broker.serve)
 
     logging.info("setting up subscriber")
     sub = Subscriber(sub_address, broker_address)
-    future = executor.submit(wait_loop, sub.wait_for_msg, num_msg)
-
     sub.register_callback(add_number)
     sub.register(topic)
+    future = executor.submit(wait_loop, sub.wait_for_msg, num_msg)
 
     logging.info("setting up publisher")
     pub = Publisher(pub_address, broker_address)
     pub.register(topic)
 
-    sleep(.5)
     numbers = []
     for i in range(num_msg):
         pub.publish(topic, str(i))
         numbers.append(str(i))
 
     future.result(60)
+    broker.shutdown()
     logging.info(f"nl: {nl}")
     logging.info(f"nu: {numbers}")
     assert nl == numbers
@@ -65,27 +70,27 @@ def test_publish_direct():
     nl.clear()
 
     broker = DirectBroker("tcp://127.0.0.1:5565")
-    executor.submit(wait_loop, broker.process_registration, 2)
+    executor.submit(broker.serve)
 
     logging.info("setting up subscriber")
     sub = Subscriber(sub_address, "tcp://127.0.0.1:5565")
-    future = executor.submit(wait_loop, sub.wait_for_msg, num_msg)
-    executor.submit(wait_loop, sub.wait_for_registration, 1)
-
     sub.register_callback(add_number)
     sub.register(topic)
+    executor.submit(wait_loop, sub.wait_for_registration, 1)
 
     logging.info("setting up publisher")
     pub = Publisher(pub_address, "tcp://127.0.0.1:5565")
     pub.register(topic)
+    assert pub.wait_for_subscribers(1, 5)
+    future = executor.submit(wait_loop, sub.wait_for_msg, num_msg)
 
-    sleep(.5)
     numbers = []
     for i in range(num_msg):
         pub.publish(topic, str(i))
         numbers.append(str(i))
 
     future.result(60)
+    broker.shutdown()
     logging.info(f"nl: {nl}")
     logging.info(f"nu: {numbers}")
     assert nl == numbers
@@ -96,21 +101,20 @@ def test_publish_first_routing():
     num_msg = 100
     nl.clear()
 
-    broker = RoutingBroker("tcp://127.0.0.1:5562")
-    executor.submit(wait_loop, broker.process, num_msg)
-    executor.submit(wait_loop, broker.process_registration, 2)
+    broker = RoutingBroker("tcp://127.0.0.1:5462")
+    executor.submit(broker.serve)
 
     logging.info("setting up publisher")
-    pub = Publisher(pub_address, broker_address)
+    pub = Publisher(pub_address, "tcp://127.0.0.1:5462")
     pub.register(topic)
 
     logging.info("setting up subscriber")
-    sub = Subscriber(sub_address, broker_address)
-    future = executor.submit(wait_loop, sub.wait_for_msg, num_msg)
-
+    sub = Subscriber(sub_address, "tcp://127.0.0.1:5462")
     sub.register_callback(add_number)
     sub.register(topic)
-    sleep(.5)
+    # The broker only subscribes to the publisher once a subscriber is interested
+    assert pub.wait_for_subscribers(1, 5)
+    future = executor.submit(wait_loop, sub.wait_for_msg, num_msg)
 
     numbers = []
     for i in range(num_msg):
@@ -118,6 +122,7 @@ def test_publish_first_routing():
         numbers.append(str(i))
 
     future.result(60)
+    broker.shutdown()
     logging.info(f"nl: {nl}")
     logging.info(f"nu: {numbers}")
     assert nl == numbers
@@ -129,7 +134,7 @@ def test_publish_first_direct():
     nl.clear()
 
     broker = DirectBroker("tcp://127.0.0.1:5465")
-    executor.submit(wait_loop, broker.process_registration, 2)
+    executor.submit(broker.serve)
 
     logging.info("setting up publisher")
     pub = Publisher(pub_address, "tcp://127.0.0.1:5465")
@@ -137,18 +142,18 @@ def test_publish_first_direct():
 
     logging.info("setting up subscriber")
     sub = Subscriber(sub_address, "tcp://127.0.0.1:5465")
-    future = executor.submit(wait_loop, sub.wait_for_msg, num_msg)
-
     sub.register_callback(add_number)
     sub.register(topic)
+    assert pub.wait_for_subscribers(1, 5)
+    future = executor.submit(wait_loop, sub.wait_for_msg, num_msg)
 
-    sleep(.5)
     numbers = []
     for i in range(num_msg):
         pub.publish(topic, str(i))
         numbers.append(str(i))
 
     future.result(60)
+    broker.shutdown()
     logging.info(f"nl: {nl}")
     logging.info(f"nu: {numbers}")
     assert nl == numbers
@@ -161,16 +166,14 @@ def test_two_publishers():
     nl.clear()
 
     broker = RoutingBroker("tcp://127.0.0.1:5570")
-    executor.submit(wait_loop, broker.process, num_msg * 2)
-    executor.submit(wait_loop, broker.process_registration, 4)
+    executor.submit(broker.serve)
 
     logging.info("setting up subscriber")
     sub = Subscriber("tcp://127.0.0.1:5571", "tcp://127.0.0.1:5570")
-    future = executor.submit(wait_loop, sub.wait_for_msg, num_msg * 2)
-
     sub.register_callback(add_number)
     sub.register(topic)
     sub.register(topic2)
+    future = executor.submit(wait_loop, sub.wait_for_msg, num_msg * 2)
 
     logging.info("setting up publisher")
     pub1 = Publisher("tcp://127.0.0.1:5572", "tcp://127.0.0.1:5570")
@@ -179,7 +182,6 @@ def test_two_publishers():
     pub2 = Publisher("tcp://127.0.0.1:5573", "tcp://127.0.0.1:5570")
     pub2.register(topic2)
 
-    sleep(.5)
     numbers = []
     for i in range(num_msg):
         pub1.publish(topic, f"pub1 {i}")
@@ -188,10 +190,186 @@ def test_two_publishers():
         numbers.append(f"pub2 {i}")
 
     future.result(60)
+    broker.shutdown()
     logging.info(f"nl: {nl}")
     logging.info(f"nu: {numbers}")
     assert len(nl) == len(numbers)
 
 
+def test_pattern_routing():
+    topics = ["plant/boiler/temperature", "plant/boiler/pressure", "plant/boiler/temperature/max"]
+    num_msg = 50
+    received = []
+
+    broker = RoutingBroker("tcp://127.0.0.1:5574")
+    executor.submit(broker.serve)
+
+    sub = Subscriber("tcp://127.0.0.1:5575", "tcp://127.0.0.1:5574")
+    sub.register_callback(lambda topic, message: received.append((topic, message)))
+    sub.register("plant/*/temperature")
+    future = executor.submit(wait_loop, sub.wait_for_msg, num_msg)
+
+    pub = Publisher("tcp://127.0.0.1:5576", "tcp://127.0.0.1:5574")
+    pub.register_many(topics)
+
+    expected = []
+    for i in range(num_msg):
+        for topic in topics:
+            pub.publish(topic, str(i))
+        expected.append((topics[0], str(i)))
+
+    future.result(60)
+    broker.shutdown()
+    assert received == expected
+
+
+def test_overlapping_patterns_routing():
+    topics = ["plant/boiler/temperature", "plant/boiler/pressure", "plant/pump/temperature", "tank/level"]
+    num_msg = 50
+    received = []
+
+    broker = RoutingBroker("tcp://127.0.0.1:5604")
+    executor.submit(broker.serve)
+
+    # Every plant topic matches two or three of the subscriptions
+    sub = Subscriber("tcp://127.0.0.1:5607", "tcp://127.0.0.1:5604")
+    sub.register_callback(lambda topic, message: received.append((topic, message)))
+    sub.register_many(["plant/#", "plant/*/temperature", "plant/boiler/"])
+    future = executor.submit(wait_until, sub.wait_for_msg, lambda: len(received) >= num_msg * 3)
+
+    pub = Publisher("tcp://127.0.0.1:5608", "tcp://127.0.0.1:5604")
+    pub.register_many(topics)
+
+    expected = []
+    for i in range(num_msg):
+        for topic in topics:
+            pub.publish(topic, str(i))
+        expected.extend((topic, str(i)) for topic in topics[:3])
+
+    future.result(60)
+    broker.shutdown()
+    # each message once, and nothing after them
+    assert received == expected
+    assert sub.run_once(timeout=.2) == 0
+
+
+def test_snapshot_routing():
+    topics = ["plant/boiler/temperature", "plant/boiler/pressure", "plant/pump/temperature"]
+    received = []
+
+    broker = RoutingBroker("tcp://127.0.0.1:5567", cache=LastValueCache())
+    executor.submit(broker.serve)
+
+    # Nobody subscribes yet, the broker still keeps the latest message of each topic
+    pub = Publisher("tcp://127.0.0.1:5568", "tcp://127.0.0.1:5567")
+    pub.register_many(topics)
+    for i in range(3):
+        for topic in topics:
+            pub.publish(topic, str(i))
+    deadline = time.time() + 5
+    while len(broker.cache) < len(topics) and time.time() < deadline:
+        time.sleep(.01)
+
+    sub = Subscriber("tcp://127.0.0.1:5569", "tcp://127.0.0.1:5567")
+    sub.register_callback(lambda topic, message: received.append((topic, message)))
+    sub.register("plant/*/temperature")
+    sub.wait_for_msg()
+    assert sorted(received) == [(topics[0], "2"), (topics[2], "2")]
+
+    # Then messages arrive as they are published
+    future = executor.submit(sub.wait_for_msg)
+    pub.publish(topics[0], "3")
+    future.result(60)
+    broker.shutdown()
+    assert received[-1] == (topics[0], "3")
+
+
+def test_pattern_direct():
+    topics = ["plant/boiler/temperature", "plant/boiler/pressure", "plant/boiler/temperature/max"]
+    num_msg = 50
+    received = []
+
+    broker = DirectBroker("tcp://127.0.0.1:5577")
+    executor.submit(broker.serve)
+
+    pub = Publisher("tcp://127.0.0.1:5578", "tcp://127.0.0.1:5577")
+    pub.register_many(topics)
+
+    sub = Subscriber("tcp://127.0.0.1:5579", "tcp://127.0.0.1:5577")
+    sub.register_callback(lambda topic, message: received.append((topic, message)))
+    sub.register("plant/*/temperature")
+    assert pub.wait_for_subscribers(1, 5)
+
+    expected = []
+    for i in range(num_msg):
+        for topic in topics:
+            pub.publish(topic, str(i))
+        expected.append((topics[0], str(i)))
+
+    # The subscriber receives everything under plant/ and drops what does not match
+    executor.submit(wait_loop, sub.wait_for_msg, num_msg * len(topics)).result(60)
+    broker.shutdown()
+    assert received == expected
+
+
+def test_compression_direct():
+    topic = "plant/boiler/status"
+    messages = [f'{{"state": "running", "temperature": {70 + i % 5}, "pressure": {i % 3}}}' for i in range(40)]
+    received = []
+
+    broker = DirectBroker("tcp://127.0.0.1:5593")
+    executor.submit(broker.serve)
+
+    compression = Compression(samples=20)
+    compression.configure(topic, TopicCompression(threshold=0))
+    pub = Publisher("tcp://127.0.0.1:5594", "tcp://127.0.0.1:5593", compression=compression)
+    pub.register(topic)
+
+    sub = Subscriber("tcp://127.0.0.1:5595", "tcp://127.0.0.1:5593")
+    sub.register_callback(lambda topic, message: received.append(message))
+    sub.register(topic)
+    assert pub.wait_for_subscribers(1, 5)
+
+    for message in messages[:20]:
+        pub.publish(topic, message)
+    executor.submit(wait_loop, sub.wait_for_msg, 20).result(60)
+
+    # The subscriber gets the trained dictionary from the broker when the first
+    # message compressed with it arrives
+    pub.train_dictionary(topic, 1024)
+    for message in messages[20:]:
+        pub.publish(topic, message)
+    executor.submit(wait_until, sub.wait_for_msg, lambda: len(received) == len(messages)).result(60)
+    broker.shutdown()
+
+    assert received == messages
+    assert topic in broker.dictionaries
+    assert sub.compression.statistics()[topic]["messages"] == 40
+    assert compression.statistics()[topic]["ratio"] > 1
+
+def test_flow_control_routing():
+    topic = "orders/new"
+    num_msg = 200
+    received = []
+
+    broker = RoutingBroker("tcp://127.0.0.1:5596", flow=FlowControl(sndhwm=100, rcvhwm=100, policy=BLOCK))
+    executor.submit(broker.serve)
+
+    sub = Subscriber("tcp://127.0.0.1:5597", "tcp://127.0.0.1:5596", flow=FlowControl(rcvhwm=100))
+    sub.register_callback(lambda topic, message: received.append(message))
+    sub.register(topic)
+
+    # Nothing is dropped when every role waits for room
+    flow = FlowControl(sndhwm=100, policy=BLOCK, rate=2000)
+    pub = Publisher("tcp://127.0.0.1:5598", "tcp://127.0.0.1:5596", flow=flow)
+    pub.register(topic)
+    for i in range(num_msg):
+        pub.publish(topic, str(i))
+
+    executor.submit(wait_loop, sub.wait_for_msg, num_msg).result(60)
+    broker.shutdown()
+    assert received == [str(i) for i in range(num_msg)]
+    assert not flow.dropped and not broker.flow.dropped
+
 def add_number(topic, message):
     nl.append(message)
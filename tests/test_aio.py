@@ -0,0 +1,97 @@
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+import zmq
+
+from pubsub import REG_PUB, REG_SUB
+from pubsub.aio import AsyncPublisher, AsyncSubscriber
+from pubsub.broker import BrokerType
+from pubsub.util import MessageType, TopicNotRegisteredError, WireFormat, pack_batch, pack_envelope
+
+ctx = zmq.Context()
+broker_address = "tcp://127.0.0.1:5600"
+pub_address = "tcp://127.0.0.1:5601"
+sub_address = "tcp://127.0.0.1:5602"
+
+executor = ThreadPoolExecutor(max_workers=2)
+
+
+@pytest.fixture(scope="module")
+def reply():
+    reply = ctx.socket(zmq.REP)
+    reply.bind(broker_address)
+    yield reply
+    reply.close(linger=0)
+
+
+def broker_recv_reg(socket, frames):
+    """ Answers one registration as a direct broker that knows about the test publisher """
+    message = socket.recv_multipart()
+    socket.send_multipart([BrokerType.DIRECT.encode('utf-8'),
+                           json.dumps({"wire_format": WireFormat.COMPACT}).encode('utf-8')] + frames)
+    return message
+
+
+def test_publish_and_receive(reply):
+    async def run():
+        publisher = AsyncPublisher(pub_address, broker_address)
+        subscriber = AsyncSubscriber(sub_address, broker_address, conn_sec=.1)
+
+        future = executor.submit(broker_recv_reg, reply, [])
+        await publisher.register("topic")
+        pub_reg = future.result(10)
+
+        future = executor.submit(broker_recv_reg, reply, [b'\x01', pub_address.encode('utf-8')])
+        await subscriber.register("topic")
+        sub_reg = future.result(10)
+
+        assert publisher.wire_format == WireFormat.COMPACT
+        with pytest.raises(TopicNotRegisteredError):
+            await publisher.publish("unregistered", "message")
+
+        received = asyncio.ensure_future(subscriber.recv())
+        await asyncio.sleep(.5)
+        # empty batches are not sent, and skipped by the subscriber if they are
+        await publisher.publish_batch("topic", [])
+        await publisher.message_pub.send_multipart(pack_envelope("topic", MessageType.STRING, time.time(),
+                                                                 [pack_batch([], MessageType.STRING)],
+                                                                 WireFormat.COMPACT, batch=True))
+        await publisher.publish("topic", "message 1")
+        await publisher.publish_batch("topic", ["message 2", "message 3"])
+        await publisher.publish("topic", np.arange(4), MessageType.NDARRAY)
+
+        messages = [await asyncio.wait_for(received, 10)]
+        async for topic, message in subscriber:
+            messages.append((topic, message))
+            if len(messages) == 4:
+                break
+
+        subscriber.close()
+        publisher.close()
+        return pub_reg, sub_reg, messages
+
+    pub_reg, sub_reg, messages = asyncio.run(run())
+
+    assert pub_reg[0].decode('utf-8') == REG_PUB
+    assert sub_reg[0].decode('utf-8') == REG_SUB
+    assert sub_reg[2].decode('utf-8') == sub_address
+    assert messages[:3] == [("topic", "message 1"), ("topic", "message 2"), ("topic", "message 3")]
+    assert messages[3][0] == "topic"
+    assert np.array_equal(messages[3][1], np.arange(4))
+
+
+def test_register_pattern():
+    async def run():
+        subscriber = AsyncSubscriber("tcp://127.0.0.1:5603", broker_address)
+        # nothing is sent to the broker
+        with pytest.raises(ValueError):
+            await subscriber.register_many(["topic", "plant/*/temperature"])
+        topics = list(subscriber.topics)
+        subscriber.close()
+        return topics
+
+    assert asyncio.run(run()) == []
@@ -0,0 +1,48 @@
+from pubsub.analysis import PerfSummary, split, summarize_chunk, summarize_files
+from pubsub.logs import PerfFile
+
+
+def write_logs(tmp_path, count):
+    text = tmp_path / "sub-1_broker-r.log"
+    binary = PerfFile(str(tmp_path / "sub-1_broker-r.bin"))
+    with open(text, "w") as file:
+        for i in range(count):
+            # one message every 10ms, latency 1 to 100ms
+            record = ((i % 100 + 1) / 1000, 1000.0 + i / 100, 5, 64)
+            file.write(", ".join(str(value) for value in record) + "\n")
+            binary.record(*record)
+    binary.close()
+    return str(text), str(tmp_path / "sub-1_broker-r.bin")
+
+
+def test_split_lines(tmp_path):
+    text, binary = write_logs(tmp_path, 1000)
+
+    # every line is read by exactly one chunk, whatever the chunk size
+    for chunk_size in [7, 100, 1 << 20]:
+        total = PerfSummary()
+        for path, start, end in split(text, chunk_size):
+            total.merge(summarize_chunk(path, start, end))
+        assert total.latency.count == 1000
+
+    assert all((end - start) % 24 == 0 for _, start, end in split(binary, 100)[:-1])
+
+
+def test_summarize_files(tmp_path):
+    text, binary = write_logs(tmp_path, 1000)
+
+    summaries = summarize_files({"text": [text], "binary": [binary]}, workers=2, chunk_size=1000)
+    for summary in summaries.values():
+        assert summary.latency.count == 1000
+        assert abs(summary.latency.percentile(50) - 50000) < 500
+        assert summary.latency.max == 100000
+        assert summary.throughput() == [(float(second), 100.0, 6400.0) for second in range(10)]
+        assert summary.cdf()[-1] == (.1, 1.0)
+
+
+def test_throughput_gaps():
+    summary = PerfSummary(window=.5)
+    summary.record(.001, 10.1, 5, 10)
+    summary.record(.001, 11.2, 5, 10)
+
+    assert summary.throughput() == [(0.0, 2.0, 20.0), (.5, 0.0, 0.0), (1.0, 2.0, 20.0)]
@@ -0,0 +1,51 @@
+import zmq
+
+from pubsub.cache import LastValueCache
+
+
+class TestLastValueCache:
+
+    def test_put(self):
+        cache = LastValueCache()
+        cache.put(b"topic", [b"topic", b"one"])
+        cache.put(b"topic", [b"topic", b"two"])
+        cache.put(b"other", [zmq.Frame(b"other"), zmq.Frame(b"three")])
+
+        assert len(cache) == 2
+        assert cache.get(b"topic") == [b"topic", b"two"]
+        assert cache.get(b"other")[1].bytes == b"three"
+        assert cache.get(b"missing") is None
+        assert cache.size == len(b"topictwo") + len(b"otherthree")
+
+    def test_evict_topics(self):
+        cache = LastValueCache(max_topics=2)
+        cache.put(b"a", [b"a", b"1"])
+        cache.put(b"b", [b"b", b"2"])
+        # reading a topic keeps it over the ones used before
+        cache.get(b"a")
+        cache.put(b"c", [b"c", b"3"])
+
+        assert b"b" not in cache
+        assert b"a" in cache and b"c" in cache
+        assert cache.evictions == 1
+
+    def test_evict_bytes(self):
+        cache = LastValueCache(max_bytes=10)
+        cache.put(b"a", [b"a", b"1234"])
+        cache.put(b"b", [b"b", b"1234"])
+        cache.put(b"c", [b"c", b"1234"])
+
+        assert list(cache.messages) == [b"b", b"c"]
+        assert cache.size == 10
+
+        # too large for the cache, and the previous message is stale
+        cache.put(b"c", [b"c", b"12345678910"])
+        assert b"c" not in cache
+        assert cache.size == 5
+
+    def test_snapshot(self):
+        cache = LastValueCache()
+        cache.put(b"a", [b"a", b"1"])
+        cache.put(b"b", [b"b", b"2"])
+
+        assert cache.snapshot([b"b", b"missing", b"a"]) == [[b"b", b"2"], [b"a", b"1"]]
@@ -0,0 +1,140 @@
+import json
+import random
+import time
+import zlib
+
+import pytest
+
+from pubsub.compression import LZMA, ZLIB, Compression, PayloadTooLargeError, TopicCompression, \
+    UnknownDictionaryError, train_dictionary
+from pubsub.util import FLAG_DICTIONARY, FLAG_LZMA, FLAG_ZLIB, MessageType, WireFormat, decode_payload, \
+    pack_envelope, unpack_envelope
+
+TOPIC = "topic here"
+WORDS = "the quick brown fox jumps over the lazy dog while lorem ipsum dolor sits on the amet".split()
+
+
+def sentences(count, seed=0):
+    rand = random.Random(seed)
+    return [json.dumps({"name": " ".join(rand.choice(WORDS) for _ in range(2)),
+                        "sentence": " ".join(rand.choice(WORDS) for _ in range(8)),
+                        "value": round(rand.random(), 4)}).encode('utf-8')
+            for _ in range(count)]
+
+
+def test_topic_compression():
+    assert TopicCompression().flags == FLAG_ZLIB
+    assert TopicCompression(LZMA).flags == FLAG_LZMA
+    assert TopicCompression(dictionary=b"dictionary").flags == FLAG_ZLIB | FLAG_DICTIONARY
+
+    with pytest.raises(ValueError):
+        TopicCompression("zstd")
+    with pytest.raises(ValueError):
+        TopicCompression(LZMA, dictionary=b"dictionary")
+
+
+@pytest.mark.parametrize("codec", [ZLIB, LZMA])
+def test_compress(codec):
+    compression = Compression()
+    compression.configure(TOPIC, TopicCompression(codec, threshold=32))
+    payload = b"message here " * 10
+
+    flags, compressed = compression.compress(TOPIC, payload)
+    assert flags == TopicCompression(codec).flags
+    assert len(compressed) < len(payload)
+    assert Compression().decompress(TOPIC, flags, compressed) == payload
+
+    # below the threshold, and for other topics, payloads are sent as they are
+    assert compression.compress(TOPIC, b"short") == (0, b"short")
+    assert compression.compress("other", payload) == (0, payload)
+
+    # and so are payloads that do not get smaller
+    incompressible = random.Random(0).randbytes(100)
+    assert compression.compress(TOPIC, incompressible) == (0, incompressible)
+
+    counters = compression.statistics()[TOPIC]
+    assert counters["messages"] == 3
+    assert counters["compressed"] == 1
+    assert counters["bytes_in"] == len(payload) + len(b"short") + len(incompressible)
+    assert counters["bytes_out"] == len(compressed) + len(b"short") + len(incompressible)
+    assert counters["ratio"] > 1
+
+
+@pytest.mark.parametrize("codec", [ZLIB, LZMA])
+def test_max_size(codec):
+    compression = Compression()
+    compression.configure(TOPIC, TopicCompression(codec))
+    payload = bytes(1 << 20)
+    flags, compressed = compression.compress(TOPIC, payload)
+
+    assert Compression(max_size=len(payload)).decompress(TOPIC, flags, compressed) == payload
+    with pytest.raises(PayloadTooLargeError):
+        Compression(max_size=len(payload) - 1).decompress(TOPIC, flags, compressed)
+
+
+def test_default():
+    compression = Compression(TopicCompression(threshold=0))
+    assert compression.compress("any topic", b"message here " * 10)[0] == FLAG_ZLIB
+
+
+def test_dictionary():
+    samples = sentences(200)
+    compression = Compression(samples=100)
+    compression.configure(TOPIC, TopicCompression())
+    for sample in samples[:100]:
+        compression.compress(TOPIC, sample)
+    assert len(compression.samples[TOPIC]) == 100
+
+    settings = compression.train(TOPIC)
+    assert TOPIC not in compression.samples
+    # nothing changes until the settings are applied
+    assert compression.settings(TOPIC).dictionary is None
+    compression.configure(TOPIC, settings)
+
+    message = samples[150]
+    flags, compressed = compression.compress(TOPIC, message)
+    assert flags == FLAG_ZLIB | FLAG_DICTIONARY
+
+    # Subscribers need the dictionary, which they get as the broker sends it
+    subscriber = Compression()
+    with pytest.raises(UnknownDictionaryError) as error:
+        subscriber.decompress(TOPIC, flags, compressed)
+    assert error.value.dictionary_id == zlib.crc32(settings.dictionary)
+    assert not subscriber.has_dictionary(error.value.dictionary_id)
+
+    subscriber.add_dictionaries(compression.export_dictionaries([TOPIC, "other"]))
+    assert subscriber.has_dictionary(error.value.dictionary_id)
+    assert subscriber.decompress(TOPIC, flags, compressed) == message
+    assert subscriber.statistics()[TOPIC]["bytes_in"] == len(message)
+
+    with pytest.raises(ValueError):
+        compression.train("other")
+
+
+def test_train_dictionary():
+    samples = sentences(300)
+    dictionary = train_dictionary(samples[:200], 4096)
+    assert 0 < len(dictionary) <= 4096
+
+    def compressed_size(payload, zdict=None):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15, **({"zdict": zdict} if zdict else {}))
+        return len(compressor.compress(payload) + compressor.flush())
+
+    # small messages compress much better with the dictionary than without
+    plain = sum(compressed_size(sample) for sample in samples[200:])
+    trained = sum(compressed_size(sample, dictionary) for sample in samples[200:])
+    assert trained < plain / 2
+
+
+def test_envelope():
+    compression = Compression()
+    compression.configure(TOPIC, TopicCompression(threshold=0))
+    time_sent = time.time()
+    flags, payload = compression.compress(TOPIC, b"message here " * 10)
+    frames = pack_envelope(TOPIC, MessageType.STRING, time_sent, [payload], WireFormat.COMPACT, flags=flags)
+
+    topic, actual_time, message_type, batch, payload = unpack_envelope(frames, compression.decompress)
+    assert decode_payload(actual_time, message_type, batch, payload) == [(time_sent, "message here " * 10)]
+
+    with pytest.raises(ValueError):
+        unpack_envelope(frames)
@@ -1,13 +1,14 @@
 import logging
-from collections import defaultdict
+import threading
 from concurrent.futures import ThreadPoolExecutor
 from time import sleep
 
 import pytest
 import zmq
 
-from pubsub import REG_PUB, REG_SUB
+from pubsub import LOOKUP_DICTIONARIES, READY_PREFIX, REG_PUB, REG_PUB_MANY, REG_SUB, REG_SUB_MANY
 from pubsub.broker import DirectBroker, BrokerType
+from pubsub.util import pack_options, pack_topics, split_reply
 
 ctx = zmq.Context()
 BROKER_ADDRESS = "tcp://127.0.0.1:5559"
@@ -39,7 +40,7 @@ class TestDirectBroker:
         broker = DirectBroker(BROKER_ADDRESS)
         assert broker.registration is not None
         assert broker.connect_address == BROKER_ADDRESS
-        assert broker.registry == defaultdict(list)
+        assert len(broker.registry) == 0
         assert broker.message_out is not None
 
     def wait_for_msg(self, socket):
@@ -103,3 +104,173 @@ class TestDirectBroker:
         assert address == PUB_ADDRESS
 
         subscriber.setsockopt_string(zmq.UNSUBSCRIBE, TOPIC)
+
+    def test_serve_confirms_ready(self):
+        address = "tcp://127.0.0.1:5557"
+        sub_address = "tcp://127.0.0.1:5558"
+        token = READY_PREFIX + b"token"
+
+        sub = ctx.socket(zmq.SUB)
+        sub.bind(sub_address)
+        sub.setsockopt(zmq.SUBSCRIBE, token)
+
+        broker = DirectBroker(address)
+        broker.ready_timeout = .5
+        thread = threading.Thread(target=broker.serve, args=[.05])
+        thread.start()
+
+        req = ctx.socket(zmq.REQ)
+        req.connect(address)
+
+        def register(ready):
+            req.send_multipart([REG_SUB.encode(ENCODING), TOPIC.encode(ENCODING), sub_address.encode(ENCODING),
+                                pack_options({"ready": ready})])
+            # The bound socket only attaches the broker's connection when it is used
+            while not req.poll(10):
+                sub.getsockopt(zmq.EVENTS)
+            return split_reply(req.recv_multipart())
+
+        broker_type, options, frames = register("token")
+        assert broker_type == BrokerType.DIRECT
+        assert options["ready"] is True
+
+        # Nobody subscribes to this token, so the broker gives up
+        broker_type, options, frames = register("other token")
+        assert options["ready"] is False
+        assert frames == [b'\x00']
+
+        broker.shutdown()
+        thread.join(5)
+        assert not thread.is_alive()
+
+        for socket in [req, sub]:
+            socket.close(linger=0)
+
+    def test_serve_replies_out_of_order(self):
+        address = "tcp://127.0.0.1:5557"
+        sub_address = "tcp://127.0.0.1:5558"
+
+        broker = DirectBroker(address)
+        broker.ready_timeout = 1
+        thread = threading.Thread(target=broker.serve, args=[.05])
+        thread.start()
+
+        # Nobody subscribes to the token, so this registration is held until it times out
+        dealer = ctx.socket(zmq.DEALER)
+        dealer.connect(address)
+        dealer.send_multipart([b"7", b"", REG_SUB.encode(ENCODING), TOPIC.encode(ENCODING),
+                               sub_address.encode(ENCODING), pack_options({"ready": "token"})])
+
+        req = ctx.socket(zmq.REQ)
+        req.connect(address)
+        req.send_multipart([REG_PUB.encode(ENCODING), TOPIC.encode(ENCODING), PUB_ADDRESS.encode(ENCODING)])
+        assert req.poll(500)
+        assert req.recv_multipart() == [b"DIRECT"]
+        assert not dealer.poll(0)
+
+        assert dealer.poll(2000)
+        request_id, delimiter, *reply = dealer.recv_multipart()
+        assert (request_id, delimiter) == (b"7", b"")
+        broker_type, options, frames = split_reply(reply)
+        assert broker_type == BrokerType.DIRECT
+        assert options["ready"] is False
+        # The publisher registered meanwhile is included
+        assert frames == [b'\x01', PUB_ADDRESS.encode(ENCODING)]
+
+        broker.shutdown()
+        thread.join(5)
+        assert not thread.is_alive()
+
+        for socket in [req, dealer]:
+            socket.close(linger=0)
+
+    def test_process_registration_many(self):
+        address = "tcp://127.0.0.1:5556"
+        other_address = "tcp://127.0.0.1:5555"
+        broker = DirectBroker(address)
+        req = ctx.socket(zmq.REQ)
+        req.connect(address)
+
+        def register(reg_type, topics, reg_address):
+            future = executor.submit(broker.process_registration)
+            req.send_multipart([reg_type.encode(ENCODING), topics, reg_address.encode(ENCODING)])
+            future.result(10)
+            return req.recv_multipart()
+
+        assert register(REG_PUB_MANY, pack_topics(["topic 1", "topic 2"]), PUB_ADDRESS) == [b"DIRECT"]
+        assert register(REG_PUB, b"topic 2", other_address) == [b"DIRECT"]
+        assert broker.registry["topic 1"] == [PUB_ADDRESS.encode(ENCODING)]
+        assert broker.registry["topic 2"] == [PUB_ADDRESS.encode(ENCODING), other_address.encode(ENCODING)]
+
+        # Every publisher of every topic, once each
+        message = register(REG_SUB_MANY, pack_topics(["topic 1", "topic 2", "topic 3"]), SUB_ADDRESS)
+        assert message == [b"DIRECT", b'\x01', PUB_ADDRESS.encode(ENCODING), other_address.encode(ENCODING)]
+
+        message = register(REG_SUB_MANY, pack_topics(["topic 3"]), SUB_ADDRESS)
+        assert message == [b"DIRECT", b'\x00']
+        assert broker.stats.registrations == {REG_PUB: 3, REG_SUB: 4}
+
+        req.close(linger=0)
+
+    def test_process_registration_prefix(self):
+        address = "tcp://127.0.0.1:5556"
+        other_address = "tcp://127.0.0.1:5555"
+        broker = DirectBroker(address)
+        req = ctx.socket(zmq.REQ)
+        req.connect(address)
+
+        def register(reg_type, topic, reg_address):
+            future = executor.submit(broker.process_registration)
+            req.send_multipart([reg_type.encode(ENCODING), topic.encode(ENCODING), reg_address.encode(ENCODING)])
+            future.result(10)
+            return req.recv_multipart()
+
+        register(REG_PUB, "sensor/temp", PUB_ADDRESS)
+        register(REG_PUB, "sensor/temp", PUB_ADDRESS)
+        register(REG_PUB, "sensor/humidity", other_address)
+        register(REG_PUB, "sensors", other_address)
+        register(REG_PUB, "other", other_address)
+        assert broker.registry["sensor/temp"] == [PUB_ADDRESS.encode(ENCODING)]
+
+        # A subscription matches every topic it is a prefix of
+        message = register(REG_SUB, "sensor/", SUB_ADDRESS)
+        assert message == [b"DIRECT", b'\x01', PUB_ADDRESS.encode(ENCODING), other_address.encode(ENCODING)]
+
+        message = register(REG_SUB, "sensor/temp/inside", SUB_ADDRESS)
+        assert message == [b"DIRECT", b'\x00']
+
+        # Wildcard patterns match by segment
+        message = register(REG_SUB, "*/humidity", SUB_ADDRESS)
+        assert message == [b"DIRECT", b'\x01', other_address.encode(ENCODING)]
+
+        req.close(linger=0)
+
+    def test_process_registration_dictionaries(self):
+        address = "tcp://127.0.0.1:5556"
+        broker = DirectBroker(address)
+        req = ctx.socket(zmq.REQ)
+        req.connect(address)
+
+        def register(reg_type, topic, options):
+            future = executor.submit(broker.process_registration)
+            req.send_multipart([reg_type.encode(ENCODING), topic.encode(ENCODING), PUB_ADDRESS.encode(ENCODING),
+                                pack_options(options)])
+            future.result(10)
+            return split_reply(req.recv_multipart())
+
+        register(REG_PUB, "sensor/temp", {"dictionaries": {"sensor/temp": "ZGljdGlvbmFyeQ=="}})
+        register(REG_PUB, "other", {"dictionaries": {"other": "b3RoZXI="}})
+        assert broker.dictionaries == {"sensor/temp": "ZGljdGlvbmFyeQ==", "other": "b3RoZXI="}
+
+        # Subscribers get the dictionaries of the topics they match when they ask for them
+        broker_type, options, _ = register(REG_SUB, "sensor/", {"dictionaries": True})
+        assert options["dictionaries"] == {"sensor/temp": "ZGljdGlvbmFyeQ=="}
+        assert "dictionaries" not in register(REG_SUB, "sensor/", {})[1]
+
+        broker_type, options, frames = register(LOOKUP_DICTIONARIES, "*/temp", {"dictionaries": True})
+        assert broker_type == BrokerType.DIRECT
+        assert options["dictionaries"] == {"sensor/temp": "ZGljdGlvbmFyeQ=="}
+        assert frames == []
+        assert broker.stats.registrations == {REG_PUB: 2, REG_SUB: 2}
+
+        req.close(linger=0)
@@ -0,0 +1,86 @@
+import threading
+import time
+from collections import defaultdict
+
+from pubsub.util import shard_for_topic
+from pubsub.dispatch import Dispatcher, DispatchMode
+from pubsub.subscriber import Subscriber
+
+sub_address = "tcp://127.0.0.1:5605"
+broker_address = "tcp://127.0.0.1:5606"
+
+
+def noop_callback(topic, message):
+    pass
+
+
+def test_ordered_per_topic():
+    received = defaultdict(list)
+
+    def callback(topic, message):
+        time.sleep(.001)
+        received[topic].append(message)
+
+    dispatcher = Dispatcher(num_workers=4)
+    for i in range(50):
+        for topic in ["one", "two", "three"]:
+            dispatcher.submit(callback, topic, i)
+    dispatcher.shutdown()
+
+    assert received == {topic: list(range(50)) for topic in ["one", "two", "three"]}
+
+    statistics = dispatcher.statistics()
+    assert statistics["callbacks"] == 150
+    assert statistics["errors"] == 0
+    assert statistics["queue_depth"] == [0] * 4
+    assert max(statistics["max_queue_depth"]) > 1
+    assert statistics["max_latency"] >= statistics["mean_latency"] >= .001
+
+
+def test_topics_run_concurrently():
+    # two topics on different lanes can both be inside their callback at once
+    topics = ["a", "b", "c", "d", "e"]
+    first = topics[0]
+    second = next(topic for topic in topics if shard_for_topic(topic, 2) != shard_for_topic(first, 2))
+    barrier = threading.Barrier(2, timeout=5)
+
+    dispatcher = Dispatcher(num_workers=2)
+    dispatcher.submit(lambda topic, message: barrier.wait(), first, None)
+    dispatcher.submit(lambda topic, message: barrier.wait(), second, None)
+    dispatcher.shutdown()
+
+    assert dispatcher.statistics()["errors"] == 0
+
+
+def test_errors_counted():
+    def failing_callback(topic, message):
+        raise ValueError(message)
+
+    dispatcher = Dispatcher(num_workers=1, max_pending=1)
+    dispatcher.submit(failing_callback, "topic", "one")
+    dispatcher.submit(failing_callback, "topic", "two")
+    dispatcher.shutdown()
+
+    statistics = dispatcher.statistics()
+    assert statistics["callbacks"] == 2
+    assert statistics["errors"] == 2
+
+
+def test_process_mode():
+    dispatcher = Dispatcher(num_workers=2, mode=DispatchMode.PROCESS)
+    dispatcher.submit(noop_callback, "topic", "message")
+    dispatcher.shutdown()
+
+    assert dispatcher.statistics()["callbacks"] == 1
+
+
+def test_subscriber_notify():
+    received = []
+    dispatcher = Dispatcher(num_workers=2)
+    subscriber = Subscriber(sub_address, broker_address, dispatcher=dispatcher)
+    subscriber.register_callback(lambda topic, message: received.append((topic, message)))
+
+    subscriber.notify("topic", "message")
+    dispatcher.shutdown()
+
+    assert received == [("topic", "message")]
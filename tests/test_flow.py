@@ -0,0 +1,118 @@
+import time
+
+import pytest
+import zmq
+
+from pubsub.flow import BLOCK, DROP, FlowControl, TokenBucket
+
+ctx = zmq.Context()
+
+
+def connected_pair(flow, address):
+    pub = ctx.socket(zmq.XPUB)
+    flow.apply_send(pub)
+    pub.bind(address)
+    sub = ctx.socket(zmq.SUB)
+    flow.apply(sub)
+    sub.connect(address)
+    sub.setsockopt(zmq.SUBSCRIBE, b"")
+    # the subscription arrives once the connection is made
+    pub.recv()
+    return pub, sub
+
+
+def test_token_bucket():
+    bucket = TokenBucket(100, burst=5)
+    assert all(bucket.try_acquire() for _ in range(5))
+    assert not bucket.try_acquire()
+
+    time.sleep(.05)
+    assert bucket.try_acquire(3)
+
+    # more than the burst is let through and paid back by waiting
+    bucket = TokenBucket(100, burst=5)
+    assert bucket.acquire(5) == 0
+    assert 0 < bucket.acquire(5) <= .05
+
+    with pytest.raises(ValueError):
+        TokenBucket(0)
+
+
+def test_policy():
+    flow = FlowControl()
+    flow.set_policy("orders/", BLOCK)
+    flow.set_policy("orders/quotes/", DROP)
+
+    assert flow.policy("orders/new") == BLOCK
+    assert flow.policy(b"orders/new") == BLOCK
+    assert flow.policy("orders/quotes/1") == DROP
+    assert flow.policy("prices") == DROP
+    assert FlowControl(policy=BLOCK).policy("prices") == BLOCK
+
+    with pytest.raises(ValueError):
+        flow.set_policy("prices", "wait")
+
+
+def test_apply():
+    flow = FlowControl(sndhwm=10, rcvhwm=20, sndbuf=1 << 16, send_timeout=.5)
+    socket = ctx.socket(zmq.XPUB)
+    flow.apply_send(socket)
+    assert socket.getsockopt(zmq.SNDHWM) == 10
+    assert socket.getsockopt(zmq.RCVHWM) == 20
+    assert socket.getsockopt(zmq.SNDBUF) == 1 << 16
+    # blocking sends wait up to the send timeout
+    assert socket.getsockopt(zmq.SNDTIMEO) == 500
+    socket.close()
+
+    socket = ctx.socket(zmq.XPUB)
+    FlowControl().apply_send(socket, send_timeout=2)
+    assert socket.getsockopt(zmq.SNDTIMEO) == 2000
+    socket.close()
+
+
+def test_send_drop():
+    flow = FlowControl(sndhwm=1, rcvhwm=1)
+    pub, sub = connected_pair(flow, "inproc://flow-drop")
+
+    # the subscriber does not read, so its queue fills up
+    sent = sum(flow.send(pub, "topic", [b"topic", b"message"]) for _ in range(10))
+    assert 0 < sent < 10
+    assert flow.dropped["topic"] == 10 - sent
+    assert flow.statistics() == {"topic": {"dropped": 10 - sent, "throttled": 0, "blocked": 0}}
+
+    # every message sent is received, the others were counted as dropped
+    received = 0
+    while sub.poll(100):
+        sub.recv_multipart()
+        received += 1
+    assert received == sent
+
+    pub.close()
+    sub.close()
+
+
+def test_send_block():
+    flow = FlowControl(sndhwm=1, rcvhwm=1, policy=BLOCK, send_timeout=.1)
+    pub, sub = connected_pair(flow, "inproc://flow-block")
+
+    # a blocked send goes through once the subscriber reads
+    while flow.send(pub, b"topic", [b"topic", b"message"]) and not flow.blocked:
+        pass
+    assert flow.dropped[b"topic"] == 1
+    assert sub.recv_multipart() == [b"topic", b"message"]
+    assert flow.send(pub, b"topic", [b"topic", b"message"])
+
+    pub.close()
+    sub.close()
+
+
+def test_admit():
+    flow = FlowControl(rate=100, burst=2)
+    flow.set_policy("slow", BLOCK)
+    assert flow.admit("topic", 2)
+    assert not flow.admit("topic")
+    assert flow.throttled["topic"] == 1
+
+    assert flow.admit("slow")
+    assert flow.blocked["slow"] == 1
+    assert FlowControl().admit("topic", 1000)
@@ -0,0 +1,49 @@
+import json
+
+from local_scaling import remove_results, run_name, summarize, topic_names
+from pubsub.metrics import Histogram
+
+config = {"subscribers": 2, "publishers": 1, "size": 64, "topics": 1, "broker": "r", "messages": 10}
+
+
+def test_run_name():
+    assert run_name(config, set()) == "sub-2_broker-r"
+    assert run_name(config, {"size", "publishers"}) == "sub-2_broker-r_pub-1_size-64"
+
+
+def test_topic_names():
+    assert topic_names(1) == ["lorem"]
+    assert topic_names(3) == ["lorem-0000", "lorem-0001", "lorem-0002"]
+
+
+def test_summarize():
+    reports = [
+        {"name": "pub-0", "role": "publisher", "sent": 10},
+        {"name": "sub-0", "role": "subscriber", "received": 10, "first": 100.0, "last": 101.0},
+        {"name": "sub-1", "role": "subscriber", "received": 8, "first": 100.5, "last": 102.0},
+    ]
+    latency = Histogram()
+    for value in range(1, 101):
+        latency.record(value * 1000)
+
+    summary = summarize(config, reports, latency)
+    assert summary["sent"] == 10
+    assert summary["received"] == 18
+    assert summary["lost"] == 2
+    assert summary["throughput"] == 9.0
+    assert abs(summary["latency"]["p50"] - .05) < .0005
+    assert summary["latency"]["max"] == .1
+    assert [report["name"] for report in summary["processes"]] == ["pub-0", "sub-0", "sub-1"]
+
+
+def test_remove_results(tmp_path):
+    results = tmp_path / "scaling.json"
+    results.write_text(json.dumps([{"name": "sub-2_broker-r"}]))
+    for file in ["sub-2_broker-r.log", "sub-2_broker-r.metrics", "sub-1_broker-r.log"]:
+        (tmp_path / file).write_text("")
+
+    remove_results(str(results))
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["sub-1_broker-r.log"]
+
+    # nothing to remove without a previous run
+    remove_results(str(results))
@@ -0,0 +1,74 @@
+import logging
+
+from pubsub import LOGGER, PERF_LOGGER
+from pubsub.logs import PERF_RECORD, PerfMode, PerfRing, configure_logging, log_perf, message_size, perf_enabled, \
+    read_perf_records, stop_logging
+
+
+def test_not_configured():
+    assert not LOGGER.handlers
+    assert not PERF_LOGGER.isEnabledFor(logging.INFO)
+    assert not perf_enabled()
+
+
+def test_message_size():
+    assert message_size("message") == 7
+    assert message_size(12) == 0
+
+
+def test_perf_ring():
+    ring = PerfRing(capacity=3)
+    for i in range(5):
+        ring.record(i / 10, 100.0 + i, 5, i)
+
+    assert ring.overwritten == 2
+    assert ring.records() == [(.2, 102.0, 5, 2), (.3, 103.0, 5, 3), (.4, 104.0, 5, 4)]
+
+
+def test_configure_text(tmp_path):
+    log_file = tmp_path / "pubsub.log"
+    perf_file = tmp_path / "pubsub_perf.log"
+
+    configure_logging(str(log_file), str(perf_file))
+    assert perf_enabled()
+    LOGGER.info("application message")
+    LOGGER.debug("not written")
+    log_perf(.5, 100.0, 5, 10)
+
+    # mutable arguments are formatted before they can change
+    topics = ["topic"]
+    LOGGER.info("topics %s", topics)
+    topics.append("changed")
+    stop_logging()
+
+    assert log_file.read_text().count("\n") == 2
+    assert "application message" in log_file.read_text()
+    assert "topics ['topic']\n" in log_file.read_text()
+    assert perf_file.read_text() == "0.5, 100.0, 5, 10\n"
+    assert not LOGGER.handlers
+
+
+def test_configure_ring(tmp_path):
+    perf_file = tmp_path / "pubsub_perf.bin"
+
+    configure_logging(None, str(perf_file), perf_mode=PerfMode.RING)
+    log_perf(.5, 100.0, 5, 10)
+    log_perf(.25, 101.0, 5, 11)
+    stop_logging()
+
+    assert list(read_perf_records(str(perf_file))) == [(.5, 100.0, 5, 10), (.25, 101.0, 5, 11)]
+
+
+def test_configure_binary(tmp_path):
+    perf_file = tmp_path / "pubsub_perf.bin"
+
+    configure_logging(None, str(perf_file), perf_mode=PerfMode.BINARY)
+    for i in range(5000):
+        log_perf(i / 1000, 100.0 + i, 5, i)
+    stop_logging()
+
+    records = list(read_perf_records(str(perf_file)))
+    assert len(records) == 5000
+    assert records[4999] == (4.999, 5099.0, 5, 4999)
+    assert list(read_perf_records(str(perf_file), PERF_RECORD.size * 2, PERF_RECORD.size * 4)) == \
+        [(.002, 102.0, 5, 2), (.003, 103.0, 5, 3)]
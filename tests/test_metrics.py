@@ -0,0 +1,90 @@
+import math
+import random
+
+import pytest
+
+from pubsub.metrics import Histogram, TopicMetrics, read_exports
+
+
+def test_histogram_precision():
+    histogram = Histogram()
+    values = [random.randint(0, 10 ** 7) for _ in range(10000)]
+    for value in values:
+        histogram.record(value)
+
+    values.sort()
+    for percentile in [50, 99, 99.9]:
+        exact = values[math.ceil(round(len(values) * percentile / 100, 6)) - 1]
+        assert histogram.percentile(percentile) == pytest.approx(exact, rel=1 / 128)
+    assert histogram.percentile(100) == histogram.max == values[-1]
+    assert histogram.min == values[0]
+    assert histogram.count == len(values)
+
+
+def test_histogram_buckets():
+    histogram = Histogram(precision_bits=8)
+    for value in range(0, 1 << 16):
+        index = histogram.index(value)
+        assert histogram.highest_equivalent(index) >= value
+        assert histogram.index(histogram.highest_equivalent(index)) == index
+
+
+def test_histogram_merge():
+    first = Histogram()
+    second = Histogram()
+    for value in range(1000):
+        first.record(value)
+        second.record(value + 1000000)
+
+    first.merge(second)
+    assert first.count == 2000
+    assert first.min == 0
+    assert first.max == 1000999
+    assert first.percentile(50) == 999
+
+    with pytest.raises(ValueError):
+        first.merge(Histogram(precision_bits=4))
+
+
+def test_histogram_to_dict():
+    histogram = Histogram()
+    for value in [1, 5, 5, 300000]:
+        histogram.record(value)
+
+    copy = Histogram.from_dict(histogram.to_dict())
+    assert copy.to_dict() == histogram.to_dict()
+    assert copy.percentile(99) == histogram.percentile(99)
+
+
+def test_export(tmp_path):
+    export_file = str(tmp_path / "pubsub.metrics")
+    metrics = TopicMetrics(export_file=export_file, interval=1)
+
+    metrics.record("topic", .001, 100, metrics.interval_start)
+    metrics.record("topic", .002, 200, metrics.interval_start + .5)
+    # past the interval, exports both messages and this one
+    metrics.record("other", .003, 300, metrics.interval_start + 1)
+    metrics.record("topic", .004, 400, metrics.interval_start + 1.5)
+    metrics.close()
+
+    with open(export_file) as file:
+        assert len(file.readlines()) == 2
+
+    latency, size = read_exports(export_file)
+    assert latency["topic"].count == 3
+    assert latency["other"].count == 1
+    assert latency["topic"].max == 4000
+    assert size["topic"].percentile(50) == 200
+
+
+def test_max_topics():
+    metrics = TopicMetrics(max_topics=2)
+    for topic in ["a", "b", "c", "d", "a"]:
+        metrics.record(topic, .001, 10, 0)
+
+    assert sorted(metrics.latency) == [TopicMetrics.OTHER_TOPIC, "a", "b"]
+    assert metrics.latency["a"].count == 2
+    assert metrics.latency[TopicMetrics.OTHER_TOPIC].count == 2
+
+    with pytest.raises(ValueError):
+        TopicMetrics(max_topics=0)
@@ -0,0 +1,29 @@
+import glob
+import os
+import tempfile
+
+from benchmarks import microbench
+from benchmarks.microbench import compare, run
+
+
+def test_compare():
+    baseline = {"fast": {"ops_per_sec": 1000.0}, "slow": {"ops_per_sec": 1000.0}, "removed": {"ops_per_sec": 1.0}}
+    results = {"fast": {"ops_per_sec": 1200.0}, "slow": {"ops_per_sec": 850.0}, "new": {"ops_per_sec": 5.0}}
+
+    changes, regressions = compare(results, baseline, .1)
+    assert changes == {"fast": 1200 / 1000 - 1, "slow": 850 / 1000 - 1}
+    assert regressions == ["slow"]
+
+
+def test_run():
+    pattern = os.path.join(tempfile.gettempdir(), "pubsub-bench-*")
+    before = set(glob.glob(pattern))
+
+    results = run(["inproc", "ipc"], 20, 1)
+    assert {"publish/ipc/STRING", "wait_for_msg/inproc/STRING", "routing_process/ipc", "registration/direct/inproc",
+            "trie", "patterns", "compress", "decompress"} <= set(results)
+    assert all(result["ops_per_sec"] > 0 for result in results.values())
+
+    # the ipc endpoints' directory is removed again
+    assert microbench.ipc_dir is None
+    assert set(glob.glob(pattern)) == before
@@ -0,0 +1,64 @@
+import pytest
+
+from pubsub.patterns import PatternIndex, is_pattern, literal_prefix, matches, tag, untag
+
+PATTERNS = ["plant/*/temperature", "plant/#", "#", "*/pressure", "plant/boiler/*"]
+
+TOPICS = {
+    "plant": ["plant/#", "#"],
+    "plant/boiler": ["plant/#", "#"],
+    "plant/boiler/temperature": ["plant/*/temperature", "plant/#", "#", "plant/boiler/*"],
+    "plant/boiler/temperature/max": ["plant/#", "#"],
+    "tank/pressure": ["#", "*/pressure"],
+    "plants/boiler/temperature": ["#"],
+}
+
+
+def test_is_pattern():
+    assert is_pattern("plant/*/temperature")
+    assert is_pattern("plant/#")
+    assert not is_pattern("plant/boiler")
+    assert not is_pattern("plant*/boiler")
+    with pytest.raises(ValueError):
+        is_pattern("plant/#/temperature")
+
+
+def test_literal_prefix():
+    assert literal_prefix("plant/*/temperature") == "plant/"
+    assert literal_prefix("plant/#") == "plant"
+    assert literal_prefix("*/pressure") == ""
+    assert literal_prefix("#") == ""
+
+
+def test_tag():
+    tagged = tag("plant/#").decode('utf-8') + "plant/boiler"
+    assert untag(tagged) == ("plant/#", "plant/boiler")
+    assert untag("plant/boiler") == (None, "plant/boiler")
+    assert not tag("plant/#").startswith(tag("plant/"))
+
+
+def test_match():
+    index = PatternIndex()
+    for pattern in PATTERNS:
+        assert index.add(pattern)
+    assert not index.add(PATTERNS[0])
+    with pytest.raises(ValueError):
+        index.add("plant/boiler")
+
+    for topic, expected in TOPICS.items():
+        assert sorted(index.match(topic)) == sorted(expected)
+        assert sorted(pattern for pattern in PATTERNS if matches(pattern, topic)) == sorted(expected)
+
+    # memoized until the patterns change
+    assert "plant" in index.memo
+    assert index.remove("plant/#")
+    assert not index.remove("plant/#")
+    assert index.memo == {}
+    assert sorted(index.match("plant/boiler/temperature")) == ["#", "plant/*/temperature", "plant/boiler/*"]
+    assert len(index) == 4
+
+    for pattern in PATTERNS[1:]:
+        index.remove(pattern)
+    assert list(index.root.children) == ["plant"]
+    index.remove(PATTERNS[0])
+    assert index.root.children == {}
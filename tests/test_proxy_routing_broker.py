@@ -0,0 +1,265 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
+
+import pytest
+import zmq
+
+from pubsub import READY_PREFIX, REG_PUB, REG_SUB
+from pubsub.broker import ProxyRoutingBroker, BrokerType, RoutingBroker
+from pubsub.subscriber import Subscriber
+from pubsub.util import pack_options, split_reply
+
+ctx = zmq.Context()
+broker_address = "tcp://127.0.0.1:5580"
+sub_address = "tcp://127.0.0.1:5581"
+pub_address = "tcp://127.0.0.1:5582"
+capture_address = "tcp://127.0.0.1:5583"
+
+executor = ThreadPoolExecutor(max_workers=2)
+
+
+def process_registrations(broker, count):
+    for _ in range(count):
+        broker.process_registration()
+
+
+class TestProxyRoutingBroker:
+
+    @pytest.fixture(scope="module")
+    def publisher(self):
+        pub = ctx.socket(zmq.PUB)
+        pub.bind(pub_address)
+        yield pub
+        pub.unbind(pub_address)
+
+    @pytest.fixture(scope="module")
+    def subscriber(self):
+        sub = ctx.socket(zmq.SUB)
+        sub.bind(sub_address)
+        yield sub
+        sub.unbind(sub_address)
+
+    def register(self, req, reg_type, topic, address):
+        req.send_string(reg_type, flags=zmq.SNDMORE)
+        req.send_string(topic, flags=zmq.SNDMORE)
+        req.send_string(address)
+        return req.recv_string()
+
+    def test_constructor(self):
+        broker = ProxyRoutingBroker("tcp://127.0.0.1:5584")
+        assert broker.message_in.type == zmq.XSUB
+        assert broker.message_out.type == zmq.XPUB
+        assert broker.proxy_thread.is_alive()
+        # it only shares the registration handling of a routing broker
+        assert broker.broker_type == BrokerType.ROUTE
+        assert not isinstance(broker, RoutingBroker)
+
+        broker.stop()
+        assert broker.proxy_thread is None
+
+    def test_statistics(self):
+        broker = ProxyRoutingBroker("tcp://127.0.0.1:5585")
+        stats = broker.statistics()
+        assert len(stats) == 8
+        assert all(value == 0 for value in stats)
+        broker.stop()
+
+    def test_process_message(self, publisher, subscriber):
+        topic = "topic here"
+
+        broker = ProxyRoutingBroker(broker_address, capture_address)
+        capture = ctx.socket(zmq.SUB)
+        capture.connect(capture_address)
+        capture.setsockopt_string(zmq.SUBSCRIBE, "")
+
+        req = ctx.socket(zmq.REQ)
+        req.connect(broker_address)
+
+        executor.submit(process_registrations, broker, 2)
+
+        logging.info("Register subscriber")
+        assert self.register(req, REG_SUB, topic, sub_address) == BrokerType.ROUTE
+
+        logging.info("Register publisher")
+        assert self.register(req, REG_PUB, topic, pub_address) == BrokerType.ROUTE
+
+        subscriber.setsockopt_string(zmq.SUBSCRIBE, topic)
+        msg_future = executor.submit(subscriber.recv_multipart)
+        sleep(.5)
+
+        publisher.send_string(topic, flags=zmq.SNDMORE)
+        publisher.send_string("message here")
+
+        result = msg_future.result(60)
+        assert result[0].decode('utf-8') == topic
+        assert result[1].decode('utf-8') == "message here"
+
+        # The capture socket also sees subscriptions flowing upstream
+        captured = capture.recv_multipart()
+        while len(captured) == 1:
+            captured = capture.recv_multipart()
+        assert captured == result
+
+        subscriber.setsockopt_string(zmq.UNSUBSCRIBE, topic)
+        broker.stop()
+
+    def test_serve_confirms_ready(self):
+        address = "tcp://127.0.0.1:5586"
+        ready_address = "tcp://127.0.0.1:5587"
+
+        sub = ctx.socket(zmq.SUB)
+        sub.bind(ready_address)
+        sub.setsockopt_string(zmq.SUBSCRIBE, "topic here")
+        sub.setsockopt(zmq.SUBSCRIBE, READY_PREFIX + b"token")
+
+        broker = ProxyRoutingBroker(address)
+        thread = threading.Thread(target=broker.serve, args=[.05])
+        thread.start()
+
+        req = ctx.socket(zmq.REQ)
+        req.connect(address)
+        req.send_multipart([REG_SUB.encode('utf-8'), b"topic here", ready_address.encode('utf-8'),
+                            pack_options({"ready": "token"})])
+        # The bound socket only attaches the broker's connection when it is used
+        while not req.poll(10):
+            sub.getsockopt(zmq.EVENTS)
+        broker_type, options, _ = split_reply(req.recv_multipart())
+        assert broker_type == BrokerType.ROUTE
+        assert options["ready"] is True
+
+        broker.shutdown()
+        thread.join(5)
+        assert not thread.is_alive()
+        broker.stop()
+
+        for socket in [req, sub]:
+            socket.close(linger=0)
+
+    def test_rejects_patterns(self):
+        address = "tcp://127.0.0.1:5579"
+
+        broker = ProxyRoutingBroker(address)
+        thread = threading.Thread(target=broker.serve, args=[.05])
+        thread.start()
+
+        # The plain topic is registered, the pattern is rejected and dropped
+        subscriber = Subscriber("tcp://127.0.0.1:5578", address)
+        with pytest.raises(ValueError):
+            subscriber.register_many(["topic here", "plant/*/temperature"])
+        assert subscriber.topics == ["topic here"]
+        assert not subscriber.patterns
+
+        broker.shutdown()
+        thread.join(5)
+        assert not thread.is_alive()
+        broker.stop()
+
+    def test_interest(self):
+        address = "tcp://127.0.0.1:5573"
+        interest_sub_address = "tcp://127.0.0.1:5572"
+        interest_pub_address = "tcp://127.0.0.1:5571"
+
+        pub = ctx.socket(zmq.XPUB)
+        pub.bind(interest_pub_address)
+        sub = ctx.socket(zmq.SUB)
+        sub.bind(interest_sub_address)
+        sub.setsockopt_string(zmq.SUBSCRIBE, "topic")
+        sub.setsockopt(zmq.SUBSCRIBE, READY_PREFIX + b"token")
+
+        broker = ProxyRoutingBroker(address)
+        thread = threading.Thread(target=broker.serve, args=[.05])
+        thread.start()
+
+        req = ctx.socket(zmq.REQ)
+        req.connect(address)
+        req.send_multipart([REG_SUB.encode('utf-8'), b"topic", interest_sub_address.encode('utf-8'),
+                            pack_options({"ready": "token"})])
+        while not req.poll(10):
+            sub.getsockopt(zmq.EVENTS)
+        assert split_reply(req.recv_multipart())[1]["ready"] is True
+
+        # Publishers are told which topics subscribers want, and only get their subscriptions
+        req.send_multipart([REG_PUB.encode('utf-8'), b"topic here", interest_pub_address.encode('utf-8'),
+                            pack_options({})])
+        assert split_reply(req.recv_multipart())[1]["subscribes"] is True
+        req.send_multipart([REG_PUB.encode('utf-8'), b"other", interest_pub_address.encode('utf-8'),
+                            pack_options({})])
+        assert "subscribes" not in split_reply(req.recv_multipart())[1]
+
+        assert pub.poll(5000)
+        events = {pub.recv()}
+        while pub.poll(200):
+            events.add(pub.recv())
+        assert b"\x01topic" in events
+        assert not any(event.startswith(b"\x01other") for event in events)
+
+        broker.shutdown()
+        thread.join(5)
+        assert not thread.is_alive()
+        broker.stop()
+
+        for socket in [req, pub, sub]:
+            socket.close(linger=0)
+
+    def test_registration_keeps_forwarding(self):
+        address = "tcp://127.0.0.1:5622"
+        forward_sub_address = "tcp://127.0.0.1:5621"
+        forward_pub_address = "tcp://127.0.0.1:5620"
+        num_msg = 2000
+
+        pub = ctx.socket(zmq.XPUB)
+        pub.bind(forward_pub_address)
+        sub = ctx.socket(zmq.SUB)
+        sub.bind(forward_sub_address)
+        sub.setsockopt_string(zmq.SUBSCRIBE, "topic")
+        sub.setsockopt(zmq.SUBSCRIBE, READY_PREFIX + b"token")
+        sub.setsockopt(zmq.RCVTIMEO, 5000)
+
+        broker = ProxyRoutingBroker(address)
+        thread = threading.Thread(target=broker.serve, args=[.05])
+        thread.start()
+
+        req = ctx.socket(zmq.REQ)
+        req.connect(address)
+        req.send_multipart([REG_SUB.encode('utf-8'), b"topic", forward_sub_address.encode('utf-8'),
+                            pack_options({"ready": "token"})])
+        while not req.poll(10):
+            sub.getsockopt(zmq.EVENTS)
+        assert split_reply(req.recv_multipart())[1]["ready"] is True
+        assert self.register(req, REG_PUB, "topic", forward_pub_address) == BrokerType.ROUTE
+        assert pub.poll(5000)
+        while pub.recv() != b"\x01topic":
+            pass
+
+        def publish():
+            for i in range(num_msg):
+                pub.send_multipart([b"topic", str(i).encode('utf-8')])
+                if i % 50 == 0:
+                    sleep(.001)
+
+        # Other clients register while messages are being forwarded, by the same proxy thread
+        proxy_thread = broker.proxy_thread
+        publishing = executor.submit(publish)
+        others = []
+        for port in range(5612, 5620):
+            other = ctx.socket(zmq.PUB if port % 2 else zmq.SUB)
+            other_address = f"tcp://127.0.0.1:{port}"
+            other.bind(other_address)
+            others.append(other)
+            reg_type = REG_PUB if port % 2 else REG_SUB
+            assert self.register(req, reg_type, "other", other_address) == BrokerType.ROUTE
+        publishing.result(60)
+        assert broker.proxy_thread is proxy_thread
+
+        received = [int(sub.recv_multipart()[1]) for _ in range(num_msg)]
+        assert received == list(range(num_msg))
+
+        broker.shutdown()
+        thread.join(5)
+        assert not thread.is_alive()
+        broker.stop()
+
+        for socket in [req, pub, sub] + others:
+            socket.close(linger=0)
@@ -1,3 +1,5 @@
+import gc
+import json
 import logging
 import os
 import re
@@ -9,9 +11,12 @@ from time import sleep
 import pytest
 import zmq
 
-from pubsub import REG_PUB
+from pubsub import REG_PUB, REG_PUB_MANY
+from pubsub.compression import Compression, TopicCompression
+from pubsub.flow import BLOCK, FlowControl
 from pubsub.publisher import Publisher
-from pubsub.util import MessageType, TopicNotRegisteredError
+from pubsub.util import MessageType, TopicNotRegisteredError, WireFormat, pack_options, unpack_batch, unpack_envelope, \
+    unpack_topics
 
 ctx = zmq.Context()
 pub_address = "tcp://127.0.0.1:5557"
@@ -23,6 +28,13 @@ time_stamp_regex = re.compile(r'\d{2}/\d{2}/\d{4}\s+\d{2}:\d{2}:\d{2}')
 
 class TestPublisher:
 
+    @pytest.fixture(autouse=True)
+    def collect_publishers(self):
+        # Publishers kept alive by exception tracebacks still hold their
+        # bound address until they are garbage collected
+        yield
+        gc.collect()
+
     @pytest.fixture(scope="module")
     def reply(self):
         reply = ctx.socket(zmq.REP)
@@ -38,9 +50,8 @@ class TestPublisher:
         assert publisher.registration is not None
 
     def broker_recv_reg(self, socket):
-        reg_type = socket.recv_string()
-        topic = socket.recv_string()
-        address = socket.recv_string()
+        message = socket.recv_multipart()
+        reg_type, topic, address = [part.decode('utf-8') for part in message[:3]]
         socket.send_string("TEST_BROKER")
         return reg_type, topic, address
 
@@ -58,6 +69,101 @@ class TestPublisher:
         assert result[1] == topic
         assert result[2] == pub_address
 
+    def broker_recv_reg_frames(self, socket):
+        message = socket.recv_multipart()
+        socket.send_string("TEST_BROKER")
+        return message
+
+    def test_register_many(self, reply):
+        future = executor.submit(self.broker_recv_reg_frames, reply)
+
+        topics = ["topic 1", "topic 2"]
+        publisher = Publisher(pub_address, broker_address)
+        publisher.register_many(topics)
+
+        result = future.result(60)
+        assert result[0].decode('utf-8') == REG_PUB_MANY
+        assert unpack_topics(result[1]) == topics
+        assert result[2].decode('utf-8') == pub_address
+        assert publisher.topics == topics
+
+    def test_register_without_waiting(self):
+        router_address = "tcp://127.0.0.1:5559"
+        router = ctx.socket(zmq.ROUTER)
+        router.bind(router_address)
+
+        publisher = Publisher(pub_address, router_address)
+        first = publisher.register("topic 1", wait=False)
+        second = publisher.register("topic 2", wait=False)
+        assert not first.done() and not second.done()
+
+        requests = [router.recv_multipart() for _ in range(2)]
+        assert [request[4] for request in requests] == [b"topic 1", b"topic 2"]
+
+        # Replies are matched to their requests whatever order they come in
+        router.send_multipart(requests[1][:3] + [b"DIRECT"])
+        assert second.result(60) == "DIRECT"
+        assert not first.done()
+        router.send_multipart(requests[0][:3] + [b"ROUTE"])
+        assert first.result(60) == "ROUTE"
+        assert publisher.broker_type == "ROUTE"
+
+        router.close(linger=0)
+
+    def test_register_compact(self, reply, broker_sub_multipart):
+        future = executor.submit(self.broker_reply_compact, reply)
+
+        topic = "the topic name"
+        publisher = Publisher(pub_address, broker_address)
+        publisher.register(topic)
+        future.result(60)
+        assert publisher.wire_format == WireFormat.COMPACT
+
+        sleep(.5)
+        publisher.publish(topic, "message here")
+
+        frames = broker_sub_multipart.result(60)
+        assert len(frames) == 3
+        assert unpack_envelope(frames)[0] == topic
+        assert unpack_envelope(frames)[2] == MessageType.STRING
+        assert frames[2] == b"message here"
+
+    def test_publish_compressed(self, reply, broker_sub_multipart):
+        topic = "the topic name"
+        compression = Compression(samples=10)
+        compression.configure(topic, TopicCompression(threshold=0))
+        future = executor.submit(self.broker_reply_compact, reply)
+        publisher = Publisher(pub_address, broker_address, compression=compression)
+        publisher.register(topic)
+        assert "dictionaries" not in json.loads(future.result(60)[3])
+
+        sleep(.5)
+        message = "message here, message here, message here"
+        publisher.publish(topic, message)
+
+        frames = broker_sub_multipart.result(60)
+        assert len(frames[2]) < len(message)
+        assert unpack_envelope(frames, Compression().decompress)[4] == [message.encode('utf-8')]
+
+        # Training registers the topic again with the dictionary, which is used
+        # once the broker has it
+        for _ in range(9):
+            publisher.publish(topic, message)
+        future = executor.submit(self.broker_reply_compact, reply)
+        publisher.train_dictionary(topic, 1024)
+        dictionaries = json.loads(future.result(60)[3])["dictionaries"]
+        assert list(dictionaries) == [topic]
+        assert compression.settings(topic).dictionary is not None
+        assert publisher.topics == [topic]
+
+        with pytest.raises(TopicNotRegisteredError):
+            publisher.train_dictionary("other topic")
+
+    def broker_reply_compact(self, socket):
+        message = socket.recv_multipart()
+        socket.send_multipart([b"ROUTE", pack_options({"wire_format": WireFormat.COMPACT})])
+        return message
+
     @pytest.fixture()
     def broker_sub(self):
         sub = ctx.socket(zmq.SUB)
@@ -109,6 +215,69 @@ class TestPublisher:
         assert result[2] == MessageType.PYOBJ
         assert result[3] == message
 
+    @pytest.fixture()
+    def broker_sub_multipart(self):
+        sub = ctx.socket(zmq.SUB)
+        sub.connect(pub_address)
+        sub.setsockopt_string(zmq.SUBSCRIBE, "the topic name")
+        return executor.submit(sub.recv_multipart)
+
+    def test_publish_batch(self, broker_sub_multipart):
+        topic = "the topic name"
+        messages = ["message one", "message two", "message three"]
+        publisher = Publisher(pub_address, broker_address)
+        publisher.topics.append(topic)
+        sleep(.5)
+        # an empty batch is not sent
+        publisher.publish_batch(topic, [])
+        publisher.publish_batch(topic, messages)
+
+        result = broker_sub_multipart.result(60)
+        assert len(result) == 5
+        assert result[0].decode('utf-8') == topic
+        assert result[2].decode('utf-8') == MessageType.BATCH
+        assert result[3].decode('utf-8') == MessageType.STRING
+        assert [message for _, message in unpack_batch(result[4], MessageType.STRING)] == messages
+
+    def test_publish_flow_control(self, broker_sub_multipart):
+        topic = "the topic name"
+        flow = FlowControl(sndhwm=5, rate=10, burst=2)
+        publisher = Publisher(pub_address, broker_address, flow=flow)
+        assert publisher.message_pub.getsockopt(zmq.SNDHWM) == 5
+        publisher.topics.append(topic)
+        sleep(.5)
+
+        # Messages over the rate are dropped and counted
+        for number in range(3):
+            publisher.publish(topic, f"message {number}")
+        assert flow.throttled == {topic: 1}
+        assert broker_sub_multipart.result(60)[3] == b"message 0"
+
+        # or wait for it
+        flow.set_policy(topic, BLOCK)
+        publisher.publish_batch(topic, ["message 3", "message 4"])
+        assert flow.blocked == {topic: 1}
+        assert flow.throttled == {topic: 1}
+
+    def test_publish_auto_batch(self, broker_sub_multipart):
+        topic = "the topic name"
+        publisher = Publisher(pub_address, broker_address, batch_size=3)
+        publisher.topics.append(topic)
+        sleep(.5)
+        publisher.publish(topic, {"number": 1}, MessageType.JSON)
+        publisher.publish(topic, {"number": 2}, MessageType.JSON)
+        assert not broker_sub_multipart.done()
+        assert len(publisher.batches[(topic, MessageType.JSON)]) == 2
+
+        publisher.flush()
+
+        result = broker_sub_multipart.result(60)
+        assert result[2].decode('utf-8') == MessageType.BATCH
+        assert result[3].decode('utf-8') == MessageType.JSON
+        assert [message for _, message in unpack_batch(result[4], MessageType.JSON)] == [{"number": 1},
+                                                                                       {"number": 2}]
+        assert publisher.batches == {}
+
     def test_publish(self):
         with pytest.raises(TopicNotRegisteredError) as err:
             topic = "the topic name"
@@ -117,6 +286,28 @@ class TestPublisher:
             publisher.publish(topic, message)
         assert "Topic has not been registered with publisher" in str(err.value)
 
+    def test_wait_for_subscribers(self):
+        publisher = Publisher(pub_address, broker_address)
+        publisher.topics.append("topic")
+        assert not publisher.wait_for_subscribers(1, .1)
+
+        subs = []
+        for prefix in ["topic", "top", "other"]:
+            sub = ctx.socket(zmq.SUB)
+            sub.setsockopt_string(zmq.SUBSCRIBE, prefix)
+            sub.connect(pub_address)
+            subs.append(sub)
+
+        # Prefixes of the topic count, other topics do not
+        assert publisher.wait_for_subscribers(2, 5)
+        assert publisher.count_subscribers("topic") == 2
+        assert not publisher.wait_for_subscribers(3, .1)
+
+        for sub in subs:
+            sub.close(linger=0)
+        publisher.message_pub.close(linger=0)
+        publisher.registration.close(linger=0)
+
 
 class Person:
 
@@ -1,13 +1,18 @@
+import json
 import logging
 import os
+import threading
 from concurrent.futures import ThreadPoolExecutor
 from time import sleep
 
 import pytest
 import zmq
 
-from pubsub import REG_PUB, REG_SUB
+from pubsub import LOOKUP_DICTIONARIES, READY_PREFIX, REG_ERROR, REG_PUB, REG_SUB, REG_SUB_MANY
 from pubsub.broker import RoutingBroker, BrokerType
+from pubsub.cache import LastValueCache
+from pubsub.flow import BLOCK, FlowControl
+from pubsub.util import RegistrationError, WireFormat, pack_options, pack_topics, split_reply
 
 ctx = zmq.Context()
 broker_address = "tcp://127.0.0.1:5554"
@@ -59,7 +64,13 @@ class TestRoutingBroker:
         broker_type = req.recv_string()
         assert broker_type == BrokerType.ROUTE
 
+        # Nobody is interested in the topic yet, so the broker does not subscribe
+        assert broker.published["topic here"] == [address2]
+        assert broker.interest == {}
+
         logging.info("Test that registration configured broker properly")
+        broker.add_subscription(b"topic")
+        assert broker.interest == {"topic here": 1}
 
         # Start waiting to recv the message in a thread
         future = executor.submit(self.wait_for_msg, broker.message_in)
@@ -112,7 +123,7 @@ class TestRoutingBroker:
         broker = RoutingBroker(broker_address)
 
         logging.info("Register subscriber")
-        executor.submit(broker.process_registration)
+        registration = executor.submit(broker.process_registration)
 
         req = ctx.socket(zmq.REQ)
         req.connect(broker_address)
@@ -125,6 +136,8 @@ class TestRoutingBroker:
         assert broker_type == BrokerType.ROUTE
 
         logging.info("Register publisher")
+        # the socket may still be in use by the previous registration's thread
+        registration.result(5)
         executor.submit(broker.process_registration)
 
         req.send_string(REG_PUB, flags=zmq.SNDMORE)
@@ -151,3 +164,295 @@ class TestRoutingBroker:
         result = msg_future.result(60)
         assert result[0].decode('utf-8') == topic
         assert result[1].decode('utf-8') == "message here"
+
+    def test_negotiate_wire_format(self):
+        # process() from the previous test keeps that broker bound to broker_address
+        address = "tcp://127.0.0.1:5553"
+        broker = RoutingBroker(address, wire_format=WireFormat.LEGACY)
+        executor.submit(broker.process_registration)
+
+        req = ctx.socket(zmq.REQ)
+        req.connect(address)
+
+        req.send_multipart([REG_PUB.encode('utf-8'), b"topic here", address2.encode('utf-8'),
+                            pack_options({"wire_formats": [WireFormat.LEGACY, WireFormat.COMPACT]})])
+
+        broker_type, options, frames = split_reply(req.recv_multipart())
+        assert broker_type == BrokerType.ROUTE
+        assert options == {"wire_format": WireFormat.LEGACY}
+        assert frames == []
+
+    def test_negotiate_wire_format_per_client(self):
+        address = "tcp://127.0.0.1:5610"
+        broker = RoutingBroker(address)
+        req = ctx.socket(zmq.REQ)
+        req.connect(address)
+        offered = pack_options({"wire_formats": [WireFormat.LEGACY, WireFormat.COMPACT]})
+
+        def register(frames):
+            registration = executor.submit(broker.process_registration)
+            req.send_multipart(frames)
+            reply = split_reply(req.recv_multipart())
+            registration.result(5)
+            return reply[1]
+
+        # A subscriber without options predates the compact format
+        assert register([REG_SUB.encode('utf-8'), b"old", b"tcp://127.0.0.1:5609"]) == {}
+        assert broker.legacy_topics == {"old"}
+
+        # so publishers of its topics use the legacy format, and other clients the compact one
+        for topic, wire_format in [(b"old/topic", WireFormat.LEGACY), (b"new", WireFormat.COMPACT)]:
+            options = register([REG_PUB.encode('utf-8'), topic, address2.encode('utf-8'), offered])
+            assert options["wire_format"] == wire_format
+        options = register([REG_SUB.encode('utf-8'), b"old", b"tcp://127.0.0.1:5609", offered])
+        assert options["wire_format"] == WireFormat.COMPACT
+        req.close()
+
+    def test_serve_malformed_registrations(self):
+        address = "tcp://127.0.0.1:5611"
+        broker = RoutingBroker(address)
+        thread = threading.Thread(target=broker.serve, args=[.05])
+        thread.start()
+
+        req = ctx.socket(zmq.REQ)
+        req.connect(address)
+        req.setsockopt(zmq.RCVTIMEO, 5000)
+        for frames in [[REG_PUB.encode('utf-8')],
+                       [REG_PUB.encode('utf-8'), b"topic", address2.encode('utf-8'), b"not json"],
+                       [REG_PUB.encode('utf-8'), b"topic", address2.encode('utf-8'), b"[]"],
+                       [REG_SUB_MANY.encode('utf-8'), b"{}", address1.encode('utf-8')],
+                       [b"UNKNOWN", b"topic", address2.encode('utf-8')],
+                       [LOOKUP_DICTIONARIES.encode('utf-8'), b"topic", address1.encode('utf-8')],
+                       [REG_PUB.encode('utf-8'), b"topic", b"not an address", pack_options({})]]:
+            req.send_multipart(frames)
+            reply = req.recv_multipart()
+            assert reply[0] == REG_ERROR.encode('utf-8')
+            with pytest.raises(RegistrationError):
+                split_reply(reply)
+
+        # the broker is still serving
+        req.send_multipart([REG_PUB.encode('utf-8'), b"topic", address2.encode('utf-8')])
+        assert req.recv_string() == BrokerType.ROUTE
+
+        broker.shutdown()
+        thread.join(5)
+        assert not thread.is_alive()
+        for socket in [req, broker.registration, broker.message_in, broker.message_out]:
+            socket.close(linger=0)
+
+    def test_serve(self):
+        address = "tcp://127.0.0.1:5552"
+        sub_address = "tcp://127.0.0.1:5562"
+        pub_address = "tcp://127.0.0.1:5563"
+        topic = "topic here"
+
+        pub = ctx.socket(zmq.PUB)
+        pub.bind(pub_address)
+        sub = ctx.socket(zmq.SUB)
+        sub.bind(sub_address)
+        sub.setsockopt_string(zmq.SUBSCRIBE, topic)
+
+        stats_address = "tcp://127.0.0.1:5564"
+        broker = RoutingBroker(address, stats_address=stats_address)
+        thread = threading.Thread(target=broker.serve, args=[.05])
+        thread.start()
+
+        req = ctx.socket(zmq.REQ)
+        req.connect(address)
+        for reg_type, reg_address in [(REG_SUB, sub_address), (REG_PUB, pub_address)]:
+            req.send_multipart([reg_type.encode('utf-8'), topic.encode('utf-8'), reg_address.encode('utf-8')])
+            assert req.recv_string() == BrokerType.ROUTE
+
+        # Keep publishing until the connections are up and a message makes it through
+        for _ in range(50):
+            pub.send_multipart([topic.encode('utf-8'), b"message here"])
+            if sub.poll(100):
+                break
+
+        assert sub.recv_multipart() == [topic.encode('utf-8'), b"message here"]
+
+        stats = ctx.socket(zmq.REQ)
+        stats.connect(stats_address)
+        stats.send(b"")
+        snapshot = json.loads(stats.recv())
+        counters = snapshot["topics"][topic]
+        assert snapshot["broker"] == "RoutingBroker"
+        assert snapshot["registrations"] == {"publishers": 1, "subscribers": 1}
+        assert counters["publishers"] == [pub_address]
+        assert counters["subscribers"] == [sub_address]
+        assert counters["messages_out"] >= 1
+        assert counters["messages_in"] == counters["messages_out"] + counters["drops"]
+        assert counters["bytes_out"] == counters["messages_out"] * len(topic + "message here")
+        stats.close(linger=0)
+
+        broker.shutdown()
+        thread.join(5)
+        assert not thread.is_alive()
+
+        for socket in [req, pub, sub]:
+            socket.close(linger=0)
+
+    def test_serve_confirms_ready(self):
+        address = "tcp://127.0.0.1:5551"
+        sub_address = "tcp://127.0.0.1:5565"
+        pub_address = "tcp://127.0.0.1:5566"
+        topic = "topic here"
+
+        pub = ctx.socket(zmq.XPUB)
+        pub.bind(pub_address)
+        sub = ctx.socket(zmq.SUB)
+        sub.bind(sub_address)
+        sub.setsockopt_string(zmq.SUBSCRIBE, topic)
+        sub.setsockopt(zmq.SUBSCRIBE, READY_PREFIX + b"token")
+
+        broker = RoutingBroker(address)
+        thread = threading.Thread(target=broker.serve, args=[.05])
+        thread.start()
+
+        req = ctx.socket(zmq.REQ)
+        req.connect(address)
+        req.send_multipart([REG_SUB.encode('utf-8'), topic.encode('utf-8'), sub_address.encode('utf-8'),
+                            pack_options({"ready": "token"})])
+        # The bound socket only attaches the broker's connection when it is used
+        while not req.poll(10):
+            sub.getsockopt(zmq.EVENTS)
+        broker_type, options, _ = split_reply(req.recv_multipart())
+        assert broker_type == BrokerType.ROUTE
+        assert options["ready"] is True
+
+        # The broker tells publishers that it subscribes to them
+        req.send_multipart([REG_PUB.encode('utf-8'), topic.encode('utf-8'), pub_address.encode('utf-8'),
+                            pack_options({})])
+        broker_type, options, _ = split_reply(req.recv_multipart())
+        assert options["subscribes"] is True
+        assert pub.poll(5000)
+        assert pub.recv() == b'\x01' + topic.encode('utf-8')
+
+        # With the subscription seen, nothing published is lost
+        pub.send_multipart([topic.encode('utf-8'), b"message here"])
+        assert sub.poll(5000)
+        assert sub.recv_multipart() == [topic.encode('utf-8'), b"message here"]
+
+        broker.shutdown()
+        thread.join(5)
+        assert not thread.is_alive()
+
+        for socket in [req, pub, sub]:
+            socket.close(linger=0)
+
+    def test_interest(self):
+        broker = RoutingBroker("tcp://127.0.0.1:5550")
+        # Replies go nowhere without an envelope
+        broker.process_pub_registrations(["plant/boiler/temperature", "plant/boiler/pressure", "tank/pressure"],
+                                         address2)
+        assert broker.interest == {}
+
+        broker.add_subscription(b"plant/")
+        broker.add_pattern("*/*/pressure")
+        assert broker.interest == {"plant/boiler/temperature": 1, "plant/boiler/pressure": 2}
+
+        # A topic registered later counts every prefix and pattern matching it
+        broker.reply_options = {}
+        broker.process_pub_registrations(["plant/pump/pressure", "other"], address2)
+        assert broker.reply_options == {"subscribed": ["plant/pump/pressure"]}
+        assert broker.interest["plant/pump/pressure"] == 2
+
+        broker.remove_subscription(b"plant/")
+        assert broker.interest == {"plant/boiler/pressure": 1, "plant/pump/pressure": 1}
+        broker.remove_pattern("*/*/pressure")
+        assert broker.interest == {}
+
+        for socket in [broker.registration, broker.message_in, broker.message_out]:
+            socket.close(linger=0)
+
+    def test_snapshot(self):
+        address = "tcp://127.0.0.1:5549"
+        broker = RoutingBroker(address, cache=LastValueCache())
+        topics = ["plant/boiler/temperature", "plant/boiler/pressure", "tank/pressure", "tank/level"]
+        broker.process_pub_registrations(topics, address2)
+        # the cache is interested in every topic
+        assert broker.interest == dict.fromkeys(topics, 1)
+
+        for topic, value in [(topics[0], b"20"), (topics[0], b"21"), (topics[1], b"3"), (topics[2], b"4")]:
+            broker.forward([zmq.Frame(topic.encode('utf-8')), zmq.Frame(value)])
+
+        req = ctx.socket(zmq.REQ)
+        req.connect(address)
+
+        registration = executor.submit(broker.process_registration)
+        req.send_multipart([REG_SUB_MANY.encode('utf-8'), pack_topics(["plant/boiler/", "*/pressure", "tank/level"]),
+                            address1.encode('utf-8'), pack_options({"snapshot": True})])
+        broker_type, options, frames = split_reply(req.recv_multipart())
+        assert broker_type == BrokerType.ROUTE
+        assert options["snapshot"] == [2, 2, 2]
+        assert sorted(zip(frames[::2], frames[1::2])) == [(b"plant/boiler/pressure", b"3"),
+                                                          (b"plant/boiler/temperature", b"21"),
+                                                          (b"tank/pressure", b"4")]
+
+        # Only subscribers that ask get a snapshot
+        registration.result(5)
+        executor.submit(broker.process_registration)
+        req.send_multipart([REG_SUB.encode('utf-8'), b"tank/", address1.encode('utf-8'), pack_options({})])
+        broker_type, options, frames = split_reply(req.recv_multipart())
+        assert "snapshot" not in options
+        assert frames == []
+
+        req.close(linger=0)
+        for socket in [broker.registration, broker.message_in, broker.message_out]:
+            socket.close(linger=0)
+
+    def test_flow_control(self):
+        flow = FlowControl(sndhwm=1, rcvhwm=1)
+        flow.set_policy("blocking", BLOCK)
+        broker = RoutingBroker("tcp://127.0.0.1:5548", flow=flow)
+        assert broker.message_out.getsockopt(zmq.SNDHWM) == 1
+        assert broker.message_in.getsockopt(zmq.RCVHWM) == 1
+
+        broker.message_out.bind("inproc://routing-flow")
+        sub = broker.context.socket(zmq.SUB)
+        flow.apply(sub)
+        sub.connect("inproc://routing-flow")
+        sub.setsockopt(zmq.SUBSCRIBE, b"")
+        assert broker.message_out.recv() == b"\x01"
+
+        # The subscriber does not read, messages that find its queue full are counted
+        for _ in range(10):
+            broker.forward([zmq.Frame(b"topic"), zmq.Frame(b"message")])
+        dropped = broker.stats.snapshot()["topics"]["topic"]["hwm_drops"]
+        assert 0 < dropped < 10
+        assert flow.dropped[b"topic"] == dropped
+
+        # unless the topic waits for room, at most for the default send timeout
+        assert broker.message_out.getsockopt(zmq.SNDTIMEO) == 1000
+        broker.message_out.setsockopt(zmq.SNDTIMEO, 10)
+        broker.forward([zmq.Frame(b"blocking"), zmq.Frame(b"message")])
+        assert flow.blocked[b"blocking"] == 1
+
+        for socket in [broker.registration, broker.message_in, broker.message_out, sub]:
+            socket.close(linger=0)
+
+    def test_flow_control_drop(self):
+        flow = FlowControl(sndhwm=10, rcvhwm=10)
+        broker = RoutingBroker("tcp://127.0.0.1:5547", flow=flow)
+        assert broker.message_out.getsockopt(zmq.SNDTIMEO) == 1000
+
+        broker.message_out.bind("inproc://routing-flow-drop")
+        sub = broker.context.socket(zmq.SUB)
+        flow.apply(sub)
+        sub.connect("inproc://routing-flow-drop")
+        sub.setsockopt(zmq.SUBSCRIBE, b"topic")
+        assert broker.message_out.recv() == b"\x01topic"
+
+        # The subscriber does not read, so its queue fills up and the messages
+        # that do not fit are dropped and counted
+        for index in range(100):
+            broker.forward([zmq.Frame(b"topic"), zmq.Frame(str(index).encode())])
+        received = 0
+        while sub.poll(100):
+            sub.recv_multipart()
+            received += 1
+        assert 0 < received < 100
+        assert broker.stats.snapshot()["topics"]["topic"]["hwm_drops"] == 100 - received
+
+        for socket in [broker.registration, broker.message_in, broker.message_out, sub]:
+            socket.close(linger=0)
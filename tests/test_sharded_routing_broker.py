@@ -0,0 +1,248 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
+
+import pytest
+import zmq
+
+from pubsub import READY_PREFIX, REG_PUB, REG_SUB
+from pubsub.broker import ShardedRoutingBroker, BrokerType
+from pubsub.patterns import tag
+from pubsub.util import pack_options, shard_for_topic, split_reply
+
+ctx = zmq.Context()
+broker_address = "tcp://127.0.0.1:5590"
+sub_address = "tcp://127.0.0.1:5591"
+pub_address = "tcp://127.0.0.1:5592"
+
+executor = ThreadPoolExecutor(max_workers=2)
+
+
+def process_registrations(broker, count):
+    for _ in range(count):
+        broker.process_registration()
+
+
+def test_shard_for_topic():
+    shards = {shard_for_topic(f"topic {i}", 4) for i in range(100)}
+    assert shards == {0, 1, 2, 3}
+    assert shard_for_topic("topic here", 4) == shard_for_topic("topic here", 4)
+
+
+class TestShardedRoutingBroker:
+
+    @pytest.fixture(scope="module")
+    def publisher(self):
+        pub = ctx.socket(zmq.PUB)
+        pub.bind(pub_address)
+        yield pub
+        pub.unbind(pub_address)
+
+    @pytest.fixture(scope="module")
+    def subscriber(self):
+        sub = ctx.socket(zmq.SUB)
+        sub.bind(sub_address)
+        yield sub
+        sub.unbind(sub_address)
+
+    def register(self, req, reg_type, topic, address):
+        req.send_string(reg_type, flags=zmq.SNDMORE)
+        req.send_string(topic, flags=zmq.SNDMORE)
+        req.send_string(address)
+        return req.recv_string()
+
+    def wait_for_msgs(self, socket, count):
+        topics = set()
+        for _ in range(count):
+            topics.add(socket.recv_string())
+            socket.recv_string()
+        return topics
+
+    def test_process_message(self, publisher, subscriber):
+        topics = ["topic one", "topic two", "topic three"]
+
+        broker = ShardedRoutingBroker(broker_address, num_shards=2)
+        assert len(broker.shards) == 2
+
+        req = ctx.socket(zmq.REQ)
+        req.connect(broker_address)
+
+        executor.submit(process_registrations, broker, 1 + len(topics))
+
+        # The subscriber registers a prefix of every topic, so it is connected
+        # to the shards of the topics publishers register
+        logging.info("Register subscriber")
+        assert self.register(req, REG_SUB, "topic", sub_address) == BrokerType.ROUTE
+
+        logging.info("Register publisher")
+        for topic in topics:
+            assert self.register(req, REG_PUB, topic, pub_address) == BrokerType.ROUTE
+
+        subscriber.setsockopt_string(zmq.SUBSCRIBE, "topic")
+        msg_future = executor.submit(self.wait_for_msgs, subscriber, len(topics))
+        sleep(1)
+
+        for topic in topics:
+            publisher.send_string(topic, flags=zmq.SNDMORE)
+            publisher.send_string("message here")
+
+        received = msg_future.result(60)
+        assert received == set(topics)
+
+        subscriber.setsockopt_string(zmq.UNSUBSCRIBE, "topic")
+        broker.stop()
+        assert not any(shard.is_alive() for shard in broker.shards)
+
+    def test_serve_confirms_ready(self):
+        address = "tcp://127.0.0.1:5588"
+        ready_address = "tcp://127.0.0.1:5589"
+
+        sub = ctx.socket(zmq.SUB)
+        sub.bind(ready_address)
+        sub.setsockopt_string(zmq.SUBSCRIBE, "topic here")
+        sub.setsockopt(zmq.SUBSCRIBE, READY_PREFIX + b"token")
+
+        broker = ShardedRoutingBroker(address, num_shards=2)
+        thread = threading.Thread(target=broker.serve, args=[.05])
+        thread.start()
+
+        req = ctx.socket(zmq.REQ)
+        req.connect(address)
+        req.send_multipart([REG_SUB.encode('utf-8'), b"topic here", ready_address.encode('utf-8'),
+                            pack_options({"ready": "token"})])
+        # The bound socket only attaches the shards' connections when it is used
+        while not req.poll(10):
+            sub.getsockopt(zmq.EVENTS)
+        broker_type, options, _ = split_reply(req.recv_multipart())
+        assert broker_type == BrokerType.ROUTE
+        # only sent once both shards are connected
+        assert options["ready"] is True
+        assert broker.shard_tokens == {}
+
+        # serve stops the shards when it returns
+        broker.shutdown()
+        thread.join(10)
+        assert not thread.is_alive()
+        assert not any(shard.is_alive() for shard in broker.shards)
+
+        for socket in [req, sub]:
+            socket.close(linger=0)
+
+    def test_patterns(self):
+        address = "tcp://127.0.0.1:5577"
+        pattern_sub_address = "tcp://127.0.0.1:5576"
+        pattern_pub_address = "tcp://127.0.0.1:5575"
+        pattern = "plant/*/temperature"
+        topics = ["plant/boiler/temperature", "plant/boiler/pressure", "plant/tank/temperature"]
+
+        pub = ctx.socket(zmq.XPUB)
+        pub.bind(pattern_pub_address)
+        sub = ctx.socket(zmq.SUB)
+        sub.bind(pattern_sub_address)
+        sub.setsockopt(zmq.SUBSCRIBE, tag(pattern))
+        sub.setsockopt(zmq.SUBSCRIBE, READY_PREFIX + b"token")
+
+        broker = ShardedRoutingBroker(address, num_shards=2)
+        thread = threading.Thread(target=broker.serve, args=[.05])
+        thread.start()
+
+        req = ctx.socket(zmq.REQ)
+        req.connect(address)
+        req.send_multipart([REG_SUB.encode('utf-8'), pattern.encode('utf-8'), pattern_sub_address.encode('utf-8'),
+                            pack_options({"ready": "token"})])
+        while not req.poll(10):
+            sub.getsockopt(zmq.EVENTS)
+        assert split_reply(req.recv_multipart())[1]["ready"] is True
+
+        for topic in topics:
+            req.send_multipart([REG_PUB.encode('utf-8'), topic.encode('utf-8'), pattern_pub_address.encode('utf-8')])
+            assert req.recv_string() == BrokerType.ROUTE
+        # the shards subscribe to every topic they own
+        subscribed = set()
+        while len(subscribed) < len(topics):
+            assert pub.poll(5000)
+            subscribed.add(pub.recv()[1:].decode('utf-8'))
+
+        # Each shard tags the messages of its own topics that match the pattern
+        for topic in topics:
+            pub.send_multipart([topic.encode('utf-8'), b"message here"])
+        received = set()
+        while len(received) < 2:
+            assert sub.poll(5000)
+            received.add(sub.recv_multipart()[0])
+        assert received == {tag(pattern) + topic.encode('utf-8') for topic in topics if topic.endswith("temperature")}
+        assert not sub.poll(200)
+
+        broker.shutdown()
+        thread.join(5)
+        assert not thread.is_alive()
+        broker.stop()
+
+        for socket in [req, pub, sub]:
+            socket.close(linger=0)
+
+    def test_routes_to_owning_shards(self):
+        address = "tcp://127.0.0.1:5623"
+        owning_sub_address = "tcp://127.0.0.1:5624"
+        owning_pub_address = "tcp://127.0.0.1:5625"
+        prefix = "sensor"
+        other = next(topic for topic in (f"sensor/{i}" for i in range(100))
+                     if shard_for_topic(topic, 2) != shard_for_topic(prefix, 2))
+
+        pub = ctx.socket(zmq.XPUB)
+        pub.bind(owning_pub_address)
+        sub = ctx.socket(zmq.SUB)
+        sub.bind(owning_sub_address)
+        sub.setsockopt_string(zmq.SUBSCRIBE, prefix)
+
+        broker = ShardedRoutingBroker(address, num_shards=2)
+        thread = threading.Thread(target=broker.serve, args=[.05])
+        thread.start()
+
+        req = ctx.socket(zmq.REQ)
+        req.connect(address)
+
+        def register_sub(token):
+            sub.setsockopt(zmq.SUBSCRIBE, READY_PREFIX + token)
+            req.send_multipart([REG_SUB.encode('utf-8'), prefix.encode('utf-8'), owning_sub_address.encode('utf-8'),
+                                pack_options({"ready": token.decode('utf-8')})])
+            while not req.poll(10):
+                sub.getsockopt(zmq.EVENTS)
+            assert split_reply(req.recv_multipart())[1]["ready"] is True
+
+        # The subscriber is only connected to the shard owning its topic
+        register_sub(b"one")
+        assert broker.subscribers[owning_sub_address] == {shard_for_topic(prefix, 2)}
+
+        # and to the shard of a topic starting with it once a publisher registers one
+        for topic in [prefix, other]:
+            req.send_multipart([REG_PUB.encode('utf-8'), topic.encode('utf-8'), owning_pub_address.encode('utf-8')])
+            assert req.recv_string() == BrokerType.ROUTE
+        assert broker.subscribers[owning_sub_address] == {0, 1}
+        # registering again is confirmed once both shards have seen the token
+        register_sub(b"two")
+
+        subscribed = set()
+        while len(subscribed) < 2:
+            assert pub.poll(5000)
+            subscribed.add(pub.recv()[1:].decode('utf-8'))
+        assert subscribed == {prefix, other}
+
+        # The shard owning the prefix receives the other topic too but does not forward it
+        for topic in [prefix, other]:
+            pub.send_multipart([topic.encode('utf-8'), b"message here"])
+        received = []
+        while len(received) < 2:
+            assert sub.poll(5000)
+            received.append(sub.recv_multipart()[0].decode('utf-8'))
+        assert not sub.poll(300)
+        assert sorted(received) == sorted([prefix, other])
+
+        broker.shutdown()
+        thread.join(10)
+        assert not thread.is_alive()
+        assert not any(shard.is_alive() for shard in broker.shards)
+
+        for socket in [req, pub, sub]:
+            socket.close(linger=0)
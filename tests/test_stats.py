@@ -0,0 +1,27 @@
+from pubsub import REG_PUB, REG_SUB
+from pubsub.stats import HWM_DROPS, MESSAGES_IN, BrokerStats, rates
+
+
+def test_snapshot():
+    stats = BrokerStats()
+    stats.register(REG_PUB, "topic", "tcp://127.0.0.1:5561")
+    stats.register(REG_SUB, "top", "tcp://127.0.0.1:5562")
+    stats.register(REG_SUB, "top", "tcp://127.0.0.1:5562")
+    stats.counters(b"topic")[MESSAGES_IN] += 2
+    stats.counters(b"topic")[HWM_DROPS] += 1
+
+    snapshot = stats.snapshot()
+    assert snapshot["registrations"] == {"publishers": 1, "subscribers": 2}
+    assert snapshot["topics"]["topic"]["messages_in"] == 2
+    assert snapshot["topics"]["topic"]["hwm_drops"] == 1
+    assert snapshot["topics"]["topic"]["publishers"] == ["tcp://127.0.0.1:5561"]
+    assert snapshot["topics"]["top"]["subscribers"] == ["tcp://127.0.0.1:5562"]
+
+
+def test_rates():
+    previous = {"time": 10.0, "topics": {"topic": {"messages_in": 100, "drops": 0}}}
+    current = {"time": 12.0, "topics": {"topic": {"messages_in": 300, "drops": 4},
+                                        "new": {"messages_in": 10}}}
+
+    assert rates(previous, current) == {"topic": {"messages_in": 100.0, "drops": 2.0},
+                                        "new": {"messages_in": 5.0}}
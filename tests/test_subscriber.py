@@ -1,3 +1,4 @@
+import json
 import struct
 import time
 from concurrent.futures import ThreadPoolExecutor
@@ -6,10 +7,12 @@ from time import sleep
 import pytest
 import zmq
 
-from pubsub import REG_SUB
+from pubsub import LOOKUP_DICTIONARIES, REG_SUB, REG_SUB_MANY
 from pubsub.broker import BrokerType
+from pubsub.compression import Compression, TopicCompression
+from pubsub.flow import FlowControl
 from pubsub.subscriber import Subscriber
-from pubsub.util import MessageType
+from pubsub.util import MessageType, WireFormat, get_codec, pack_batch, pack_envelope, pack_options, unpack_topics
 
 ctx = zmq.Context()
 sub_address = "tcp://127.0.0.1:5556"
@@ -37,13 +40,24 @@ class TestSubscriber:
         assert subscriber.registration is not None
         assert len(subscriber.topics) == 0
 
+    def test_constructor_flow_control(self):
+        # its own address, the subscriber of test_constructor may not be collected yet
+        subscriber = Subscriber("tcp://127.0.0.1:5599", broker_address, flow=FlowControl(rcvhwm=10, rcvbuf=1 << 16))
+        for socket in [subscriber.message_sub, subscriber.publisher_sub]:
+            assert socket.getsockopt(zmq.RCVHWM) == 10
+            assert socket.getsockopt(zmq.RCVBUF) == 1 << 16
+
     def broker_recv_reg(self, socket):
-        reg_type = socket.recv_string()
-        topic = socket.recv_string()
-        address = socket.recv_string()
+        message = socket.recv_multipart()
+        reg_type, topic, address = [part.decode('utf-8') for part in message[:3]]
         socket.send_string(BrokerType.ROUTE)
         return reg_type, topic, address
 
+    def broker_recv_reg_frames(self, socket):
+        message = socket.recv_multipart()
+        socket.send_string(BrokerType.ROUTE)
+        return message
+
     def test_register(self, reply):
         future = executor.submit(self.broker_recv_reg, reply)
 
@@ -56,6 +70,19 @@ class TestSubscriber:
         assert result[1] == topic
         assert result[2] == sub_address
 
+    def test_register_many(self, reply):
+        future = executor.submit(self.broker_recv_reg_frames, reply)
+
+        topics = ["topic 1", "topic 2", "topic 3"]
+        subscriber = Subscriber(sub_address, broker_address)
+        subscriber.register_many(topics)
+
+        result = future.result(60)
+        assert result[0].decode('utf-8') == REG_SUB_MANY
+        assert unpack_topics(result[1]) == topics
+        assert result[2].decode('utf-8') == sub_address
+        assert subscriber.topics == topics
+
     def callback(self, topic, message):
         self.notifications.append(Notification(topic, message))
 
@@ -90,6 +117,208 @@ class TestSubscriber:
         assert self.notifications[0].topic == topic
         assert self.notifications[0].message == message
 
+    def test_receive_batch(self, reply):
+        self.notifications.clear()
+        reg_future = executor.submit(self.broker_recv_reg, reply)
+
+        subscriber = Subscriber(sub_address, broker_address)
+        subscriber.register("the topic name")
+        subscriber.register_callback(self.callback)
+        notify_future = executor.submit(subscriber.wait_for_msg)
+        reg_future.result(60)
+
+        topic = "the topic name"
+        messages = ["message one", "message two", "message three"]
+
+        pub = ctx.socket(zmq.PUB)
+        pub.connect(sub_address)
+        sleep(1)
+
+        # an empty batch is skipped
+        time_sent = time.time()
+        pub.send_multipart([topic.encode('utf-8'),
+                            struct.pack('d', time_sent),
+                            MessageType.BATCH.encode('utf-8'),
+                            MessageType.STRING.encode('utf-8'),
+                            pack_batch([], MessageType.STRING)])
+        notify_future.result(60)
+        assert self.notifications == []
+
+        notify_future = executor.submit(subscriber.wait_for_msg)
+        pub.send_multipart([topic.encode('utf-8'),
+                            struct.pack('d', time_sent),
+                            MessageType.BATCH.encode('utf-8'),
+                            MessageType.STRING.encode('utf-8'),
+                            pack_batch([(time_sent, message) for message in messages], MessageType.STRING)])
+
+        notify_future.result(60)
+
+        assert [notification.topic for notification in self.notifications] == [topic] * 3
+        assert [notification.message for notification in self.notifications] == messages
+        assert subscriber.metrics.latency[topic].count == 3
+
+    def test_receive_ndarray(self, reply):
+        np = pytest.importorskip("numpy")
+        self.notifications.clear()
+        reg_future = executor.submit(self.broker_recv_reg, reply)
+
+        subscriber = Subscriber(sub_address, broker_address)
+        subscriber.register("the topic name")
+        subscriber.register_callback(self.callback)
+        notify_future = executor.submit(subscriber.wait_for_msg)
+        reg_future.result(60)
+
+        topic = "the topic name"
+        array = np.random.random((256, 256))
+
+        pub = ctx.socket(zmq.PUB)
+        pub.connect(sub_address)
+        sleep(1)
+
+        payload = get_codec(MessageType.NDARRAY).encode_frames(array)
+        pub.send_multipart(pack_envelope(topic, MessageType.NDARRAY, time.time(), payload, WireFormat.COMPACT),
+                           copy=False)
+
+        notify_future.result(60)
+
+        assert len(self.notifications) == 1
+        assert np.array_equal(self.notifications[0].message, array)
+        assert not self.notifications[0].message.flags.owndata
+
+    def test_run_once(self, reply):
+        reg_future = executor.submit(self.broker_recv_reg, reply)
+
+        subscriber = Subscriber(sub_address, broker_address)
+        subscriber.register("the topic name")
+        reg_future.result(60)
+
+        batches = []
+        subscriber.register_batch_callback(batches.append)
+
+        topic = "the topic name"
+        messages = ["message one", "message two", "message three"]
+
+        pub = ctx.socket(zmq.PUB)
+        pub.connect(sub_address)
+        sleep(.5)
+        # nothing to read yet, but polling lets the subscriber accept the connection
+        assert subscriber.run_once(timeout=0) == 0
+        sleep(.5)
+
+        for message in messages:
+            pub.send_multipart(pack_envelope(topic, MessageType.STRING, time.time(),
+                                             [message.encode('utf-8')], WireFormat.COMPACT))
+        sleep(.5)
+
+        assert subscriber.run_once(timeout=5, max_batch=2) == 2
+        assert subscriber.run_once(timeout=5, max_batch=2) == 1
+        assert batches == [[(topic, messages[0]), (topic, messages[1])], [(topic, messages[2])]]
+        pub.close()
+
+    def test_receive_snapshot(self, reply):
+        topic = "the topic name"
+        time_cached = time.time()
+        cached = pack_envelope(topic, MessageType.STRING, time_cached, [b"cached"], WireFormat.COMPACT)
+
+        def broker_send_snapshot():
+            message = reply.recv_multipart()
+            reply.send_multipart([BrokerType.ROUTE.encode('utf-8'), pack_options({"snapshot": [len(cached)]})]
+                                 + cached)
+            return json.loads(message[3])
+
+        reg_future = executor.submit(broker_send_snapshot)
+        subscriber = Subscriber(sub_address, broker_address)
+        subscriber.register(topic)
+        assert reg_future.result(60)["snapshot"] is True
+
+        batches = []
+        subscriber.register_batch_callback(batches.append)
+        assert subscriber.run_once(timeout=5) == 1
+        assert batches == [[(topic, "cached")]]
+
+        pub = ctx.socket(zmq.PUB)
+        pub.connect(sub_address)
+        sleep(.5)
+        assert subscriber.run_once(timeout=0) == 0
+        sleep(.5)
+
+        # The cached message may also arrive live, it is only delivered once
+        for time_sent, message in [(time_cached, b"cached"), (time.time(), b"newer")]:
+            pub.send_multipart(pack_envelope(topic, MessageType.STRING, time_sent, [message], WireFormat.COMPACT))
+        sleep(.5)
+
+        assert subscriber.run_once(timeout=5) == 1
+        assert batches[-1] == [(topic, "newer")]
+        assert subscriber.snapshot_times == {}
+        pub.close()
+
+
+    def test_receive_compressed(self, reply):
+        topic = "the topic name"
+        publisher = Compression(samples=10)
+        publisher.configure(topic, TopicCompression(threshold=0))
+        messages = [f"message {number} here, the same as the others".encode('utf-8') for number in range(10)]
+        for message in messages:
+            publisher.compress(topic, message)
+        publisher.configure(topic, publisher.train(topic, 1024))
+        dictionaries = publisher.export_dictionaries([topic])
+
+        def broker_reply(options):
+            message = reply.recv_multipart()
+            reply.send_multipart([BrokerType.ROUTE.encode('utf-8'), pack_options(options)])
+            return message[0].decode('utf-8'), json.loads(message[3])
+
+        # The broker has no dictionary yet at registration
+        reg_future = executor.submit(broker_reply, {"dictionaries": {}})
+        subscriber = Subscriber(sub_address, broker_address)
+        subscriber.register(topic)
+        assert reg_future.result(60)[1]["dictionaries"] is True
+
+        pub = ctx.socket(zmq.PUB)
+        pub.connect(sub_address)
+        sleep(.5)
+        assert subscriber.run_once(timeout=0) == 0
+        sleep(.5)
+
+        def send(message):
+            flags, payload = publisher.compress(topic, message)
+            pub.send_multipart(pack_envelope(topic, MessageType.STRING, time.time(), [payload], WireFormat.COMPACT,
+                                             flags=flags))
+
+        # so the subscriber looks it up when the first message using it arrives,
+        # and delivers the messages using it once the reply arrives
+        lookup_future = executor.submit(broker_reply, {"dictionaries": dictionaries})
+        send(messages[0])
+        send(messages[1])
+        assert subscriber.receive() == []
+        assert lookup_future.result(60)[0] == LOOKUP_DICTIONARIES
+        received = []
+        while len(received) < 2:
+            received.extend(subscriber.receive())
+        assert received == [(topic, message.decode('utf-8')) for message in messages[:2]]
+        assert subscriber.compression.statistics()[topic]["messages"] == 2
+        assert not subscriber.lookups
+
+        # Messages using a dictionary the broker does not have either are dropped
+        other = Compression()
+        other.configure(topic, TopicCompression(threshold=0, dictionary=b"another dictionary"))
+        lookup_future = executor.submit(broker_reply, {"dictionaries": {}})
+        flags, payload = other.compress(topic, messages[1])
+        pub.send_multipart(pack_envelope(topic, MessageType.STRING, time.time(), [payload], WireFormat.COMPACT,
+                                         flags=flags))
+        assert subscriber.receive() == []
+        lookup_future.result(60)
+        assert subscriber.run_once(timeout=5) == 0
+        assert len(subscriber.missing_dictionaries) == 1
+        assert subscriber.flow.dropped == {topic: 1}
+
+        # and so are payloads larger than the subscriber accepts
+        subscriber.compression.max_size = 10
+        send(messages[2])
+        assert subscriber.receive() == []
+        assert subscriber.flow.dropped == {topic: 2}
+
+        pub.close()
 
 class Notification:
 
@@ -0,0 +1,43 @@
+from pubsub.trie import TopicTrie
+
+
+def test_add():
+    trie = TopicTrie()
+    assert trie.add("sensor/temp", "a")
+    assert not trie.add("sensor/temp", "a")
+    assert trie.add("sensor/temp", "b")
+    # splits the edge of sensor/temp
+    assert trie.add("sensor/hum", "a")
+    assert trie.add("sensor", "c")
+    assert trie.add("", "d")
+
+    assert len(trie) == 4
+    assert trie["sensor/temp"] == ["a", "b"]
+    assert trie["sensor/hum"] == ["a"]
+    assert trie["sensor"] == ["c"]
+    assert trie[""] == ["d"]
+    assert trie["sensor/"] == []
+    assert trie["sensor/temperature"] == []
+    assert "sensor" in trie
+    assert "sens" not in trie
+    assert sorted(trie.items()) == [("", ["d"]), ("sensor", ["c"]), ("sensor/hum", ["a"]),
+                                    ("sensor/temp", ["a", "b"])]
+
+
+def test_match():
+    trie = TopicTrie()
+    trie.add("sensor/temp", "a")
+    trie.add("sensor/temp/inside", "b")
+    trie.add("sensor/hum", "a")
+    trie.add("sensors", "c")
+    trie.add("other", "d")
+
+    assert sorted(trie.match("sensor/temp")) == ["a", "b"]
+    assert sorted(trie.match("sensor/te")) == ["a", "b"]
+    assert sorted(trie.match("sensor/")) == ["a", "b"]
+    assert sorted(trie.match("sensor")) == ["a", "b", "c"]
+    assert sorted(trie.match("sensor/temp/inside/left")) == []
+    assert sorted(trie.match("sensor/x")) == []
+    assert sorted(trie.match("")) == ["a", "b", "c", "d"]
+
+    assert TopicTrie().match("") == []
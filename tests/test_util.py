@@ -0,0 +1,139 @@
+import struct
+import time
+
+import pytest
+
+from pubsub.util import MessageType, WireFormat, COMPACT_HEADER, Codec, CodecNotRegisteredError, StructCodec, \
+    choose_wire_format, decode_payload, get_codec, pack_batch, pack_envelope, pack_options, register_codec, \
+    RegistrationError, split_reply, unpack_envelope
+
+TOPIC = "topic here"
+
+
+def test_legacy_envelope():
+    time_sent = time.time()
+    frames = pack_envelope(TOPIC, MessageType.STRING, time_sent, [b"message here"])
+    assert frames == [TOPIC.encode('utf-8'), struct.pack('d', time_sent), b"STRING", b"message here"]
+
+    topic, actual_time, message_type, batch, payload = unpack_envelope(frames)
+    assert topic == TOPIC
+    assert actual_time == time_sent
+    assert message_type == MessageType.STRING
+    assert not batch
+    assert decode_payload(actual_time, message_type, batch, payload) == [(time_sent, "message here")]
+
+
+def test_compact_envelope():
+    time_sent = time.time()
+    message = {"number": 1}
+    payload = get_codec(MessageType.JSON).encode_frames(message)
+    frames = pack_envelope(TOPIC, MessageType.JSON, time_sent, payload, WireFormat.COMPACT)
+    assert len(frames) == 3
+    assert len(frames[1]) == COMPACT_HEADER.size
+
+    topic, actual_time, message_type, batch, payload = unpack_envelope(frames)
+    assert topic == TOPIC
+    assert actual_time == time_sent
+    assert message_type == MessageType.JSON
+    assert decode_payload(actual_time, message_type, batch, payload) == [(time_sent, message)]
+
+
+def test_batch_envelope():
+    messages = [(time.time(), "one"), (time.time(), "two")]
+    batch_payload = [pack_batch(messages, MessageType.STRING)]
+
+    for wire_format in [WireFormat.LEGACY, WireFormat.COMPACT]:
+        frames = pack_envelope(TOPIC, MessageType.STRING, time.time(), batch_payload, wire_format, batch=True)
+        topic, time_sent, message_type, batch, payload = unpack_envelope(frames)
+        assert batch
+        assert message_type == MessageType.STRING
+        assert decode_payload(time_sent, message_type, batch, payload) == messages
+
+
+def test_choose_wire_format():
+    assert choose_wire_format([WireFormat.LEGACY, WireFormat.COMPACT], WireFormat.COMPACT) == WireFormat.COMPACT
+    assert choose_wire_format([WireFormat.LEGACY, WireFormat.COMPACT], WireFormat.LEGACY) == WireFormat.LEGACY
+    assert choose_wire_format([], WireFormat.COMPACT) == WireFormat.LEGACY
+
+
+def test_split_reply():
+    assert split_reply([b"ROUTE"]) == ("ROUTE", {}, [])
+    assert split_reply([b"DIRECT", b"\x01", b"tcp://127.0.0.1:5561"]) == ("DIRECT", {}, [b"\x01",
+                                                                                       b"tcp://127.0.0.1:5561"])
+
+    options = pack_options({"wire_format": WireFormat.COMPACT})
+    assert split_reply([b"DIRECT", options, b"\x00"]) == ("DIRECT", {"wire_format": WireFormat.COMPACT}, [b"\x00"])
+
+    with pytest.raises(RegistrationError) as error:
+        split_reply([b"ERROR", b"Unknown registration type 'PUBLISH'"])
+    assert error.value.reason == "Unknown registration type 'PUBLISH'"
+
+
+def test_struct_codec():
+    codec = StructCodec("<dff", ["time", "x", "y"])
+    record = codec.decode(codec.encode((1.5, 2.0, 3.0)))
+    assert record == (1.5, 2.0, 3.0)
+    assert record.x == 2.0
+
+    plain = StructCodec("<dff")
+    assert plain.decode(plain.encode((1.5, 2.0, 3.0))) == (1.5, 2.0, 3.0)
+
+
+def test_struct_codec_bulk():
+    codec = StructCodec("<If", ["id", "value"], bulk=True)
+    records = [(i, i * 0.5) for i in range(10)]
+    data = codec.encode(records)
+    assert len(data) == 10 * struct.calcsize("<If")
+    assert codec.decode(data) == records
+    assert codec.decode(data)[3].value == 1.5
+
+
+def test_register_codec():
+    register_codec("position", StructCodec("<ff"), 64)
+    payload = get_codec("position").encode_frames((1.0, 2.0))
+
+    frames = pack_envelope(TOPIC, "position", time.time(), payload, WireFormat.COMPACT)
+    topic, time_sent, message_type, batch, payload = unpack_envelope(frames)
+    assert message_type == "position"
+    assert decode_payload(time_sent, message_type, batch, payload)[0][1] == (1.0, 2.0)
+
+    with pytest.raises(ValueError):
+        register_codec("other position", StructCodec("<ff"), 64)
+
+    with pytest.raises(CodecNotRegisteredError):
+        get_codec("not registered")
+
+    # a codec must implement encode and decode, and be a Codec to be registered
+    class EncodeOnly(Codec):
+        def encode(self, message):
+            return message
+
+    with pytest.raises(TypeError):
+        EncodeOnly()
+    with pytest.raises(TypeError):
+        register_codec("plain", object(), 65)
+
+
+def test_ndarray_codec():
+    np = pytest.importorskip("numpy")
+    import zmq
+
+    array = np.arange(12, dtype=np.float32).reshape(3, 4)
+    codec = get_codec(MessageType.NDARRAY)
+
+    payload = codec.encode_frames(array)
+    assert len(payload) == 2
+    frames = pack_envelope(TOPIC, MessageType.NDARRAY, time.time(), payload, WireFormat.COMPACT)
+
+    # Frames as they arrive from recv_multipart(copy=False)
+    received = [zmq.Frame(bytes(memoryview(frame))) for frame in frames]
+    topic, time_sent, message_type, batch, payload = unpack_envelope(received)
+    assert message_type == MessageType.NDARRAY
+
+    result = decode_payload(time_sent, message_type, batch, payload)[0][1]
+    assert result.dtype == np.float32
+    assert result.shape == (3, 4)
+    assert np.array_equal(result, array)
+    assert not result.flags.owndata
+
+    assert np.array_equal(codec.decode(codec.encode(array)), array)